@@ -3,23 +3,49 @@ import os
 import sys
 import time
 import json
+import hmac
+import hashlib
+import base64
 import shutil
 import errno
-import requests
+import stat
+import threading
+import queue
+import random
 import zipfile
-import urllib3
+import tarfile
+import tempfile
+import glob
+import importlib.util
+import sqlite3
 import subprocess
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+import logging
+import logging.handlers
+import gzip
+import uuid
+import atexit
+import contextlib
+import contextvars
+import signal
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
 import getpass
+import file_ops
+import metrics
+
+# Flask, watchdog ו-requests נטענים רק כשצריך אותם, כדי שבדיקה בודדת (--single) תעלה מהר ובלי תופעות לוואי
+FLASK_AVAILABLE = importlib.util.find_spec('flask') is not None
 
 # Flask API for deployment endpoint
-try:
-    from flask import Flask, request, jsonify
-    FLASK_AVAILABLE = True
-except ImportError:
-    FLASK_AVAILABLE = False
-if FLASK_AVAILABLE:
+_flask_app = None
+
+def create_app(watch=True):
+    """יוצר את אפליקציית ה-Flask (ל-Gunicorn: app:create_app()); watch=True מפעיל גם את ה-Watcher על pending"""
+    global _flask_app, observer
+    if _flask_app is not None:
+        return _flask_app
+    from flask import Flask, Response, request, jsonify
     app = Flask(__name__)
 
     @app.route('/deploy', defaults={'filename': None}, methods=['GET'], strict_slashes=False)  # ללא סלאש
@@ -78,7 +104,7 @@ if FLASK_AVAILABLE:
         dst = os.path.join(CONFIG_WATCH_DIR, filename)
         
         # Check if the file exists and provide guidance
-        if not os.path.exists(src):
+        if get_config_registry().get(filename) is None or not os.path.exists(src):
             error_response = {
                 'success': False,
                 'message': f'File {filename} not found in processed directory',
@@ -93,7 +119,7 @@ if FLASK_AVAILABLE:
                         'Ensure the configuration file exists in the processed directory',
                         'Try processing the configuration file first'
                     ],
-                    'available_files': os.listdir(CONFIG_PROCESSED_DIR) if os.path.exists(CONFIG_PROCESSED_DIR) else []
+                    'available_files': get_config_registry().names()
                 }
             }
             log_message(f"קובץ {filename} לא נמצא ב-processed")
@@ -119,294 +145,2628 @@ if FLASK_AVAILABLE:
             log_message(f"שגיאה בהעברת קובץ {filename}: {str(e)}")
             return jsonify({'success': False, 'message': str(e)}), 400
 
+    @app.route('/webhook', methods=['POST'], strict_slashes=False)
+    def github_webhook():
+        body = request.get_data()
+        signature = request.headers.get('X-Hub-Signature-256')
+        event = request.headers.get('X-GitHub-Event', '')
+        try:
+            payload = json.loads(body or b'{}')
+        except ValueError:
+            return jsonify({'success': False, 'message': 'Invalid JSON payload'}), 400
+
+        # החתימה נבדקת מול הסוד הכללי או מול webhook_secret של הגדרות המאגר
+        repository = payload.get('repository') or {}
+        owner = repository.get('owner') or {}
+        secrets = {WEBHOOK_SECRET} | {
+            ctx.config.get('webhook_secret', '')
+            for ctx in find_configs(owner.get('login') or owner.get('name') or '', repository.get('name', ''))
+        }
+        if not any(verify_webhook_signature(body, signature, secret) for secret in secrets):
+            log_message(f"Webhook: חתימה לא תקינה ({event})")
+            return jsonify({'success': False, 'message': 'Invalid signature'}), 401
+
+        if event == 'ping':
+            return jsonify({'success': True, 'message': 'pong'}), 200
+        if event != 'push':
+            return jsonify({'success': True, 'message': f'Event {event} ignored'}), 200
+
+        queued = handle_push_event(payload)
+        return jsonify({'success': True, 'queued': queued}), 202 if queued else 200
+
+    @app.route('/history/<filename>', methods=['GET'], strict_slashes=False)
+    def deploy_history(filename):
+        ctx = get_config_registry().get(filename)
+        if not ctx:
+            return jsonify({'success': False, 'message': f'File {filename} not found in processed directory'}), 400
+        try:
+            limit = max(1, min(int(request.args.get('limit', 10)), HISTORY_MAX_ENTRIES))
+        except ValueError:
+            return jsonify({'success': False, 'message': 'limit must be an integer'}), 400
+        return jsonify({'success': True, 'history': get_deploy_history(ctx, limit)}), 200
+
+    @app.route('/status', defaults={'filename': None}, methods=['GET'], strict_slashes=False)
+    @app.route('/status/<filename>', methods=['GET'], strict_slashes=False)
+    def deploy_status(filename):
+        # ללא שם קובץ - מצב כל ההגדרות
+        if not filename:
+            return jsonify({'success': True, 'states': get_state_store().get_all_states()}), 200
+
+        ctx = get_config_registry().get(filename)
+        if not ctx:
+            return jsonify({'success': False, 'message': f'File {filename} not found in processed directory'}), 400
+        result = {'success': True, 'state': get_state_store().get_state(ctx.state_key)}
+        if ctx.deploy_mode == 'release':
+            # רשימת הגרסאות שאפשר לחזור אליהן; החזרה עצמה רק ב-POST /rollback
+            live = get_live_release(ctx)
+            result['releases'] = [dict(release, live=bool(live and release['id'] == live['id']))
+                                  for release in get_state_store().get_releases(ctx.state_key)]
+        return jsonify(result), 200
+
+    @app.route('/rollback/<filename>', methods=['POST'], strict_slashes=False)
+    def rollback(filename):
+        ctx = get_config_registry().get(filename)
+        if not ctx:
+            return jsonify({'success': False, 'message': f'File {filename} not found in processed directory'}), 400
+        if ctx.deploy_mode != 'release':
+            return jsonify({'success': False, 'message': 'Rollback requires "deploy_mode": "release"'}), 400
+        release = rollback_release(ctx, request.args.get('release'))
+        if not release:
+            return jsonify({'success': False, 'message': 'No release available for rollback'}), 400
+        return jsonify({'success': True, 'release': release['name'], 'commit': release['commit_sha']}), 200
+
+    @app.route('/setup/<filename>', methods=['GET'], strict_slashes=False)
+    def setup_progress(filename):
+        ctx = get_config_registry().get(filename)
+        if not ctx:
+            return jsonify({'success': False, 'message': f'File {filename} not found in processed directory'}), 400
+        run = get_setup_run(ctx)
+        if not run:
+            return jsonify({'success': False, 'message': 'setup.sh has not run since the service started'}), 400
+        try:
+            lines = max(0, min(int(request.args.get('lines', 100)), SETUP_OUTPUT_LINES))
+        except ValueError:
+            return jsonify({'success': False, 'message': 'lines must be an integer'}), 400
+        return jsonify({'success': True, 'setup': run.snapshot(lines)}), 200
+
+    @app.route('/setup/<filename>/cancel', methods=['POST'], strict_slashes=False)
+    def setup_cancel(filename):
+        ctx = get_config_registry().get(filename)
+        if not ctx:
+            return jsonify({'success': False, 'message': f'File {filename} not found in processed directory'}), 400
+        run = get_setup_run(ctx)
+        if not run or not run.cancel():
+            return jsonify({'success': False, 'message': 'setup.sh is not running'}), 400
+        return jsonify({'success': True, 'message': 'Cancellation requested'}), 202
+
+    @app.route('/cache', methods=['GET'], strict_slashes=False)
+    def blob_cache_stats():
+        return jsonify({'success': True, 'cache': get_blob_cache().stats()}), 200
+
+    @app.route('/schedule', methods=['GET'], strict_slashes=False)
+    def poll_schedule():
+        registry = get_config_registry()
+        registry.refresh()
+        groups = group_contexts([ctx for ctx in (registry.get(name, refresh=False)
+                                                 for name in registry.names(refresh=False)) if ctx])
+        return jsonify({'success': True,
+                        'budget': get_rate_budget().snapshot(),
+                        'schedule': get_poll_scheduler().snapshot(groups)}), 200
+
+    @app.route('/metrics', methods=['GET'], strict_slashes=False)
+    def prometheus_metrics():
+        return Response(METRICS.render(), content_type=metrics.CONTENT_TYPE), 200
+
+    _flask_app = app
+    if watch:
+        observer = start_watcher()
+    return app
+
+observer = None
+
+def __getattr__(name):
+    # תאימות ל-"app:app" (Gunicorn) ול-app.app: האפליקציה נוצרת רק בגישה הראשונה
+    if name == 'app' and FLASK_AVAILABLE:
+        return create_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# הגדרות מערכת
+BASE_DIR = "/var/www/html/CornGetFromGit"
+CONFIG_WATCH_DIR = f"{BASE_DIR}/pending"  # תיקייה לקבצי הגדרות חדשים
+CONFIG_PROCESSED_DIR = f"{BASE_DIR}/processed"  # תיקייה לקבצים שעובדו
+LOG_FILE = f"{BASE_DIR}/log.log"
+SINGLE_LOG_FILE = f"{BASE_DIR}/log.single.log"  # לוג נפרד להרצות --single (cron), כדי שכל קובץ יוחלף רק על ידי תהליך אחד
+STATE_DB = f"{BASE_DIR}/state.db"  # מצב הפריסה של כל קובץ הגדרות, היסטוריית פריסות ומטמון ETag
+MIRRORS_DIR = f"{BASE_DIR}/mirrors"  # מראות git מקומיות (bare) עבור transport=git
+BLOB_CACHE_DIR = f"{BASE_DIR}/blobs"  # מטמון תוכן קבצים לפי מזהה ה-blob ב-git
+
+# הגדרות לוג (JSON lines, נכתב ברקע)
+LOG_MAX_BYTES = 20 * 1024 * 1024  # החלפת קובץ הלוג כשהוא מגיע לגודל זה
+LOG_ROTATE_INTERVAL = 86400  # החלפת קובץ הלוג בכתיבה הראשונה בכל פרק זמן כזה (שניות; 86400 = כל יום)
+LOG_BACKUP_COUNT = 14  # מספר קבצי הלוג הישנים (דחוסים ב-gzip) שנשמרים
+LOG_COMMAND_OUTPUT_LIMIT = 4000  # מספר התווים המקסימלי מפלט פקודה שנכתב ללוג
+
+# מרווחי זמן לבדיקות - לכל מאגר וענף מרווח משלו, שמותאם לתדירות הקומיטים שנצפתה
+AUTO_CHECK_INTERVAL = 1200   # מרווח הבדיקה ההתחלתי (20 דקות)
+POLL_MIN_INTERVAL = 120  # מרווח הבדיקה הקצר ביותר (מאגר עם קומיטים תכופים)
+POLL_MAX_INTERVAL = 6 * 3600  # מרווח הבדיקה הארוך ביותר (מאגר רדום)
+POLL_BACKOFF = 1.5  # הגדלת המרווח אחרי כל בדיקה בלי קומיט חדש
+POLL_CHANGE_FACTOR = 0.25  # אחרי קומיט חדש המרווח הוא חלק זה מהזמן הממוצע בין קומיטים
+POLL_JITTER = 0.1  # פיזור אקראי של מועד הבדיקה הבאה (חלק מהמרווח), כדי שהבדיקות לא יתרכזו יחד
+POLL_TICK = 15  # כל כמה שניות המתזמן בשירות בודק אילו מאגרים הגיע זמנם
+RATE_LIMIT_DEPLOY_RESERVE = 300  # בקשות API לכל טוקן שנשמרות לפריסות (לכל היותר עשירית מהמכסה); בדיקות תקופתיות נדחות כשהמכסה יורדת לכאן
+
+# סוד ברירת המחדל לאימות חתימות Webhook של GitHub (ניתן לדרוס לכל הגדרה עם webhook_secret)
+WEBHOOK_SECRET = os.environ.get('GITHUB_WEBHOOK_SECRET', '')
+
+# שמירת היסטוריית פריסות
+HISTORY_MAX_ENTRIES = 200  # מספר הרשומות המקסימלי לכל הגדרה
+HISTORY_MAX_AGE_DAYS = 180  # רשומות ישנות מזה נמחקות
+LEGACY_STATUS_FIELDS = ('last_commit', 'last_update', 'status', 'update_log', 'history')  # שדות מצב שנשמרו בעבר בקובץ ההגדרות
+
+# הגדרות הורדה וחילוץ
+DEFAULT_TRANSPORT = 'zip'  # zip - הורדת ארכיון הענף; git - fetch מצטבר למראה מקומית
+GIT_ARCHIVE_BATCH = 500  # מספר הנתיבים המקסימלי בכל הרצת git archive
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # גודל מקטע בהורדה ובחילוץ (בתים)
+DOWNLOAD_PROGRESS_INTERVAL = 10 * 1024 * 1024  # כל כמה בתים לדווח על התקדמות ההורדה
+
+# בעלות על קבצים שנפרסו - נקבעת רק לקבצים ולתיקיות שנכתבו
+DEPLOY_OWNER = 'www-data:www-data'
+FILE_OPS_HELPER = '/usr/local/lib/cornget/file_ops.py'  # מבצע פעולות שדורשות הרשאות, בהרצת sudo אחת (עותק של root בלבד)
+FILE_OPS_PYTHON = '/usr/bin/python3'  # המפרש שמורשה ב-sudoers (install.sh) להריץ את FILE_OPS_HELPER
+
+# הרצת setup.sh
+SETUP_TIMEOUT = 1800  # זמן מקסימלי להרצת setup.sh (שניות); ניתן לדרוס לכל הגדרה עם setup_timeout
+SETUP_KILL_GRACE = 10  # זמן המתנה בין SIGTERM ל-SIGKILL בביטול או בחריגה מהזמן (שניות)
+SETUP_KILL_ATTEMPTS = 3  # מספר ניסיונות העצירה; אחריהם ההרצה מסומנת כנכשלה והתהליך נשאר ללא מעקב
+SETUP_OUTPUT_LINES = 500  # מספר שורות הפלט האחרונות שנשמרות לצפייה חיה
+
+# מצב גרסאות (deploy_mode=release): כל פריסה נבנית בתיקייה נפרדת ונתיב הפריסה הוא קישור סימבולי אליה
+RELEASES_KEEP = 5  # מספר הגרסאות שנשמרות לכל הגדרה (לצורך rollback)
+
+# תיקיות עבודה לפריסות (ארכיון וקבצים שחולצו) - תיקייה נפרדת לכל פריסה
+WORKSPACE_ROOT = os.environ.get('CORNGET_WORKSPACE_ROOT') or tempfile.gettempdir()  # למשל tmpfs, או אותה מערכת קבצים של האתרים כדי שההעברה תהיה rename
+WORKSPACE_PREFIX = 'cornget-'
+WORKSPACE_MIN_FREE = 100 * 1024 * 1024  # שטח פנוי שחייב להישאר אחרי הורדה וחילוץ (בתים)
+WORKSPACE_STALE_AGE = 6 * 3600  # תיקיות עבודה ישנות מזה (שנשארו מתהליך שקרס) נמחקות באתחול
+
+# מטמון blobs (רק עבור transport=zip; במצב git המראה המקומית משמשת כמטמון)
+BLOB_CACHE_ENABLED = True
+BLOB_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # גודל מקסימלי; מעבר לכך נמחקים ה-blobs שלא נוצלו הכי הרבה זמן
+BLOB_FETCH_MAX = 10  # אם חסרים יותר blobs מזה (או ממה שנשאר במכסה מעל הרזרבה), מורידים את ארכיון ה-ZIP - שלא נספר במכסת ה-API - במקום בקשת API לכל blob
+BLOB_CACHE_LINK = 'reflink'  # reflink (העתקה אם לא נתמך), hardlink (חוסך מקום אך משתף הרשאות ותוכן עם האתר) או copy
+GIT_SYMLINK_MODE = '120000'  # מצב של קישור סימבולי בעץ הקבצים של git
+
+# הגדרות GitHub API
+GITHUB_API_URL = "https://api.github.com"
+GITHUB_URL = "https://github.com"
+HTTP_TIMEOUT = (10, 60)  # זמן המתנה מקסימלי לחיבור ולקריאה (שניות)
+HTTP_POOL_SIZE = 10  # מספר חיבורים פתוחים לשימוש חוזר לכל שרת
+HTTP_RETRIES = 3  # מספר ניסיונות חוזרים בשגיאות שרת או חיבור
+HTTP_BACKOFF_FACTOR = 1  # בסיס ההמתנה המעריכית בין ניסיונות (שניות)
+COMPARE_FILES_LIMIT = 300  # מספר הקבצים המקסימלי שמוחזר בהשוואת טווח; מעבר לכך הרשימה קטועה
+
+# הגדרות מקביליות
+SYNC_HASH_WORKERS = 4  # מספר הקבצים שמחושב להם hash במקביל בסנכרון תיקיית הפריסה
+POLL_MAX_WORKERS = 8  # מספר קבצי הגדרות שנבדקים במקביל בבדיקה התקופתית
+DEPLOY_WORKERS = 4  # מספר העובדים שמריצים פריסות מתור הפריסות
+GROUP_DEPLOY_WORKERS = 4  # מספר נתיבי הפריסה שמוצבים במקביל בפריסה קבוצתית (אותו מאגר, ענף וטוקן)
+HTTP_HOST_CONCURRENCY = 4  # מספר בקשות מקבילות מקסימלי לכל שרת
+
+# גבולות ה-buckets של מדדי הזמן ב-/metrics (שניות)
+PHASE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+SWEEP_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+class DeployContext:
+    """הגדרות הפריסה של קובץ הגדרות יחיד (במקום משתנים גלובליים משותפים)"""
+
+    def __init__(self, config, config_file=None):
+        self.config = config
+        self.config_file = config_file
+        self.repo_owner = config['repo_owner']
+        self.repo_name = config['repo_name']
+        self.deploy_path = config['deploy_path']
+        self.github_token = config.get('github_token', '')
+        self.update_only_changed_files = config.get('update_only_changed_files', False)
+        self.branch = config.get('branch', 'main')  # קריאת הענף מההגדרות
+        self.run_setup_script = config.get('run_setup_script', False)  # קריאת הגדרת הרצת setup.sh
+        self.transport = config.get('transport') or DEFAULT_TRANSPORT
+        self.repo_url = config.get('repo_url')  # כתובת git חלופית (למשל file:// לבדיקות)
+        self.deploy_mode = config.get('deploy_mode') or 'inplace'  # inplace או release
+        self.keep_releases = max(1, int(config.get('keep_releases') or RELEASES_KEEP))
+        self.releases_dir = config.get('releases_dir') or f"{os.path.normpath(self.deploy_path)}-releases"
+        # קבצים (glob) שמשפיעים על setup.sh; אם הוגדרו, setup.sh רץ רק כשאחד מהם השתנה
+        self.setup_inputs = config.get('setup_inputs') or []
+        self.setup_timeout = float(config.get('setup_timeout') or SETUP_TIMEOUT)
+
+    @property
+    def state_key(self):
+        """מפתח המצב של ההגדרה - כל שילוב של מאגר, ענף ונתיב פריסה נשמר בנפרד"""
+        return f"{self.repo_owner}/{self.repo_name}/{self.branch}:{os.path.normpath(self.deploy_path)}"
+
+    @property
+    def name(self):
+        """שם לתצוגה בלוג"""
+        if self.config_file:
+            return os.path.basename(self.config_file)
+        return f"{self.repo_owner}/{self.repo_name}"
+
+class ConfigEventHandler:
+    """בסיס למטפלי אירועים של watchdog"""
+
+    def dispatch(self, event):
+        # ה-Observer של watchdog קורא ל-dispatch; כך אין צורך לייבא את watchdog בטעינת המודול
+        handler = getattr(self, f"on_{event.event_type}", None)
+        if handler:
+            handler(event)
+
+class ConfigFileHandler(ConfigEventHandler):
+    """מטפל באירועים של קבצים חדשים בתיקיית pending - העיבוד עצמו רץ בתור הפריסות"""
+    
+    def on_created(self, event):
+        if not event.is_directory and event.src_path.endswith('.json'):
+            log_message(f"זוהה קובץ הגדרות חדש: {event.src_path}")
+            deploy_queue.enqueue_config_file(event.src_path)
+    
+    def on_modified(self, event):
+        if not event.is_directory and event.src_path.endswith('.json'):
+            if os.path.exists(event.src_path):
+                log_message(f"זוהה עדכון בקובץ הגדרות: {event.src_path}")
+                deploy_queue.enqueue_config_file(event.src_path)
+
+class ProcessedConfigHandler(ConfigEventHandler):
+    """מעדכן את מאגר ההגדרות בכל שינוי בתיקיית processed"""
+
+    def dispatch(self, event):
+        if event.is_directory:
+            return
+        for path in (event.src_path, getattr(event, 'dest_path', None)):
+            if path:
+                get_config_registry().invalidate(path)
+
+class ConfigRegistry:
+    """ההגדרות שב-processed בזיכרון, אחרי validate_config, לפי שם קובץ ולפי owner/repo/branch.
+    כשה-Observer פעיל (watch) המאגר מתעדכן רק מאירועים; אחרת כל refresh משווה את הקבצים לפי stat.
+    סריקה של כל ההגדרות קוראת ל-refresh פעם אחת ומחפשת עם refresh=False, כדי שלא תתבצע סריקת תיקייה לכל הגדרה"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.watched = False
+        self._entries = {}  # שם קובץ -> (חתימת stat, DeployContext)
+        self._by_repo = {}  # (owner, repo) -> שמות קבצים
+        self._by_branch = {}  # (owner, repo, branch) -> שמות קבצים
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _repo_key(owner, repo):
+        # שמות משתמשים ומאגרים ב-GitHub אינם תלויי רישיות
+        return (owner.lower(), repo.lower())
+
+    def _index(self, name, ctx, add):
+        repo_key = self._repo_key(ctx.repo_owner, ctx.repo_name)
+        for index, key in ((self._by_repo, repo_key), (self._by_branch, repo_key + (ctx.branch,))):
+            names = index.setdefault(key, set())
+            if add:
+                names.add(name)
+            else:
+                names.discard(name)
+                if not names:
+                    del index[key]
+
+    def _remove(self, name):
+        entry = self._entries.pop(name, None)
+        if entry:
+            self._index(name, entry[1], add=False)
+
+    def _reload(self, name):
+        """טוען מחדש קובץ אחד אם השתנה מאז הטעינה הקודמת"""
+        path = os.path.join(self.directory, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self._remove(name)
+            return
+        signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+        entry = self._entries.get(name)
+        if entry and entry[0] == signature:
+            return
+        self._remove(name)
+        if st.st_size == 0:
+            return  # הקובץ נכתב כרגע; האירוע הבא יטען אותו
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                config = json.load(f)
+            if not isinstance(config, dict) or not validate_config(config):
+                log_message(f"קובץ ההגדרות {name} לא תקין ולא ייבדק")
+                return
+            ctx = DeployContext(config, path)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log_message(f"שגיאה בטעינת הגדרות מ-{path}: {str(e)}")
+            return
+        # קבצים שנכתבו לפני מאגר המצב עדיין מכילים את הקומיט האחרון שנפרס
+        import_legacy_history(ctx, config)
+        self._entries[name] = (signature, ctx)
+        self._index(name, ctx, add=True)
+
+    def refresh(self):
+        """מסנכרן את המאגר עם התיקייה; כשה-Observer פעיל אין צורך בקריאה מהדיסק"""
+        with self._lock:
+            if self.watched and self._loaded:
+                return
+            try:
+                names = {name for name in os.listdir(self.directory) if name.endswith('.json')}
+            except FileNotFoundError:
+                names = set()
+            for name in set(self._entries) - names:
+                self._remove(name)
+            for name in sorted(names):
+                self._reload(name)
+            self._loaded = True
+
+    def watch(self):
+        """מסמן שה-Observer פעיל על התיקייה וטוען את המצב הנוכחי"""
+        with self._lock:
+            self.watched = False
+            self.refresh()
+            self.watched = True
+
+    def invalidate(self, path):
+        """נקרא מה-Observer כשקובץ ב-processed נוצר, השתנה, נמחק או הועבר"""
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.directory) or not path.endswith('.json'):
+            return
+        with self._lock:
+            self._reload(os.path.basename(path))
+
+    def names(self, refresh=True):
+        if refresh:
+            self.refresh()
+        with self._lock:
+            return sorted(self._entries)
+
+    def get(self, name, refresh=True):
+        """מחזיר את הקשר הפריסה של קובץ הגדרות לפי שמו, או None"""
+        if refresh:
+            self.refresh()
+        with self._lock:
+            entry = self._entries.get(name)
+            return entry[1] if entry else None
+
+    def find(self, owner, repo, branch=None, refresh=True):
+        """מחזיר את הקשרי הפריסה שמתאימים למאגר (ולענף, אם צוין)"""
+        if refresh:
+            self.refresh()
+        key = self._repo_key(owner, repo)
+        with self._lock:
+            names = self._by_repo.get(key, ()) if branch is None else self._by_branch.get(key + (branch,), ())
+            return [self._entries[name][1] for name in sorted(names)]
+
+_config_registry = None
+_config_registry_lock = threading.Lock()
+
+def get_config_registry():
+    """מחזיר את מאגר ההגדרות של התהליך (נוצר בשימוש הראשון)"""
+    global _config_registry
+    with _config_registry_lock:
+        if _config_registry is None or _config_registry.directory != CONFIG_PROCESSED_DIR:
+            _config_registry = ConfigRegistry(CONFIG_PROCESSED_DIR)
+        return _config_registry
+
+class DeployJob:
+    """עבודה בתור הפריסות: עיבוד קובץ מ-pending או פריסה של הגדרה לקומיט יעד"""
+
+    def __init__(self, key, ctx=None, config_file=None, target_commit=None,
+                 base_commit=None, file_changes=None, source='', contexts=None):
+        self.key = key
+        self.ctx = ctx
+        self.contexts = contexts  # פריסה קבוצתית: כמה הגדרות של אותו מאגר, ענף וטוקן
+        self.config_file = config_file
+        self.target_commit = target_commit
+        self.base_commit = base_commit
+        self.file_changes = file_changes
+        self.source = source
+        self.enqueued_at = time.time()
+        self.future = Future()
+
+    def supersede(self, target_commit, base_commit, file_changes, source):
+        """מעדכן עבודה שממתינה בתור לקומיט חדש יותר"""
+        if target_commit is None:
+            # בקשה לגרסה האחרונה מחליפה כל יעד ספציפי
+            self.file_changes = None
+        elif (self.file_changes is not None and file_changes is not None
+                and base_commit == self.target_commit):
+            # הטווחים רציפים - איחוד רשימות השינויים לפי הסדר, מה-base המקורי
+            merged = dict(self.file_changes)
+            merged.update(file_changes)
+            self.file_changes = merged
+        else:
+            self.base_commit = base_commit
+            self.file_changes = file_changes if self.target_commit is None else None
+        self.target_commit = target_commit
+        self.source = source
+
+    def run(self):
+        if self.config_file:
+            if not os.path.exists(self.config_file):
+                return True  # הקובץ כבר עובד על ידי עבודה קודמת
+            return process_config_file(self.config_file)
+        if self.contexts:
+            contexts = [ctx for ctx in self.contexts
+                        if not (self.target_commit and load_state(ctx) == self.target_commit)]
+            if not contexts:
+                return True
+            return deploy_group(contexts, self.target_commit, self.base_commit, self.file_changes)
+        if self.target_commit and load_state(self.ctx) == self.target_commit:
+            log_message(f"הקומיט {self.target_commit} כבר מותקן עבור {self.ctx.name}, דילוג")
+            return True
+        return deploy_latest_version(self.ctx, self.target_commit, self.base_commit, self.file_changes,
+                                     skip_if_current=True)
+
+class DeployQueue:
+    """תור פריסות מרכזי: עבודות לאותה הגדרה מאוחדות, ועובדים ברקע מרוקנים את התור"""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._pending = OrderedDict()  # מפתח -> עבודה שממתינה
+        self._running = set()  # מפתחות של עבודות שרצות כעת
+        self._condition = threading.Condition()
+        self._threads = []
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, name=f"deploy-worker-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _enqueue(self, key, **job_args):
+        with self._condition:
+            job = self._pending.get(key)
+            if job:
+                if job.contexts is not None:
+                    # איחוד רשימת ההגדרות של הקבוצה
+                    members = {ctx.state_key: ctx for ctx in job.contexts + job_args.get('contexts', [])}
+                    job.contexts = list(members.values())
+                if job.config_file is None:
+                    job.supersede(job_args.get('target_commit'), job_args.get('base_commit'),
+                                  job_args.get('file_changes'), job_args.get('source', ''))
+                log_message(f"עבודה עבור {key} כבר ממתינה בתור, אוחדה")
+                return job.future
+            job = DeployJob(key, **job_args)
+            self._pending[key] = job
+            self._start_workers()
+            self._condition.notify()
+            return job.future
+
+    def enqueue_deploy(self, ctx, target_commit=None, base_commit=None, file_changes=None, source=''):
+        """מכניס פריסה של הגדרה לתור ומחזיר Future עם תוצאתה"""
+        return self._enqueue(ctx.state_key, ctx=ctx, target_commit=target_commit,
+                             base_commit=base_commit, file_changes=file_changes, source=source)
+
+    def enqueue_group(self, contexts, target_commit=None, base_commit=None, file_changes=None, source=''):
+        """מכניס לתור פריסה קבוצתית של כמה הגדרות לאותו מאגר, ענף וטוקן"""
+        if len(contexts) == 1:
+            return self.enqueue_deploy(contexts[0], target_commit, base_commit, file_changes, source)
+        return self._enqueue(f"group:{'|'.join(group_key(contexts[0]))}", contexts=list(contexts),
+                             target_commit=target_commit, base_commit=base_commit,
+                             file_changes=file_changes, source=source)
+
+    def enqueue_config_file(self, config_file_path):
+        """מכניס עיבוד של קובץ הגדרות מ-pending לתור"""
+        return self._enqueue(f"file:{config_file_path}", config_file=config_file_path, source='watcher')
+
+    def _next_job(self):
+        # העבודה הוותיקה ביותר שאין עבודה אחרת עם אותו מפתח שרצה כעת
+        for key, job in self._pending.items():
+            if key not in self._running:
+                del self._pending[key]
+                self._running.add(key)
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                job = self._next_job()
+                while job is None:
+                    self._condition.wait()
+                    job = self._next_job()
+            try:
+                result = job.run()
+                if not result:
+                    log_message(f"עבודת הפריסה {job.key} ({job.source or 'ידני'}) נכשלה")
+                job.future.set_result(result)
+            except Exception as e:
+                log_message(f"שגיאה בעבודת פריסה {job.key}: {str(e)}")
+                job.future.set_result(False)
+            finally:
+                with self._condition:
+                    self._running.discard(job.key)
+                    self._condition.notify_all()
+
+    def depth(self):
+        """מספר העבודות שממתינות בתור"""
+        with self._condition:
+            return len(self._pending)
+
+    def wait_idle(self, timeout=None):
+        """ממתין עד שהתור ריק ואין עבודות רצות"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._pending or self._running:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+deploy_queue = DeployQueue(DEPLOY_WORKERS)
+
+# מדדים שנחשפים ב-/metrics
+METRICS = metrics.Registry()
+DEPLOY_PHASE_SECONDS = METRICS.histogram('cornget_deploy_phase_seconds', 'Time spent in each deploy phase', ('phase',), PHASE_BUCKETS)
+DEPLOY_SECONDS = METRICS.histogram('cornget_deploy_seconds', 'Total deploy duration by result', ('status',), PHASE_BUCKETS)
+GITHUB_REQUESTS = METRICS.counter('cornget_github_requests_total', 'GitHub requests by kind (api/download) and status code', ('kind', 'status'))
+GITHUB_RATE_LIMIT_REMAINING = METRICS.gauge('cornget_github_rate_limit_remaining', 'Last X-RateLimit-Remaining seen per token', ('token',))
+DOWNLOADED_BYTES = METRICS.counter('cornget_downloaded_bytes_total', 'Bytes downloaded from GitHub by source (zip/blob)', ('source',))
+FILES_WRITTEN = METRICS.counter('cornget_files_written_total', 'Files placed into deploy targets')
+FILES_REMOVED = METRICS.counter('cornget_files_removed_total', 'Files removed from deploy targets')
+DEPLOY_QUEUE_DEPTH = METRICS.gauge('cornget_deploy_queue_depth', 'Deploy jobs waiting in the queue', function=lambda: deploy_queue.depth())
+POLL_SWEEP_SECONDS = METRICS.histogram('cornget_poll_sweep_seconds', 'Duration of a periodic check over all processed configs', buckets=SWEEP_BUCKETS)
+POLLS_DEFERRED = METRICS.counter('cornget_polls_deferred_total', 'Due repo checks postponed to keep the deploy reserve of the API budget')
+
+def token_id(token):
+    """מזהה קצר לטוקן (לתוויות ולתצוגה) בלי לחשוף את הטוקן עצמו"""
+    return hashlib.sha256(token.encode()).hexdigest()[:8] if token else 'anonymous'
+
+class CompressedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """מחליף את קובץ הלוג לפי גודל או לפי זמן, ודוחס את הקבצים הישנים ב-gzip.
+    ההחלפה לפי זמן נקבעת לפי זמן השינוי של הקובץ עצמו ולא לפי זמן תחילת התהליך,
+    כך שגם הרצות קצרות (--single מ-cron) מחליפות קובץ שנכתב לאחרונה בפרק זמן קודם"""
+
+    def __init__(self, filename, max_bytes, interval, backup_count):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.interval = interval
+        self.namer = lambda name: name + '.gz'
+        self.rotator = self._compress
+
+    def _period(self, timestamp):
+        """מספר פרק הזמן (למשל היום, לפי השעון המקומי) שהזמן נופל בו"""
+        return int((timestamp + time.localtime(timestamp).tm_gmtoff) // self.interval)
+
+    def shouldRollover(self, record):
+        if self.interval:
+            try:
+                st = os.stat(self.baseFilename)
+            except OSError:
+                st = None
+            if st and st.st_size > 0 and self._period(st.st_mtime) < self._period(time.time()):
+                return True
+        return super().shouldRollover(record)
+
+    @staticmethod
+    def _compress(source, dest):
+        with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+# הקשר הלוג של ה-thread הנוכחי (מזהה פריסה, שם ההגדרה, שלב) - נוסף לכל שורה
+LOG_CONTEXT_FIELDS = ('deploy_id', 'config', 'phase')
+_log_context = contextvars.ContextVar('log_context', default={})
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """מוסיף שדות להקשר הלוג עד סוף הבלוק"""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+# השלב הנוכחי וזמן תחילתו, למדידת משך כל שלב בפריסה
+_phase_timer = contextvars.ContextVar('phase_timer', default=None)
+
+def set_log_phase(phase):
+    """מעדכן את השלב בהקשר הלוג הנוכחי (עד סוף בלוק ה-log_context שסביבו) ומודד את משך השלב הקודם"""
+    if _log_context.get().get('phase') == phase:
+        return
+    end_log_phase()
+    _log_context.set({**_log_context.get(), 'phase': phase})
+    _phase_timer.set((phase, time.monotonic()))
+
+def end_log_phase():
+    """רושם את משך השלב הנוכחי ב-/metrics"""
+    timer = _phase_timer.get()
+    if timer:
+        phase, started = timer
+        DEPLOY_PHASE_SECONDS.observe(time.monotonic() - started, phase=phase)
+        _phase_timer.set(None)
+
+class LogContextFilter(logging.Filter):
+    """מצמיד לרשומה את ההקשר של ה-thread שכתב אותה, לפני שהיא עוברת לתור"""
+
+    def filter(self, record):
+        for field, value in _log_context.get().items():
+            setattr(record, field, value)
+        return True
+
+class JsonLogFormatter(logging.Formatter):
+    """שורת JSON אחת לכל רשומה"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%d %H:%M:%S'),
+            'level': record.levelname.lower(),
+            'message': record.getMessage(),
+        }
+        for field in LOG_CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        command_output = getattr(record, 'command_output', None)
+        if command_output:
+            entry['command_output'] = command_output
+        return json.dumps(entry, ensure_ascii=False)
+
+_logger = None
+_log_listener = None
+_log_file = None
+_logger_lock = threading.Lock()
+
+def get_logger():
+    """מחזיר את ה-logger של התהליך. הכתיבה לקובץ ולמסך נעשית ב-thread רקע שקורא מתור בזיכרון"""
+    global _logger, _log_listener, _log_file
+    with _logger_lock:
+        if _logger is not None and _log_file == LOG_FILE:
+            return _logger
+        if _log_listener is not None:
+            _log_listener.stop()  # הקובץ הוחלף - כותבים את מה שנשאר בתור לקובץ הקודם
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(logging.Formatter('[%(asctime)s] %(message)s', '%Y-%m-%d %H:%M:%S'))
+        handlers = [console]
+        try:
+            os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+            file_handler = CompressedRotatingFileHandler(LOG_FILE, LOG_MAX_BYTES, LOG_ROTATE_INTERVAL, LOG_BACKUP_COUNT)
+            file_handler.setFormatter(JsonLogFormatter())
+            handlers.append(file_handler)
+        except OSError as e:
+            print(f"שגיאה בפתיחת קובץ הלוג {LOG_FILE}: {str(e)}")
+        log_queue = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.addFilter(LogContextFilter())
+        logger = logging.getLogger('cornget')
+        logger.handlers[:] = [queue_handler]
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        _log_listener = logging.handlers.QueueListener(log_queue, *handlers)
+        _log_listener.start()
+        _logger = logger
+        _log_file = LOG_FILE
+        return _logger
+
+@atexit.register
+def flush_log():
+    """כותב את כל הרשומות שנשארו בתור לפני יציאה"""
+    global _logger, _log_listener
+    with _logger_lock:
+        if _log_listener is not None:
+            _log_listener.stop()
+        _logger = _log_listener = None
+
+def truncate_output(output):
+    """מקצר פלט פקודה ארוך לפני הכתיבה ללוג"""
+    if output and len(output) > LOG_COMMAND_OUTPUT_LIMIT:
+        return output[:LOG_COMMAND_OUTPUT_LIMIT] + f"\n... ({len(output) - LOG_COMMAND_OUTPUT_LIMIT} תווים נוספים הושמטו)"
+    return output
+
+def log_message(message, command_output=None):
+    """כותב הודעה ללוג ולמסך (הכתיבה עצמה נעשית ברקע)"""
+    extra = {'command_output': truncate_output(command_output)} if command_output else None
+    get_logger().info(message, extra=extra)
+
+def run_command(command):
+    """מריץ פקודה ומחזיר את התוצאה והקוד"""
+    try:
+        # הרצת הפקודה דרך /bin/bash כדי לשמור על הגדרות ה-sudo
+        process = subprocess.run(['/bin/bash', '-c', command], 
+                               capture_output=True, 
+                               text=True)
+        output = process.stdout + process.stderr
+        return_code = process.returncode
+        
+        log_message(f"הרצת פקודה: {command}", 
+                   f"Return code: {return_code}\nOutput:\n{output}")
+        return return_code, output
+    except Exception as e:
+        error_msg = f"שגיאה בהרצת פקודה {command}: {str(e)}"
+        log_message(error_msg)
+        return -1, error_msg
+
+# Session משותף לכל טוקן, כדי לעשות שימוש חוזר בחיבורי TCP/TLS בין הבקשות
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+def get_http_session(token=None):
+    """מחזיר Session עם מאגר חיבורים וניסיונות חוזרים עבור הטוקן הנתון"""
+    key = token or ''
+    with _http_sessions_lock:
+        session = _http_sessions.get(key)
+        if session is None:
+            import requests
+            import urllib3
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            # התעלמות מאזהרות SSL
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+            # 429 לא נשלח שוב ו-Retry-After לא גורם להמתנה בתוך הבקשה (שיכולה להיות ארוכה ולחסום
+            # thread של בדיקה או פריסה); ההמתנה נרשמת ב-RateBudget, והמתזמן דוחה את הבדיקות של הטוקן
+            retry = Retry(total=HTTP_RETRIES,
+                          backoff_factor=HTTP_BACKOFF_FACTOR,
+                          status_forcelist=(500, 502, 503, 504),
+                          allowed_methods=frozenset(['GET', 'HEAD']),
+                          respect_retry_after_header=False,
+                          raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                                  pool_maxsize=HTTP_POOL_SIZE,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.verify = False
+            if token:
+                session.headers['Authorization'] = f'token {token}'
+            _http_sessions[key] = session
+        return session
+
+# הגבלת מספר הבקשות המקבילות לכל שרת
+_host_semaphores = {}
+
+def get_host_semaphore(url):
+    """מחזיר את הסמפור שמגביל בקשות מקבילות לשרת של הכתובת"""
+    host = urlparse(url).netloc
+    with _http_sessions_lock:
+        semaphore = _host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(HTTP_HOST_CONCURRENCY)
+            _host_semaphores[host] = semaphore
+        return semaphore
+
+def github_get(url, token=None, **kwargs):
+    """מבצע בקשת GET ל-GitHub דרך ה-Session המשותף של הטוקן"""
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    with get_host_semaphore(url):
+        response = get_http_session(token).get(url, **kwargs)
+    GITHUB_REQUESTS.inc(kind='api' if url.startswith(GITHUB_API_URL) else 'download', status=response.status_code)
+    get_rate_budget().update(token, response)
+    return response
+
+class RateBudget:
+    """מכסת בקשות ה-API של GitHub לכל טוקן, לפי כותרות X-RateLimit-* בתשובות האחרונות"""
+
+    def __init__(self, reserve=RATE_LIMIT_DEPLOY_RESERVE):
+        self.reserve = reserve  # בקשות שנשמרות לפריסות, לטוקן עם מכסה גדולה
+        self._tokens = {}  # מזהה טוקן -> {'limit', 'remaining', 'reset', 'updated'}
+        self._lock = threading.Lock()
+
+    def update(self, token, response):
+        """מעדכן את המכסה מכותרות התשובה; מכסה שנוצלה נרשמת בלוג פעם אחת עד האיפוס"""
+        headers = response.headers
+        retry_after = headers.get('Retry-After')
+        if response.status_code in (403, 429) and retry_after and retry_after.isdigit():
+            self.block(token, int(retry_after), response.status_code)
+            return
+        remaining = headers.get('X-RateLimit-Remaining')
+        if remaining is None or not remaining.isdigit():
+            return
+        if headers.get('X-RateLimit-Resource', 'core') != 'core':
+            return  # מכסות נפרדות (search, graphql) לא משפיעות על הבדיקות
+        key = token_id(token)
+        reset = headers.get('X-RateLimit-Reset')
+        limit = headers.get('X-RateLimit-Limit')
+        with self._lock:
+            previous = self._tokens.get(key) or {}
+            entry = {'limit': int(limit) if limit and limit.isdigit() else previous.get('limit'),
+                     'remaining': int(remaining),
+                     'reset': int(reset) if reset and reset.isdigit() else previous.get('reset'),
+                     'updated': time.time()}
+            self._tokens[key] = entry
+        GITHUB_RATE_LIMIT_REMAINING.set(entry['remaining'], token=key)
+        if entry['remaining'] == 0 and previous.get('remaining') != 0:
+            until = time.strftime('%H:%M:%S', time.localtime(entry['reset'])) if entry['reset'] else 'לא ידוע'
+            log_message(f"מכסת ה-API של GitHub נוצלה עבור הטוקן {key} (סטטוס {response.status_code}), עד {until}")
+
+    def block(self, token, seconds, status):
+        """מסמן את המכסה של הטוקן כמנוצלת עד סוף ההמתנה שביקש GitHub (Retry-After, למשל במגבלה משנית)"""
+        key = token_id(token)
+        now = time.time()
+        with self._lock:
+            previous = self._tokens.get(key) or {}
+            self._tokens[key] = {'limit': previous.get('limit'), 'remaining': 0,
+                                 'reset': int(now) + seconds, 'updated': now}
+        GITHUB_RATE_LIMIT_REMAINING.set(0, token=key)
+        log_message(f"GitHub ביקש להמתין {seconds} שניות עבור הטוקן {key} (סטטוס {status}), הבדיקות נדחות")
+
+    def _current(self, key, now):
+        """מחזיר את רשומת הטוקן, או None אם אינה ידועה או שחלון המכסה כבר התאפס"""
+        entry = self._tokens.get(key)
+        if not entry or (entry['reset'] and entry['reset'] <= now):
+            return None
+        return entry
+
+    def reserve_for(self, entry):
+        """הרזרבה לפריסות לפי המכסה של הטוקן: בלי טוקן המכסה היא 60 בשעה, ורזרבה קבועה הייתה חוסמת כל בדיקה"""
+        if entry.get('limit'):
+            return min(self.reserve, entry['limit'] // 10)
+        return self.reserve
+
+    def poll_allowance(self, token, now=None):
+        """מספר הבדיקות שאפשר לבצע כעת בלי לגעת ברזרבה של הפריסות; None = ללא הגבלה ידועה"""
+        with self._lock:
+            entry = self._current(token_id(token), now or time.time())
+        if entry is None:
+            return None
+        return max(0, entry['remaining'] - self.reserve_for(entry))
+
+    def spend(self, token, count):
+        """מוריד מראש בקשות שעומדות להתבצע, כדי שהחלטות במקביל יראו אותן לפני שהכותרות יתעדכנו"""
+        with self._lock:
+            entry = self._current(token_id(token), time.time())
+            if entry is not None:
+                entry['remaining'] = max(0, entry['remaining'] - count)
+
+    def reset_time(self, token):
+        """מחזיר את זמן איפוס המכסה של הטוקן (או None)"""
+        with self._lock:
+            entry = self._tokens.get(token_id(token))
+        return entry['reset'] if entry else None
+
+    def snapshot(self):
+        """מצב המכסה של כל הטוקנים (לפי מזהה מקוצר, בלי הטוקן עצמו)"""
+        now = time.time()
+        with self._lock:
+            items = sorted(self._tokens.items())
+        return [{'token': key, 'limit': entry['limit'], 'remaining': entry['remaining'], 'reset': entry['reset'],
+                 'reset_in': max(0, int(entry['reset'] - now)) if entry['reset'] else None,
+                 'deploy_reserve': self.reserve_for(entry),
+                 'poll_allowance': max(0, entry['remaining'] - self.reserve_for(entry)) if self._current(key, now) else None,
+                 'updated': entry['updated']}
+                for key, entry in items]
+
+_rate_budget = None
+_rate_budget_lock = threading.Lock()
+
+def get_rate_budget():
+    """מחזיר את מעקב המכסה המשותף (נוצר בשימוש הראשון)"""
+    global _rate_budget
+    with _rate_budget_lock:
+        if _rate_budget is None:
+            _rate_budget = RateBudget()
+        return _rate_budget
+
+class StateStore:
+    """מאגר מצב ב-SQLite (מצב WAL) עם רשומה נפרדת לכל הגדרת פריסה"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS deploy_state (
+            state_key TEXT PRIMARY KEY,
+            repo_owner TEXT,
+            repo_name TEXT,
+            branch TEXT,
+            deploy_path TEXT,
+            last_commit TEXT,
+            last_status TEXT,
+            last_check REAL,
+            last_deploy REAL,
+            last_deploy_duration REAL,
+            setup_fingerprint TEXT
+        );
+        CREATE TABLE IF NOT EXISTS deploy_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            state_key TEXT NOT NULL,
+            commit_sha TEXT,
+            status TEXT,
+            message TEXT,
+            started_at REAL,
+            duration REAL
+        );
+        CREATE INDEX IF NOT EXISTS deploy_history_key ON deploy_history (state_key, id);
+        CREATE TABLE IF NOT EXISTS etag_cache (
+            cache_key TEXT PRIMARY KEY,
+            sha TEXT,
+            etag TEXT,
+            last_modified TEXT,
+            updated_at REAL
+        );
+        CREATE TABLE IF NOT EXISTS blob_cache (
+            sha TEXT PRIMARY KEY,
+            size INTEGER,
+            last_used REAL
+        );
+        CREATE INDEX IF NOT EXISTS blob_cache_last_used ON blob_cache (last_used);
+        CREATE TABLE IF NOT EXISTS deploy_manifest (
+            state_key TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER,
+            mtime_ns INTEGER,
+            hash TEXT,
+            PRIMARY KEY (state_key, path)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS releases (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            state_key TEXT NOT NULL,
+            name TEXT,
+            path TEXT,
+            commit_sha TEXT,
+            status TEXT,
+            created_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS releases_key ON releases (state_key, id);
+        CREATE TABLE IF NOT EXISTS poll_schedule (
+            repo_key TEXT PRIMARY KEY,
+            interval REAL,
+            next_check REAL,
+            last_check REAL,
+            last_head TEXT,
+            last_change REAL,
+            avg_change_gap REAL
+        );
+    """
+
+    STATE_FIELDS = ('last_commit', 'last_status', 'last_check', 'last_deploy', 'last_deploy_duration',
+                    'setup_fingerprint')
+    SCHEDULE_FIELDS = ('interval', 'next_check', 'last_check', 'last_head', 'last_change', 'avg_change_gap')
+
+    # עמודות שנוספו אחרי יצירת הטבלה - נוספות למאגרים קיימים בפתיחה
+    MIGRATIONS = (('deploy_state', 'setup_fingerprint', 'TEXT'),)
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()  # חיבור נפרד לכל thread
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._share_files()
+            with conn:
+                conn.executescript(self.SCHEMA)
+                for table, column, column_type in self.MIGRATIONS:
+                    columns = {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}
+                    if column not in columns:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+            self._local.conn = conn
+        return conn
+
+    def _share_files(self):
+        """השירות (root) וה-cron (www-data) כותבים לאותו מאגר: קבצי ה-WAL שנוצרו על ידי התהליך
+        מקבלים את הקבוצה של קובץ המאגר והרשאת כתיבה לקבוצה"""
+        if os.name == 'nt':
+            return
+        try:
+            gid = os.stat(self.path).st_gid
+        except OSError:
+            return
+        for path in (self.path, f"{self.path}-wal", f"{self.path}-shm"):
+            try:
+                st = os.stat(path)
+                if st.st_uid != os.getuid():
+                    continue
+                if st.st_gid != gid:
+                    os.chown(path, -1, gid)
+                if st.st_mode & 0o060 != 0o060:
+                    os.chmod(path, st.st_mode | 0o060)
+            except OSError:
+                pass
+
+    def get_state(self, state_key):
+        """מחזיר את רשומת המצב של ההגדרה כמילון (או None)"""
+        row = self._connection().execute(
+            "SELECT * FROM deploy_state WHERE state_key = ?", (state_key,)).fetchone()
+        return dict(row) if row else None
+
+    def get_all_states(self):
+        """מחזיר את כל רשומות המצב"""
+        rows = self._connection().execute("SELECT * FROM deploy_state ORDER BY state_key").fetchall()
+        return [dict(row) for row in rows]
+
+    def update_state(self, ctx, **fields):
+        """מעדכן שדות במצב ההגדרה בפעולה אטומית אחת (יוצר את הרשומה אם אינה קיימת)"""
+        unknown = set(fields) - set(self.STATE_FIELDS)
+        if unknown:
+            raise ValueError(f"שדות מצב לא מוכרים: {', '.join(sorted(unknown))}")
+        columns = ['state_key', 'repo_owner', 'repo_name', 'branch', 'deploy_path'] + list(fields)
+        values = [ctx.state_key, ctx.repo_owner, ctx.repo_name, ctx.branch, ctx.deploy_path] + list(fields.values())
+        updates = ', '.join(f"{column} = excluded.{column}" for column in fields) or "state_key = excluded.state_key"
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                f"INSERT INTO deploy_state ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT(state_key) DO UPDATE SET {updates}", values)
+
+    def add_history(self, state_key, commit_sha, status, message, started_at=None, duration=None):
+        """מוסיף רשומה ליומן הפריסות ומצמצם את הרשומות הישנות של אותה הגדרה"""
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT INTO deploy_history (state_key, commit_sha, status, message, started_at, duration) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (state_key, commit_sha, status, message, started_at or time.time(), duration))
+            self._compact_history(conn, state_key)
+
+    def _compact_history(self, conn, state_key):
+        """מחיקת רשומות שחורגות ממגבלת הכמות או הגיל"""
+        conn.execute(
+            "DELETE FROM deploy_history WHERE state_key = ? AND started_at < ?",
+            (state_key, time.time() - HISTORY_MAX_AGE_DAYS * 86400))
+        conn.execute(
+            "DELETE FROM deploy_history WHERE state_key = ? AND id <= "
+            "(SELECT id FROM deploy_history WHERE state_key = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (state_key, state_key, HISTORY_MAX_ENTRIES))
+
+    def get_history(self, state_key, limit=10):
+        """מחזיר את N הפריסות האחרונות של ההגדרה, מהחדשה לישנה"""
+        rows = self._connection().execute(
+            "SELECT commit_sha, status, message, started_at, duration FROM deploy_history "
+            "WHERE state_key = ? ORDER BY id DESC LIMIT ?", (state_key, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_etag(self, cache_key):
+        """מחזיר את רשומת ה-ETag של ראש הענף (או None)"""
+        row = self._connection().execute(
+            "SELECT sha, etag, last_modified FROM etag_cache WHERE cache_key = ?", (cache_key,)).fetchone()
+        return dict(row) if row else None
+
+    def set_etag(self, cache_key, sha, etag, last_modified):
+        """שומר את ה-ETag וה-SHA האחרונים של ראש הענף"""
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO etag_cache (cache_key, sha, etag, last_modified, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)", (cache_key, sha, etag, last_modified, time.time()))
+
+    def get_schedule(self, repo_key):
+        """מחזיר את רשומת תזמון הבדיקות של המאגר והענף (או None)"""
+        row = self._connection().execute(
+            "SELECT * FROM poll_schedule WHERE repo_key = ?", (repo_key,)).fetchone()
+        return dict(row) if row else None
+
+    def get_all_schedules(self):
+        """מחזיר את כל רשומות התזמון, לפי מועד הבדיקה הבאה"""
+        rows = self._connection().execute("SELECT * FROM poll_schedule ORDER BY next_check").fetchall()
+        return [dict(row) for row in rows]
+
+    def set_schedule(self, repo_key, **fields):
+        """מעדכן שדות בתזמון המאגר (יוצר את הרשומה אם אינה קיימת)"""
+        unknown = set(fields) - set(self.SCHEDULE_FIELDS)
+        if unknown:
+            raise ValueError(f"שדות תזמון לא מוכרים: {', '.join(sorted(unknown))}")
+        columns = ['repo_key'] + list(fields)
+        updates = ', '.join(f"{column} = excluded.{column}" for column in fields) or "repo_key = excluded.repo_key"
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                f"INSERT INTO poll_schedule ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT(repo_key) DO UPDATE SET {updates}", [repo_key] + list(fields.values()))
+
+    def get_cached_blobs(self, shas):
+        """מחזיר את תת-הקבוצה של מזהי ה-blob שרשומים במטמון"""
+        conn = self._connection()
+        found = set()
+        shas = list(shas)
+        for i in range(0, len(shas), 500):
+            batch = shas[i:i + 500]
+            rows = conn.execute(
+                f"SELECT sha FROM blob_cache WHERE sha IN ({', '.join('?' * len(batch))})", batch).fetchall()
+            found.update(row['sha'] for row in rows)
+        return found
+
+    def add_blob(self, sha, size):
+        """רושם blob חדש במטמון"""
+        conn = self._connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO blob_cache (sha, size, last_used) VALUES (?, ?, ?)",
+                         (sha, size, time.time()))
+
+    def touch_blobs(self, shas):
+        """מעדכן את זמן השימוש האחרון של ה-blobs (לצורך פינוי LRU)"""
+        conn = self._connection()
+        now = time.time()
+        with conn:
+            conn.executemany("UPDATE blob_cache SET last_used = ? WHERE sha = ?", [(now, sha) for sha in shas])
+
+    def remove_blobs(self, shas):
+        """מוחק blobs מרישום המטמון"""
+        conn = self._connection()
+        with conn:
+            conn.executemany("DELETE FROM blob_cache WHERE sha = ?", [(sha,) for sha in shas])
+
+    def get_blob_cache_size(self):
+        """מחזיר (מספר blobs, סך הבתים) במטמון"""
+        row = self._connection().execute("SELECT COUNT(*) AS count, COALESCE(SUM(size), 0) AS size FROM blob_cache").fetchone()
+        return row['count'], row['size']
+
+    def get_lru_blobs(self, limit):
+        """מחזיר את ה-blobs שלא נוצלו הכי הרבה זמן, מהישן לחדש"""
+        rows = self._connection().execute(
+            "SELECT sha, size FROM blob_cache ORDER BY last_used LIMIT ?", (limit,)).fetchall()
+        return [(row['sha'], row['size']) for row in rows]
+
+    def get_manifest(self, state_key):
+        """מחזיר את רשימת הקבצים שנפרסו לאחרונה כמילון נתיב -> (size, mtime_ns, hash)"""
+        rows = self._connection().execute(
+            "SELECT path, size, mtime_ns, hash FROM deploy_manifest WHERE state_key = ?", (state_key,)).fetchall()
+        return {row['path']: (row['size'], row['mtime_ns'], row['hash']) for row in rows}
+
+    def update_manifest(self, state_key, entries, removed=()):
+        """מעדכן את רשימת הקבצים שנפרסו: entries הוא מילון נתיב -> (size, mtime_ns, hash)"""
+        conn = self._connection()
+        with conn:
+            conn.executemany("DELETE FROM deploy_manifest WHERE state_key = ? AND path = ?",
+                             [(state_key, path) for path in removed])
+            conn.executemany(
+                "INSERT OR REPLACE INTO deploy_manifest (state_key, path, size, mtime_ns, hash) VALUES (?, ?, ?, ?, ?)",
+                [(state_key, path) + tuple(entry) for path, entry in entries.items()])
+
+    def copy_manifest(self, source_key, target_key):
+        """מעתיק את רשימת הקבצים של מפתח אחד למפתח אחר"""
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM deploy_manifest WHERE state_key = ?", (target_key,))
+            conn.execute(
+                "INSERT INTO deploy_manifest (state_key, path, size, mtime_ns, hash) "
+                "SELECT ?, path, size, mtime_ns, hash FROM deploy_manifest WHERE state_key = ?",
+                (target_key, source_key))
+
+    def delete_manifest(self, manifest_key):
+        """מוחק את רשימת הקבצים של המפתח"""
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM deploy_manifest WHERE state_key = ?", (manifest_key,))
+
+    def add_release(self, state_key, name, path, commit_sha, status):
+        """רושם גרסה (release) חדשה של ההגדרה ומחזיר את המזהה שלה"""
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO releases (state_key, name, path, commit_sha, status, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (state_key, name, path, commit_sha, status, time.time()))
+        return cursor.lastrowid
+
+    def set_release_status(self, release_id, status):
+        """מעדכן את הסטטוס של גרסה"""
+        conn = self._connection()
+        with conn:
+            conn.execute("UPDATE releases SET status = ? WHERE id = ?", (status, release_id))
+
+    def get_releases(self, state_key):
+        """מחזיר את הגרסאות של ההגדרה, מהחדשה לישנה"""
+        rows = self._connection().execute(
+            "SELECT * FROM releases WHERE state_key = ? ORDER BY id DESC", (state_key,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def delete_release(self, release_id):
+        """מוחק גרסה מהרישום"""
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM releases WHERE id = ?", (release_id,))
+
+_state_store = None
+_state_store_lock = threading.Lock()
+
+def get_state_store():
+    """מחזיר את מאגר המצב של התהליך (נוצר בשימוש הראשון)"""
+    global _state_store
+    with _state_store_lock:
+        if _state_store is None or _state_store.path != STATE_DB:
+            _state_store = StateStore(STATE_DB)
+        return _state_store
+
+def git_blob_sha(path):
+    """מחשב את מזהה ה-blob של git עבור תוכן הקובץ (sha1 של כותרת 'blob <size>' והתוכן)"""
+    digest = hashlib.sha1(b"blob %d\0" % os.path.getsize(path))
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def clone_file(src, dst, link_mode):
+    """יוצר את dst מתוך src: קישור קשיח, שכפול (reflink) או העתקה, לפי link_mode"""
+    if link_mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass  # מערכות קבצים שונות - נופלים להעתקה
+    if link_mode in ('hardlink', 'reflink') and os.name != 'nt':
+        import fcntl
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), getattr(fcntl, 'FICLONE', 0x40049409), fsrc.fileno())
+            return
+        except OSError:
+            pass  # מערכת הקבצים לא תומכת בשכפול
+    shutil.copyfile(src, dst)
+
+class BlobCache:
+    """מטמון תוכן קבצים לפי מזהה blob של git, עם פינוי LRU לפי גודל"""
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'bytes_saved': 0, 'bytes_fetched': 0, 'evicted': 0}
+
+    def path(self, sha):
+        """נתיב הקובץ של ה-blob במטמון"""
+        return os.path.join(self.root, sha[:2], sha[2:])
+
+    def missing(self, shas):
+        """מחזיר את מזהי ה-blob שאינם במטמון"""
+        shas = set(shas)
+        cached = get_state_store().get_cached_blobs(shas)
+        return sorted(sha for sha in shas if sha not in cached or not os.path.exists(self.path(sha)))
+
+    def add(self, sha, src, link_mode='copy', move=False):
+        """מוסיף קובץ למטמון תחת מזהה ה-blob שלו"""
+        target = self.path(sha)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if move:
+            os.replace(src, target)
+        else:
+            # כתיבה לקובץ זמני והחלפה אטומית, כדי שקורא מקביל לא יראה קובץ חלקי
+            tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+            clone_file(src, tmp_path, link_mode)
+            os.replace(tmp_path, target)
+        get_state_store().add_blob(sha, os.path.getsize(target))
+
+    def materialize(self, sha, dst, link_mode):
+        """יוצר את dst מתוך ה-blob שבמטמון; False אם ה-blob כבר לא קיים"""
+        src = self.path(sha)
+        if not os.path.exists(src):
+            return False
+        if os.path.lexists(dst):
+            os.remove(dst)
+        clone_file(src, dst, link_mode)
+        return True
+
+    def materialize_symlink(self, sha, dst):
+        """יוצר ב-dst קישור סימבולי שהיעד שלו הוא תוכן ה-blob; False אם ה-blob כבר לא קיים"""
+        try:
+            with open(self.path(sha), 'rb') as f:
+                link_target = os.fsdecode(f.read())
+        except FileNotFoundError:
+            return False
+        if os.path.lexists(dst):
+            os.remove(dst)
+        os.symlink(link_target, dst)
+        return True
+
+    def record(self, **counts):
+        """מעדכן את מוני המטמון"""
+        with self._lock:
+            for name, value in counts.items():
+                self.counters[name] += value
+
+    def evict(self):
+        """מוחק את ה-blobs הישנים עד שהמטמון קטן מהגודל המקסימלי"""
+        store = get_state_store()
+        count, size = store.get_blob_cache_size()
+        if size <= BLOB_CACHE_MAX_BYTES:
+            return 0
+        evicted = 0
+        while size > BLOB_CACHE_MAX_BYTES:
+            batch = store.get_lru_blobs(100)
+            if not batch:
+                break
+            for sha, blob_size in batch:
+                try:
+                    os.remove(self.path(sha))
+                except FileNotFoundError:
+                    pass
+                size -= blob_size or 0
+                evicted += 1
+            store.remove_blobs([sha for sha, _ in batch])
+        self.record(evicted=evicted)
+        log_message(f"פונו {evicted} blobs ממטמון הקבצים")
+        return evicted
+
+    def stats(self):
+        """מחזיר את מוני המטמון ואת גודלו הנוכחי"""
+        count, size = get_state_store().get_blob_cache_size()
+        with self._lock:
+            counters = dict(self.counters)
+        counters.update(blobs=count, size=size, max_size=BLOB_CACHE_MAX_BYTES)
+        return counters
+
+_blob_cache = None
+_blob_cache_lock = threading.Lock()
+
+def get_blob_cache():
+    """מחזיר את מטמון ה-blobs של התהליך (נוצר בשימוש הראשון)"""
+    global _blob_cache
+    with _blob_cache_lock:
+        if _blob_cache is None or _blob_cache.root != BLOB_CACHE_DIR:
+            _blob_cache = BlobCache(BLOB_CACHE_DIR)
+        return _blob_cache
+
+
+def get_latest_commit(ctx):
+    """מקבל את המזהה של הקומיט האחרון, בבקשה מותנית שמחזירה 304 כשהענף לא השתנה"""
+    if ctx.transport == 'git':
+        return get_remote_head(ctx)
+    api_url = f"{GITHUB_API_URL}/repos/{ctx.repo_owner}/{ctx.repo_name}/commits/{ctx.branch}"  # שימוש בענף הנבחר
+    # טוקנים שונים רואים תוכן שונה (מאגר פרטי מול 404), ולכן ה-ETag נשמר בנפרד לכל טוקן
+    cache_key = f"{ctx.repo_owner}/{ctx.repo_name}/{ctx.branch}@{token_id(ctx.github_token)}"
+    cached = get_state_store().get_etag(cache_key)
+    # סוג המדיה sha מחזיר רק את מזהה הקומיט כטקסט במקום את כל ה-JSON
+    headers = {'Accept': 'application/vnd.github.sha'}
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    response = github_get(api_url, ctx.github_token, headers=headers)
+    if response.status_code == 304 and cached:
+        # 304 לא נספר במכסת הבקשות של GitHub
+        return cached['sha']
+    if response.status_code == 200:
+        sha = response.text.strip()
+        get_state_store().set_etag(cache_key, sha, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return sha
+    return None
+
+def save_state(ctx, commit_sha, **fields):
+    """שומר את מזהה הקומיט האחרון של ההגדרה"""
+    try:
+        get_state_store().update_state(ctx, last_commit=commit_sha, **fields)
+        if commit_sha:
+            log_message(f"עודכן המצב של {ctx.name}: {commit_sha}")
+        return True
+    except Exception as e:
+        log_message(f"שגיאה בשמירת המצב: {str(e)}")
+        return False
+
+def load_state(ctx):
+    """טוען את מזהה הקומיט האחרון של ההגדרה"""
+    try:
+        state = get_state_store().get_state(ctx.state_key)
+        return state.get('last_commit') if state else None
+    except Exception as e:
+        log_message(f"שגיאה בטעינת המצב: {str(e)}")
+        return None
+
+def record_deploy(ctx, commit_sha, status, message, started_at=None, duration=None):
+    """רושם פריסה ביומן ההיסטוריה של ההגדרה"""
+    try:
+        get_state_store().add_history(ctx.state_key, commit_sha, status, message, started_at, duration)
+    except Exception as e:
+        log_message(f"שגיאה ברישום היסטוריית פריסה: {str(e)}")
+
+def get_deploy_history(ctx, limit=10):
+    """מחזיר את N הפריסות האחרונות של ההגדרה"""
+    return get_state_store().get_history(ctx.state_key, limit)
+
+def download_file(url, dest_path, token=None, ensure_space=None):
+    """מוריד קובץ בהזרמה לדיסק במקטעים ומחזיר את מספר הבתים שהורדו (None בכישלון).
+    ensure_space נקרא עם הגודל הצפוי לפני ההורדה (כשהוא ידוע) ובכל דיווח התקדמות"""
+    with github_get(url, token, stream=True) as response:
+        if response.status_code != 200:
+            log_message(f"שגיאה בהורדת {url}: {response.status_code}")
+            return None
+        total_size = int(response.headers.get('Content-Length') or 0)
+        if ensure_space:
+            ensure_space(total_size)
+        downloaded = 0
+        next_report = DOWNLOAD_PROGRESS_INTERVAL
+        with open(dest_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if not chunk:
+                    continue
+                f.write(chunk)
+                downloaded += len(chunk)
+                DOWNLOADED_BYTES.inc(len(chunk), source='zip')
+                if downloaded >= next_report:
+                    if ensure_space and not total_size:
+                        ensure_space(DOWNLOAD_PROGRESS_INTERVAL)
+                    progress = f"{downloaded}/{total_size}" if total_size else f"{downloaded}"
+                    log_message(f"הורדה בתהליך: {progress} בתים")
+                    next_report += DOWNLOAD_PROGRESS_INTERVAL
+    log_message(f"הורדה הושלמה: {downloaded} בתים נשמרו ב-{dest_path}")
+    return downloaded
+
+def get_archive_root(zip_ref):
+    """מחזיר את תיקיית השורש של ארכיון GitHub (בפורמט {repo}-{branch}/)"""
+    names = zip_ref.namelist()
+    if names and '/' in names[0]:
+        return names[0].split('/', 1)[0] + '/'
+    return ''
+
+def resolve_inside(dest_root, relative_path):
+    """מחזיר את הנתיב המלא בתוך dest_root, או None אם הנתיב יוצא מתיקיית היעד"""
+    target = os.path.realpath(os.path.join(dest_root, relative_path))
+    if target != dest_root and not target.startswith(dest_root + os.sep):
+        return None
+    return target
+
+def extract_zip(zip_path, dest_dir, paths=None):
+    """מחלץ קובץ ZIP איבר אחר איבר בהזרמה, כך שבזיכרון נמצא לכל היותר מקטע אחד.
+    תיקיית השורש של הארכיון מוסרת; אם הועברה רשימת paths, מחולצים רק הקבצים שבה"""
+    dest_root = os.path.realpath(dest_dir)
+    extracted_files = 0
+    extracted_bytes = 0
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        root = get_archive_root(zip_ref)
+        if paths is None:
+            infos = zip_ref.infolist()
+        else:
+            # חילוץ ממוקד: שליפת האיברים לפי שם בלי לעבור על כל הארכיון
+            infos = []
+            for path in sorted(set(paths)):
+                try:
+                    infos.append(zip_ref.getinfo(root + path))
+                except KeyError:
+                    pass  # קובץ שנמחק בקומיט האחרון לא קיים בארכיון
+        for info in infos:
+            relative_path = info.filename[len(root):] if info.filename.startswith(root) else info.filename
+            if not relative_path:
+                continue
+            target = resolve_inside(dest_root, relative_path)
+            if target is None:
+                log_message(f"דילוג על נתיב לא חוקי בארכיון: {info.filename}")
+                continue
+            if info.is_dir():
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if stat.S_ISLNK(info.external_attr >> 16):
+                # קישור סימבולי: תוכן האיבר הוא היעד של הקישור
+                if os.path.lexists(target):
+                    os.remove(target)
+                os.symlink(os.fsdecode(zip_ref.read(info)), target)
+                extracted_files += 1
+                continue
+            with zip_ref.open(info) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_SIZE)
+            # שמירת הרשאות הקובץ (למשל הרשאת הרצה) כפי שנשמרו בארכיון
+            mode = (info.external_attr >> 16) & 0o777
+            if mode:
+                os.chmod(target, mode)
+            extracted_files += 1
+            extracted_bytes += info.file_size
+    log_message(f"חולצו {extracted_files} קבצים ({extracted_bytes} בתים)")
+    return extracted_files
+
+# נעילות לפי שם (נתיב פריסה, מראת git): פעולות על משאבים שונים רצות במקביל, ועל אותו משאב - בזו אחר זו
+_named_locks = {}
+_named_locks_lock = threading.Lock()
+
+def get_named_lock(name):
+    """מחזיר נעילה משותפת לכל מי שמשתמש באותו שם"""
+    with _named_locks_lock:
+        lock = _named_locks.get(name)
+        if lock is None:
+            lock = threading.Lock()
+            _named_locks[name] = lock
+        return lock
+
+class DeployLock:
+    """נעילת נתיב פריסה: נעילה בתוך התהליך, ו-flock על קובץ ב-BASE_DIR/locks בין תהליכים
+    (השירות וה-cron של --single יכולים לפרוס לאותו נתיב באותו זמן)"""
+
+    def __init__(self, name):
+        self.name = name
+        self.thread_lock = get_named_lock(name)
+        self._file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if os.name == 'nt':
+            return self
+        import fcntl
+        try:
+            lock_dir = os.path.join(BASE_DIR, 'locks')
+            os.makedirs(lock_dir, exist_ok=True)
+            lock_path = os.path.join(lock_dir, hashlib.sha1(self.name.encode()).hexdigest()[:16] + '.lock')
+            # פתיחה לקריאה בלבד מספיקה ל-flock, כך שגם תהליך שאינו הבעלים של הקובץ יכול לנעול
+            self._file = os.fdopen(os.open(lock_path, os.O_RDONLY | os.O_CREAT, 0o664), 'rb')
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+            if self._file:
+                self._file.close()
+                self._file = None
+            self.thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if self._file:
+                self._file.close()  # סגירת הקובץ משחררת את ה-flock
+                self._file = None
+        finally:
+            self.thread_lock.release()
+        return False
+
+def get_deploy_lock(deploy_path):
+    """מחזיר את הנעילה של נתיב הפריסה (בתוך התהליך ובין תהליכים)"""
+    # הקישור הסימבולי עצמו לא נפתר, כי במצב גרסאות הוא מצביע לגרסה אחרת אחרי כל פריסה
+    deploy_path = os.path.normpath(deploy_path)
+    return DeployLock(f"deploy:{os.path.join(os.path.realpath(os.path.dirname(deploy_path)), os.path.basename(deploy_path))}")
+
+def deploy_latest_version(ctx, target_commit=None, base_commit=None, file_changes=None, shared_source=None,
+                          skip_if_current=False):
+    """מוריד ופורס את הגרסה האחרונה, ומעתיק רק קבצים ששונו בכל הקומיטים מהפעם האחרונה.
+    target_commit/base_commit/file_changes מאפשרים לפרוס לפי מידע ידוע מראש (למשל מ-Webhook) בלי קריאות API.
+    shared_source - קבצים שכבר הורדו עבור כל הקבוצה (deploy_group).
+    skip_if_current - דילוג אם target_commit כבר מותקן, בבדיקה אחרי קבלת הנעילה (תהליך אחר אולי כבר פרס אותו)"""
+    with log_context(deploy_id=uuid.uuid4().hex[:12], config=ctx.name):
+        set_log_phase('lock')
+        try:
+            with get_deploy_lock(ctx.deploy_path):
+                if skip_if_current and target_commit and load_state(ctx) == target_commit:
+                    log_message(f"הקומיט {target_commit} כבר מותקן עבור {ctx.name}, דילוג")
+                    return True
+                return _deploy_latest_version(ctx, target_commit, base_commit, file_changes, shared_source)
+        finally:
+            end_log_phase()
+
+def get_deploy_base(ctx):
+    """מחזיר את הקומיט שממנו מחושבים השינויים בפריסה הבאה, או None לפריסה מלאה"""
+    last_known_commit = load_state(ctx)
+    if ctx.deploy_mode == 'release':
+        live_release = get_live_release(ctx)
+        last_known_commit = live_release['commit_sha'] if live_release else None
+    return last_known_commit if ctx.update_only_changed_files and last_known_commit else None
+
+def deploy_group(contexts, target_commit=None, base_commit=None, file_changes=None):
+    """פורס כמה הגדרות של אותו מאגר, ענף וטוקן: בדיקת קומיט, חישוב שינויים והורדה פעם אחת,
+    ואז הצבה בכל נתיבי הפריסה במקביל. מחזיר True אם כל הפריסות הצליחו"""
+    lead = contexts[0]
+    shared_source = None
+    with log_context(deploy_id=uuid.uuid4().hex[:12], config=f"{lead.repo_owner}/{lead.repo_name}@{lead.branch}"):
+        log_message(f"פריסה קבוצתית של {len(contexts)} הגדרות: {', '.join(ctx.name for ctx in contexts)}")
+        with Workspace(lead.repo_name) as workspace:
+            if lead.transport != 'git':
+                # במצב git המראה המקומית כבר משותפת לכל ההגדרות של המאגר
+                try:
+                    shared_source = prefetch_group_source(contexts, workspace, target_commit, base_commit, file_changes)
+                except Exception as e:
+                    log_message(f"שגיאה בהורדה המשותפת, כל הגדרה תוריד בנפרד: {str(e)}")
+                finally:
+                    end_log_phase()
+            if shared_source:
+                target_commit = shared_source.commit_sha
+            with ThreadPoolExecutor(max_workers=min(GROUP_DEPLOY_WORKERS, len(contexts))) as executor:
+                futures = [executor.submit(deploy_latest_version, ctx, target_commit,
+                                           None if shared_source else base_commit,
+                                           None if shared_source else file_changes,
+                                           shared_source, True)
+                           for ctx in contexts]
+                return all([future.result() for future in futures])
+
+def prefetch_group_source(contexts, workspace, target_commit, base_commit, file_changes):
+    """מוריד לתיקיית העבודה את איחוד הקבצים שכל ההגדרות בקבוצה צריכות. מחזיר SharedSource או None"""
+    lead = contexts[0]
+    current_commit = target_commit or get_latest_commit(lead)
+    if not current_commit:
+        return None
+    bases = {get_deploy_base(ctx) for ctx in contexts}
+    set_log_phase('api')
+    # חישוב שינויים אחד לכל קומיט בסיס שונה (בדרך כלל כל ההגדרות באותו בסיס)
+    changes_by_base = {}
+    for base in bases - {None}:
+        if file_changes is not None and base == base_commit:
+            changes_by_base[base] = file_changes
+        elif base != current_commit:
+            changes_by_base[base] = get_changes_between(lead, base, current_commit)
+        else:
+            changes_by_base[base] = merge_file_changes(FileChanges(), get_commit_file_changes(lead, current_commit))
+    # שינויים None (היסטוריה ששוכתבה) - פריסה מלאה לחברים עם אותו בסיס
+    full = None in bases or None in changes_by_base.values()
+    if full:
+        fetched, current_commit, _ = fetch_zip_source(lead, workspace, current_commit, None, None, None)
+    else:
+        paths = FileChanges()
+        for changes in changes_by_base.values():
+            for path, status in changes.items():
+                # נתיב ששונה בכמה בסיסים נשאר 'modified' רק אם כך בכולם (רק אז ההרשאות ידועות מהקובץ שנפרס)
+                if status != 'removed' and paths.get(path, 'modified') == 'modified':
+                    paths[path] = status
+            paths.blobs.update(getattr(changes, 'blobs', {}))
+        base = next(iter(changes_by_base))
+        fetched, current_commit, _ = fetch_zip_source(lead, workspace, current_commit, base, base, paths)
+    if not fetched:
+        log_message("ההורדה המשותפת נכשלה, כל הגדרה תוריד בנפרד")
+        return None
+    return SharedSource(workspace.extracted_dir, current_commit, changes_by_base, full)
+
+def get_tree_blobs(ctx, commit_sha):
+    """מחזיר את רשימת הקבצים בקומיט כמילון נתיב -> blob (sha, size, mode), או None אם לא התקבלה רשימה מלאה"""
+    api_url = f"{GITHUB_API_URL}/repos/{ctx.repo_owner}/{ctx.repo_name}/git/trees/{commit_sha}"
+    response = github_get(api_url, ctx.github_token, params={'recursive': 1})
+    if response.status_code != 200:
+        log_message(f"שגיאה בקבלת עץ הקבצים: {response.status_code}")
+        return None
+    data = response.json()
+    if data.get('truncated'):
+        log_message("עץ הקבצים קטוע, מוריד את ארכיון ה-ZIP")
+        return None
+    return {entry['path']: entry for entry in data.get('tree', []) if entry.get('type') == 'blob'}
+
+def get_changed_blobs(ctx, file_changes, paths):
+    """בונה רשומות blob לקבצים ששונו מתוך מזהי ה-blob שהחזיר compare, בלי בקשת עץ הקבצים (None אם חסר מזהה).
+    compare לא מחזיר הרשאות, ולכן הן נלקחות מהקובץ שכבר נפרס באותו נתיב; לקובץ חדש, או שהסטטוס שלו
+    אינו modified (למשל שינוי הרשאות), ההרשאות לא ידועות (mode None)"""
+    blobs = getattr(file_changes, 'blobs', {})
+    tree = {}
+    for path in paths:
+        sha = blobs.get(path)
+        if not sha:
+            return None
+        mode = None
+        try:
+            st = os.lstat(os.path.join(ctx.deploy_path, path)) if file_changes.get(path) == 'modified' else None
+        except OSError:
+            st = None
+        if st and stat.S_ISLNK(st.st_mode):
+            mode = GIT_SYMLINK_MODE
+        elif st and stat.S_ISREG(st.st_mode):
+            mode = '100755' if st.st_mode & 0o111 else '100644'
+        tree[path] = {'path': path, 'mode': mode, 'type': 'blob', 'sha': sha}
+    return tree
+
+def blob_fetch_limit(ctx):
+    """מספר ה-blobs שמותר להוריד בבקשות API נפרדות: BLOB_FETCH_MAX, ולא יותר ממה שנשאר במכסה מעל הרזרבה"""
+    allowance = get_rate_budget().poll_allowance(ctx.github_token)
+    return BLOB_FETCH_MAX if allowance is None else min(BLOB_FETCH_MAX, allowance)
+
+def fetch_blob(ctx, sha):
+    """מוריד blob בודד למטמון ומוודא שהתוכן תואם למזהה. מחזיר את מספר הבתים או None"""
+    cache = get_blob_cache()
+    api_url = f"{GITHUB_API_URL}/repos/{ctx.repo_owner}/{ctx.repo_name}/git/blobs/{sha}"
+    os.makedirs(cache.root, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache.root, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f, github_get(api_url, ctx.github_token, stream=True,
+                                                  headers={'Accept': 'application/vnd.github.raw'}) as response:
+            if response.status_code != 200:
+                log_message(f"שגיאה בהורדת blob {sha}: {response.status_code}")
+                return None
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                DOWNLOADED_BYTES.inc(len(chunk), source='blob')
+        if git_blob_sha(tmp_path) != sha:
+            log_message(f"תוכן ה-blob {sha} לא תואם למזהה")
+            return None
+        size = os.path.getsize(tmp_path)
+        cache.add(sha, tmp_path, move=True)
+        return size
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def materialize_from_cache(ctx, tree, workspace, paths=None):
+    """בונה את הקבצים המבוקשים מתוך מטמון ה-blobs, ומוריד רק את ה-blobs החסרים.
+    מחזיר False אם חסרים יותר מדי blobs או שההורדה נכשלה, ואז יש להוריד את ארכיון ה-ZIP"""
+    cache = get_blob_cache()
+    wanted = [(path, tree[path]) for path in (sorted(tree) if paths is None else paths) if path in tree]
+    shas = {entry['sha'] for _, entry in wanted}
+    missing = cache.missing(shas)
+    # כל blob הוא בקשת API; ארכיון ה-ZIP לא נספר במכסה
+    fetch_limit = blob_fetch_limit(ctx)
+    if len(missing) > fetch_limit:
+        log_message(f"חסרים {len(missing)} מתוך {len(shas)} blobs במטמון (מגבלה {fetch_limit}), מוריד את ארכיון ה-ZIP")
+        cache.record(misses=len(missing), hits=len(shas) - len(missing))
+        return False
+    if missing:
+        get_rate_budget().spend(ctx.github_token, len(missing))
+        with ThreadPoolExecutor(max_workers=HTTP_HOST_CONCURRENCY) as executor:
+            sizes = list(executor.map(lambda sha: fetch_blob(ctx, sha), missing))
+        if None in sizes:
+            return False
+        cache.record(bytes_fetched=sum(sizes))
+    workspace.ensure_space(sum(entry.get('size', 0) for _, entry in wanted))
+    dest_root = os.path.realpath(workspace.extracted_dir)
+    for path, entry in wanted:
+        target = resolve_inside(dest_root, path)
+        if target is None:
+            log_message(f"דילוג על נתיב לא חוקי בעץ הקבצים: {path}")
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if entry.get('mode') == GIT_SYMLINK_MODE:
+            # קישור סימבולי: תוכן ה-blob הוא היעד של הקישור
+            if not cache.materialize_symlink(entry['sha'], target):
+                return False
+            continue
+        if not cache.materialize(entry['sha'], target, BLOB_CACHE_LINK):
+            return False
+        os.chmod(target, 0o755 if entry.get('mode') == '100755' else 0o644)
+    saved = sum(tree_entry.get('size', 0) for tree_entry in {e['sha']: e for _, e in wanted}.values()
+                if tree_entry['sha'] not in missing)
+    cache.record(hits=len(shas) - len(missing), misses=len(missing), bytes_saved=saved)
+    get_state_store().touch_blobs(shas)
+    log_message(f"נבנו {len(wanted)} קבצים ממטמון ה-blobs ({len(missing)} blobs הורדו, {saved} בתים נחסכו)")
+    cache.evict()
+    return True
+
+def add_extracted_to_cache(tree, dest_dir, paths=None):
+    """מוסיף למטמון את הקבצים שחולצו מה-ZIP, כשהתוכן תואם למזהה ה-blob בעץ"""
+    cache = get_blob_cache()
+    wanted = {}
+    for path in (tree if paths is None else paths):
+        if path in tree:
+            wanted.setdefault(tree[path]['sha'], path)
+    missing = cache.missing(wanted)
+    added = 0
+    for sha in missing:
+        src = os.path.join(dest_dir, wanted[sha])
+        if os.path.isfile(src) and not os.path.islink(src) and git_blob_sha(src) == sha:
+            cache.add(sha, src, BLOB_CACHE_LINK)
+            added += 1
+    if added:
+        log_message(f"נוספו {added} blobs למטמון הקבצים")
+        cache.evict()
+
+class Workspace:
+    """תיקיית עבודה ייחודית לפריסה אחת, שנמחקת תמיד ביציאה מבלוק ה-with"""
+
+    def __init__(self, name, root=None):
+        self.name = name
+        self.root = root or WORKSPACE_ROOT
+        self.path = None
+        self.extracted_dir = None
+
+    def __enter__(self):
+        os.makedirs(self.root, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=f"{WORKSPACE_PREFIX}{self.name}-", dir=self.root)
+        self.extracted_dir = os.path.join(self.path, 'src')
+        os.mkdir(self.extracted_dir)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        remove_workspace(self.path)
+        return False
+
+    def file(self, name):
+        """נתיב לקובץ בתוך תיקיית העבודה"""
+        return os.path.join(self.path, name)
+
+    def ensure_space(self, needed_bytes):
+        """מוודא שיש מספיק מקום פנוי ל-needed_bytes נוספים; אחרת זורק OSError(ENOSPC)"""
+        free = shutil.disk_usage(self.path).free
+        if free - needed_bytes < WORKSPACE_MIN_FREE:
+            raise OSError(errno.ENOSPC, f"אין מספיק מקום ב-{self.root}: נדרשים {needed_bytes} בתים, פנויים {free}")
+
+def remove_workspace(path):
+    """מוחק תיקיית עבודה"""
+    if not path or not os.path.exists(path):
+        return
+    # אחרי ההעברה נשארות רק תיקיות ריקות שנוצרו על ידינו, אין צורך ב-sudo
+    try:
+        shutil.rmtree(path)
+    except OSError:
+        run_command(f"sudo -n rm -rf {path}")
+
+def cleanup_stale_workspaces():
+    """מוחק תיקיות עבודה שנשארו מתהליכים שהופסקו באמצע פריסה"""
+    if not os.path.isdir(WORKSPACE_ROOT):
+        return
+    cutoff = time.time() - WORKSPACE_STALE_AGE
+    for name in os.listdir(WORKSPACE_ROOT):
+        path = os.path.join(WORKSPACE_ROOT, name)
+        try:
+            if name.startswith(WORKSPACE_PREFIX) and os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+                remove_workspace(path)
+                log_message(f"נמחקה תיקיית עבודה ישנה: {path}")
+        except OSError:
+            continue
+
+def get_zip_extracted_size(zip_path, paths=None):
+    """מחזיר את הגודל הכולל (לפני דחיסה) של הקבצים שיחולצו מהארכיון"""
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        if paths is None:
+            return sum(info.file_size for info in zip_ref.infolist())
+        root = get_archive_root(zip_ref)
+        total = 0
+        for path in set(paths):
+            try:
+                total += zip_ref.getinfo(root + path).file_size
+            except KeyError:
+                pass
+        return total
+
+def fetch_zip_source(ctx, workspace, target_commit, last_known_commit, base_commit, file_changes):
+    """מביא את הקבצים ממטמון ה-blobs או מארכיון ה-ZIP. מחזיר (הצלחה, קומיט, שינויים); שינויים None = פריסה מלאה"""
+    set_log_phase('api')
+    current_commit = target_commit or get_latest_commit(ctx)  # שמירת הקומיט הנוכחי
+    if last_known_commit:
+        # אם יש שינוי, ניקח את כל השינויים בטווח; אם אין שינוי, רק את הקומיט האחרון
+        if file_changes is not None and base_commit == last_known_commit:
+            log_message(f"שימוש ברשימת {len(file_changes)} קבצים ששונו שהתקבלה מראש")
+        elif current_commit != last_known_commit:
+            file_changes = get_changes_between(ctx, last_known_commit, current_commit)
+        else:
+            file_changes = merge_file_changes(FileChanges(), get_commit_file_changes(ctx, current_commit))
+    if file_changes is not None:
+        # חילוץ של הקבצים ששונו בלבד במקום כל הארכיון
+        paths = [path for path, status in file_changes.items() if status != 'removed']
+    else:
+        file_changes = None
+        paths = None
+    if paths == []:
+        log_message("אין קבצים להורדה (רק מחיקות)")
+        return True, current_commit, file_changes
+    tree = None
+    if BLOB_CACHE_ENABLED and current_commit:
+        # בפריסה חלקית מזהי ה-blob מגיעים מ-compare; עץ הקבצים נדרש רק בפריסה מלאה, או כשחסרות
+        # הרשאות של קבצים שאפשר לבנות מהמטמון (אם יורד ארכיון ZIP, מזהי ה-blob מספיקים להוספה למטמון)
+        use_cache = True
+        tree = get_changed_blobs(ctx, file_changes, paths) if paths is not None else None
+        if tree is None:
+            tree = get_tree_blobs(ctx, current_commit)
+        elif any(entry['mode'] is None for entry in tree.values()):
+            shas = {entry['sha'] for entry in tree.values()}
+            missing = get_blob_cache().missing(shas)
+            if len(missing) <= blob_fetch_limit(ctx):
+                tree = get_tree_blobs(ctx, current_commit)
+            else:
+                log_message(f"חסרים {len(missing)} מתוך {len(shas)} blobs במטמון, מוריד את ארכיון ה-ZIP בלי בקשת עץ הקבצים")
+                get_blob_cache().record(misses=len(missing), hits=len(shas) - len(missing))
+                use_cache = False
+        else:
+            log_message(f"נעשה שימוש במזהי ה-blob של {len(tree)} קבצים מההשוואה, בלי בקשת עץ הקבצים")
+        set_log_phase('download')
+        if use_cache and tree is not None and materialize_from_cache(ctx, tree, workspace, paths):
+            return True, current_commit, file_changes
+    # הורדת הארכיון של הקומיט עצמו, כדי שהענף לא יתקדם בין הבדיקה להורדה
+    if current_commit:
+        zip_url = f"{GITHUB_URL}/{ctx.repo_owner}/{ctx.repo_name}/archive/{current_commit}.zip"
+    else:
+        zip_url = f"{GITHUB_URL}/{ctx.repo_owner}/{ctx.repo_name}/archive/refs/heads/{ctx.branch}.zip"
+    # הורדה בהזרמה לתיקיית העבודה של הפריסה
+    zip_path = workspace.file('source.zip')
+    set_log_phase('download')
+    try:
+        if download_file(zip_url, zip_path, ctx.github_token, workspace.ensure_space) is None:
+            return False, current_commit, None
+        log_message("הורדת הקבצים הצליחה")
+        set_log_phase('extract')
+        workspace.ensure_space(get_zip_extracted_size(zip_path, paths))
+        extract_zip(zip_path, workspace.extracted_dir, paths)
+        log_message("קבצים חולצו בהצלחה" if paths is None else "קבצים ששונו חולצו בהצלחה")
+    finally:
+        # הארכיון נמחק מיד, לפני שהקבצים מועברים ליעד
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+    if tree is not None:
+        add_extracted_to_cache(tree, workspace.extracted_dir, paths)
+    return True, current_commit, file_changes
+
+def get_repo_url(ctx):
+    """מחזיר את כתובת ה-git של המאגר"""
+    return ctx.repo_url or f"{GITHUB_URL}/{ctx.repo_owner}/{ctx.repo_name}.git"
+
+def get_mirror_path(ctx):
+    """מחזיר את נתיב המראה המקומית של המאגר"""
+    return os.path.join(MIRRORS_DIR, ctx.repo_owner, f"{ctx.repo_name}.git")
+
+def run_git(ctx, args, **kwargs):
+    """מריץ פקודת git (בלי shell), עם הטוקן ככותרת HTTP ולא כחלק מהכתובת"""
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    if ctx.github_token and get_repo_url(ctx).startswith('https://'):
+        auth = base64.b64encode(f"x-access-token:{ctx.github_token}".encode()).decode()
+        env.update(GIT_CONFIG_COUNT='1',
+                   GIT_CONFIG_KEY_0='http.extraHeader',
+                   GIT_CONFIG_VALUE_0=f"Authorization: Basic {auth}")
+    kwargs.setdefault('stdout', subprocess.PIPE)
+    kwargs.setdefault('stderr', subprocess.PIPE)
+    return subprocess.run(['git'] + args, env=env, **kwargs)
+
+def get_remote_head(ctx):
+    """מקבל את הקומיט האחרון בענף באמצעות git ls-remote"""
+    result = run_git(ctx, ['ls-remote', get_repo_url(ctx), f"refs/heads/{ctx.branch}"], text=True)
+    if result.returncode != 0:
+        log_message(f"שגיאה ב-git ls-remote: {result.stderr.strip()}")
+        return None
+    for line in result.stdout.splitlines():
+        sha, _, ref = line.partition('\t')
+        if ref == f"refs/heads/{ctx.branch}":
+            return sha
+    log_message(f"הענף {ctx.branch} לא נמצא במאגר")
+    return None
+
+def update_mirror(ctx, mirror):
+    """יוצר את המראה המקומית אם צריך ומביא אליה רק את האובייקטים החדשים של הענף"""
+    if not os.path.exists(os.path.join(mirror, 'HEAD')):
+        os.makedirs(mirror, exist_ok=True)
+        result = run_git(ctx, ['init', '--bare', '--quiet', mirror], text=True)
+        if result.returncode != 0:
+            log_message(f"שגיאה ביצירת המראה {mirror}: {result.stderr.strip()}")
+            return False
+        log_message(f"נוצרה מראה מקומית: {mirror}")
+    refspec = f"+refs/heads/{ctx.branch}:refs/heads/{ctx.branch}"
+    result = run_git(ctx, ['-C', mirror, 'fetch', '--quiet', '--prune', '--no-tags', get_repo_url(ctx), refspec], text=True)
+    if result.returncode != 0:
+        log_message(f"שגיאה ב-git fetch: {result.stderr.strip()}")
+        return False
+    return True
 
-# התעלמות מאזהרות SSL
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+def mirror_has_commit(ctx, mirror, commit):
+    """בודק אם הקומיט כבר קיים במראה המקומית"""
+    if not os.path.exists(os.path.join(mirror, 'HEAD')):
+        return False
+    return run_git(ctx, ['-C', mirror, 'cat-file', '-e', f"{commit}^{{commit}}"]).returncode == 0
 
-# הגדרות מערכת
-BASE_DIR = "/var/www/html/CornGetFromGit"
-CONFIG_WATCH_DIR = f"{BASE_DIR}/pending"  # תיקייה לקבצי הגדרות חדשים
-CONFIG_PROCESSED_DIR = f"{BASE_DIR}/processed"  # תיקייה לקבצים שעובדו
-LOG_FILE = f"{BASE_DIR}/log.log"
-STATE_FILE = f"{BASE_DIR}/last_commit.json"
-
-# מרווחי זמן לבדיקות
-AUTO_CHECK_INTERVAL = 1200   # בדיקת GitHub כל 20 דקות
-
-# הגדרות ברירת מחדל
-REPO_OWNER = None
-REPO_NAME = None
-DEPLOY_PATH = None
-GITHUB_TOKEN = ""
-UPDATE_ONLY_CHANGED_FILES = True
-BRANCH = 'main'  # ברירת מחדל
-RUN_SETUP_SCRIPT = False  # ברירת מחדל להרצת setup.sh
-
-class ConfigFileHandler(FileSystemEventHandler):
-    """מטפל באירועים של קבצים חדשים בתיקיית pending"""
-    
-    def __init__(self):
-        self.processing = set()  # מעקב אחר קבצים בעיבוד
-    
-    def on_created(self, event):
-        if not event.is_directory and event.src_path.endswith('.json'):
-            if event.src_path not in self.processing:
-                self.processing.add(event.src_path)
-                log_message(f"זוהה קובץ הגדרות חדש: {event.src_path}")
-                process_config_file(event.src_path)
-                self.processing.remove(event.src_path)
-    
-    def on_modified(self, event):
-        if not event.is_directory and event.src_path.endswith('.json'):
-            if event.src_path not in self.processing and os.path.exists(event.src_path):
-                self.processing.add(event.src_path)
-                log_message(f"זוהה עדכון בקובץ הגדרות: {event.src_path}")
-                process_config_file(event.src_path)
-                self.processing.remove(event.src_path)
+def get_local_changes(ctx, mirror, base, head):
+    """מחשב את הקבצים ששונו בין שני קומיטים מתוך המראה; None אם קומיט הבסיס לא קיים בה"""
+    if run_git(ctx, ['-C', mirror, 'cat-file', '-e', f"{base}^{{commit}}"]).returncode != 0:
+        log_message(f"הקומיט {base} לא נמצא במראה, מבצע התקנה מלאה")
+        return None
+    result = run_git(ctx, ['-C', mirror, 'diff', '--name-status', '-z', '-M', base, head, '--'])
+    if result.returncode != 0:
+        log_message(f"שגיאה ב-git diff: {result.stderr.decode(errors='replace').strip()}")
+        return None
+    files = []
+    fields = result.stdout.decode('utf-8', errors='surrogateescape').split('\0')
+    i = 0
+    while i < len(fields) - 1:
+        code = fields[i][:1]
+        if code in ('R', 'C'):
+            previous, filename = fields[i + 1], fields[i + 2]
+            i += 3
+        else:
+            previous, filename = None, fields[i + 1]
+            i += 2
+        if code == 'R':
+            files.append({'filename': filename, 'status': 'renamed', 'previous_filename': previous})
+        elif code == 'D':
+            files.append({'filename': filename, 'status': 'removed'})
+        else:
+            files.append({'filename': filename, 'status': 'added' if code in ('A', 'C') else 'modified'})
+    return merge_file_changes({}, files)
 
-def log_message(message, command_output=None):
-    """כותב הודעה לקובץ לוג ולמסך"""
-    timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
-    log_entry = f"[{timestamp}] {message}"
-    
-    # הדפסה למסך
-    print(log_entry)
-    
-    try:
-        # כתיבה לקובץ עם קידוד utf-8
-        with open(LOG_FILE, 'a', encoding='utf-8') as f:
-            f.write(log_entry + "\n")
-            if command_output:
-                f.write(f"Command output:\n{command_output}\n")
-                f.write("-" * 50 + "\n")
-    except Exception as e:
-        print(f"[{timestamp}] שגיאה בכתיבה לקובץ לוג: {str(e)}")
+def extract_git_archive(ctx, mirror, commit, dest_dir, paths=None):
+    """מחלץ את עץ הקומיט (או רק את הנתיבים שצוינו) מהמראה בעזרת git archive"""
+    if paths is None:
+        batches = [[]]
+    else:
+        paths = list(paths)
+        batches = [paths[i:i + GIT_ARCHIVE_BATCH] for i in range(0, len(paths), GIT_ARCHIVE_BATCH)]
+    for batch in batches:
+        args = ['-C', mirror, 'archive', '--format=tar', commit]
+        if batch:
+            args += ['--'] + [f":(literal){path}" for path in batch]
+        process = subprocess.Popen(['git'] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            # חילוץ תוך כדי קריאה מהצינור, בלי לשמור את הארכיון בדיסק
+            with tarfile.open(fileobj=process.stdout, mode='r|') as tar:
+                if hasattr(tarfile, 'data_filter'):
+                    tar.extractall(dest_dir, filter='data')
+                else:
+                    tar.extractall(dest_dir)
+        finally:
+            process.stdout.close()
+            stderr = process.stderr.read()
+        if process.wait() != 0:
+            raise RuntimeError(f"git archive נכשל: {stderr.decode(errors='replace').strip()}")
 
-def run_command(command):
-    """מריץ פקודה ומחזיר את התוצאה והקוד"""
+def fetch_git_source(ctx, workspace, target_commit, last_known_commit, base_commit, file_changes):
+    """מעדכן את המראה המקומית ומחלץ ממנה את הקבצים. מחזיר (הצלחה, קומיט, שינויים) כמו fetch_zip_source"""
+    mirror = get_mirror_path(ctx)
+    set_log_phase('download')
+    with get_named_lock(f"mirror:{mirror}"):
+        # בפריסה קבוצתית הראשון מעדכן את המראה והשאר מוצאים בה כבר את הקומיט
+        if target_commit and mirror_has_commit(ctx, mirror, target_commit):
+            log_message(f"הקומיט {target_commit} כבר נמצא במראה, ללא git fetch")
+        elif not update_mirror(ctx, mirror):
+            return False, target_commit, None
+        current_commit = target_commit
+        if not current_commit:
+            result = run_git(ctx, ['-C', mirror, 'rev-parse', f"refs/heads/{ctx.branch}"], text=True)
+            if result.returncode != 0:
+                log_message(f"הענף {ctx.branch} לא נמצא במראה")
+                return False, None, None
+            current_commit = result.stdout.strip()
+        elif not mirror_has_commit(ctx, mirror, current_commit):
+            log_message(f"הקומיט {current_commit} לא נמצא במראה")
+            return False, current_commit, None
+        log_message("המראה המקומית עודכנה")
+        if last_known_commit:
+            if file_changes is not None and base_commit == last_known_commit:
+                log_message(f"שימוש ברשימת {len(file_changes)} קבצים ששונו שהתקבלה מראש")
+            else:
+                base = last_known_commit if current_commit != last_known_commit else f"{current_commit}~1"
+                file_changes = get_local_changes(ctx, mirror, base, current_commit)
+        else:
+            file_changes = None
+        set_log_phase('extract')
+        workspace.ensure_space(0)
+        if file_changes is None:
+            extract_git_archive(ctx, mirror, current_commit, workspace.extracted_dir)
+            log_message("קבצים חולצו בהצלחה")
+        else:
+            updated_files = [path for path, status in file_changes.items() if status != 'removed']
+            if updated_files:
+                extract_git_archive(ctx, mirror, current_commit, workspace.extracted_dir, updated_files)
+            log_message("קבצים ששונו חולצו בהצלחה")
+        return True, current_commit, file_changes
+
+class SharedSource:
+    """קבצים שהורדו פעם אחת עבור כל ההגדרות בקבוצה; כל הגדרה מקבלת עותק משלה בתיקיית העבודה שלה"""
+
+    def __init__(self, extracted_dir, commit_sha, changes_by_base, full):
+        self.extracted_dir = extracted_dir
+        self.commit_sha = commit_sha
+        self.changes_by_base = changes_by_base  # קומיט בסיס -> שינויים עד commit_sha (None - פריסה מלאה)
+        self.full = full  # האם כל העץ הורד (לפחות הגדרה אחת צריכה פריסה מלאה)
+
+    def fetch(self, ctx, workspace, target_commit, last_known_commit, base_commit, file_changes):
+        """מחליף את fetch_zip_source בפריסה של חבר בקבוצה; אם המצב השתנה מאז ההורדה - הורדה רגילה"""
+        changes = self.changes_by_base.get(last_known_commit) if last_known_commit else None
+        known_base = not last_known_commit or last_known_commit in self.changes_by_base
+        if target_commit != self.commit_sha or not known_base or (changes is None and not self.full):
+            log_message(f"הקבצים המשותפים לא מתאימים ל-{ctx.name}, מוריד בנפרד")
+            return fetch_zip_source(ctx, workspace, target_commit, last_known_commit, base_commit, file_changes)
+        set_log_phase('extract')
+        workspace.ensure_space(0)
+        paths = None if changes is None else [path for path, status in changes.items() if status != 'removed']
+        copied = copy_shared_files(self.extracted_dir, workspace.extracted_dir, paths)
+        log_message(f"הועתקו {copied} קבצים מההורדה המשותפת")
+        return True, self.commit_sha, changes
+
+def copy_shared_files(source_dir, dest_dir, paths=None):
+    """מעתיק קבצים (reflink כשאפשר) מתיקייה משותפת; paths=None - את כל העץ. מחזיר את מספר הקבצים"""
+    if paths is None:
+        paths = list_tree_files(source_dir)
+    copied = 0
+    for path in paths:
+        src = os.path.join(source_dir, path)
+        if not os.path.lexists(src):
+            continue
+        dst = os.path.join(dest_dir, path)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), dst)
+        else:
+            clone_file(src, dst, 'reflink')
+            shutil.copymode(src, dst)
+        copied += 1
+    return copied
+
+def file_hash(path):
+    """מחשב את מזהה ה-blob של git עבור קובץ או קישור סימבולי (None אם לא ניתן לקרוא)"""
     try:
-        # הרצת הפקודה דרך /bin/bash כדי לשמור על הגדרות ה-sudo
-        process = subprocess.run(['/bin/bash', '-c', command], 
-                               capture_output=True, 
-                               text=True)
-        output = process.stdout + process.stderr
-        return_code = process.returncode
-        
-        log_message(f"הרצת פקודה: {command}", 
-                   f"Return code: {return_code}\nOutput:\n{output}")
-        return return_code, output
-    except Exception as e:
-        error_msg = f"שגיאה בהרצת פקודה {command}: {str(e)}"
-        log_message(error_msg)
-        return -1, error_msg
+        if os.path.islink(path):
+            target = os.fsencode(os.readlink(path))
+            return hashlib.sha1(b"blob %d\0" % len(target) + target).hexdigest()
+        return git_blob_sha(path)
+    except OSError:
+        return None
 
-def get_latest_commit():
-    """מקבל את המזהה של הקומיט האחרון"""
-    api_url = f"https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/commits/{BRANCH}"  # שימוש בענף הנבחר
-    headers = {'Authorization': f'token {GITHUB_TOKEN}'} if GITHUB_TOKEN else {}
-    response = requests.get(api_url, headers=headers, verify=False)
-    if response.status_code == 200:
-        return response.json()['sha']
+def hash_files(root, paths):
+    """מחשב במקביל את ה-hash של רשימת קבצים יחסית לתיקייה"""
+    paths = list(paths)
+    with ThreadPoolExecutor(max_workers=SYNC_HASH_WORKERS) as executor:
+        hashes = executor.map(lambda path: file_hash(os.path.join(root, path)), paths)
+        return dict(zip(paths, hashes))
+
+def list_tree_files(root):
+    """מחזיר את כל הקבצים והקישורים הסימבוליים בתיקייה, כנתיבים יחסיים"""
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        relative_dir = os.path.relpath(dirpath, root)
+        for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+            files.append(os.path.normpath(os.path.join(relative_dir, name)))
+    return files
+
+def run_file_ops(ops):
+    """מבצע רשימת פעולות קבצים בתוך התהליך. פעולות שנכשלו בגלל הרשאות נשלחות יחד
+    להרצה אחת של file_ops.py דרך sudo, במקום תהליך sudo לכל קובץ"""
+    if not ops:
+        return
+    owner = file_ops.resolve_owner(DEPLOY_OWNER)
+    if owner is None:
+        log_message(f"המשתמש {DEPLOY_OWNER} לא קיים, הבעלות על הקבצים לא תשונה")
+    done, failed = file_ops.run_ops(ops, owner)
+    denied = [op for op, error in failed if isinstance(error, PermissionError)]
+    errors = [f"{op}: {error}" for op, error in failed if not isinstance(error, PermissionError)]
+    if denied and os.name == 'nt':
+        errors.extend(f"{op}: {error}" for op, error in failed if isinstance(error, PermissionError))
+        denied = []
+    if denied:
+        log_message(f"מריץ {len(denied)} פעולות שדורשות הרשאות דרך sudo")
+        process = subprocess.run(['sudo', '-n', FILE_OPS_PYTHON, FILE_OPS_HELPER],
+                                 input=json.dumps({'owner': DEPLOY_OWNER if owner else None, 'ops': denied}),
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if process.returncode != 0:
+            errors.append(f"sudo file_ops.py: {process.stdout.strip()}")
+        else:
+            done += len(denied)
+            failed = [(op, error) for op, error in failed if not isinstance(error, PermissionError)]
+    failed_ops = [op for op, error in failed]
+    FILES_WRITTEN.inc(sum(1 for op in ops if op['op'] == 'move' and op not in failed_ops))
+    FILES_REMOVED.inc(sum(1 for op in ops if op['op'] == 'remove' and op not in failed_ops))
+    log_message(f"בוצעו {done} פעולות קבצים")
+    if errors:
+        raise RuntimeError("פעולות קבצים נכשלו: " + "; ".join(errors[:10]))
+
+def apply_file_changes(extracted_dir, target_dir, updated_files, removed_files):
+    """מעביר לתיקיית היעד את הקבצים שעודכנו ומוחק את הקבצים שהוסרו"""
+    target_root = os.path.realpath(target_dir)
+    ops = []
+    # מחיקה לפני העברה, כדי שקובץ שהוחלף בתיקייה באותו שם לא יחסום את ההעברה
+    for file in removed_files:
+        ops.append({'op': 'remove', 'path': os.path.join(target_root, file), 'prune_root': target_root})
+    # העברה למיקום הסופי רק של הקבצים ששונו (הגרסה האחרונה מהמקור)
+    for file in updated_files:
+        src = os.path.join(extracted_dir, file)
+        if os.path.lexists(src):
+            ops.append({'op': 'move', 'src': src, 'dst': os.path.join(target_root, file)})
+    run_file_ops(ops)
+
+def record_manifest(target_dir, manifest_key, updated_files, removed_files, hashes=None):
+    """מעדכן ברשימת הקבצים את הגודל, זמן השינוי וה-hash של הקבצים שנפרסו"""
+    if hashes is None:
+        hashes = hash_files(target_dir, updated_files)
+    entries = {}
+    for file in updated_files:
+        try:
+            st = os.lstat(os.path.join(target_dir, file))
+        except OSError:
+            continue
+        entries[file] = (st.st_size, st.st_mtime_ns, hashes.get(file))
+    get_state_store().update_manifest(manifest_key, entries, removed_files)
+
+def sync_deploy_path(extracted_dir, target_dir, manifest_key):
+    """מסנכרן את תיקיית היעד לעץ שחולץ: כותב רק קבצים חדשים או ששונו ומוחק רק קבצים
+    שנפרסו בעבר והוסרו. קבצים שהגודל וזמן השינוי שלהם תואמים לרשימה השמורה לא נקראים מחדש"""
+    os.makedirs(target_dir, exist_ok=True)
+    manifest = get_state_store().get_manifest(manifest_key)
+    new_files = list_tree_files(extracted_dir)
+    new_hashes = hash_files(extracted_dir, new_files)
+    deployed_hashes = {}
+    to_hash = []
+    changed_mode = set()
+    for file in new_files:
+        try:
+            st = os.lstat(os.path.join(target_dir, file))
+        except OSError:
+            continue  # קובץ חדש
+        if stat.S_ISDIR(st.st_mode):
+            continue
+        if (os.lstat(os.path.join(extracted_dir, file)).st_mode ^ st.st_mode) & 0o111:
+            changed_mode.add(file)  # הרשאת ההרצה השתנתה
+        entry = manifest.get(file)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns and entry[2]:
+            deployed_hashes[file] = entry[2]
+        else:
+            to_hash.append(file)
+    deployed_hashes.update(hash_files(target_dir, to_hash))
+    updated_files = [file for file in new_files
+                     if file in changed_mode or new_hashes[file] is None or deployed_hashes.get(file) != new_hashes[file]]
+    new_set = set(new_files)
+    removed_files = [file for file in manifest if file not in new_set]
+    log_message(f"סנכרון תיקיית הפריסה: {len(updated_files)} קבצים לעדכון, {len(removed_files)} למחיקה, "
+                f"{len(new_files) - len(updated_files)} ללא שינוי ({len(to_hash)} נקראו מחדש)")
+    apply_file_changes(extracted_dir, target_dir, updated_files, removed_files)
+    record_manifest(target_dir, manifest_key, new_files, removed_files, new_hashes)
+
+def release_manifest_key(ctx, name):
+    """מפתח רשימת הקבצים של גרסה"""
+    return f"{ctx.state_key}@{name}"
+
+def get_live_release(ctx):
+    """מחזיר את רשומת הגרסה שנתיב הפריסה מצביע אליה כרגע (או None)"""
+    if not os.path.islink(ctx.deploy_path):
+        return None
+    live_path = os.path.realpath(ctx.deploy_path)
+    for release in get_state_store().get_releases(ctx.state_key):
+        if os.path.realpath(release['path']) == live_path:
+            return release
     return None
 
-def save_state(commit_sha):
-    """שומר את מזהה הקומיט האחרון"""
-    try:
-        # יצירת התיקייה אם היא לא קיימת
-        os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
-        
-        # אם אין קומיט, נשמור אובייקט ריק
-        data = {'last_commit': commit_sha} if commit_sha else {}
-        
-        with open(STATE_FILE, 'w') as f:
-            json.dump(data, f)
-        
-        if commit_sha:
-            log_message(f"עודכן קובץ המצב: {commit_sha}")
-        return True
-    except Exception as e:
-        log_message(f"שגיאה בשמירת המצב: {str(e)}")
-        return False
+def link_tree(source_dir, target_dir):
+    """יוצר עותק של תיקייה מקישורים קשיחים (העתקה אם הקישור נכשל). מחזיר את התיקיות שנוצרו"""
+    created_dirs = []
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        relative_dir = os.path.relpath(dirpath, source_dir)
+        os.makedirs(os.path.join(target_dir, relative_dir), exist_ok=True)
+        created_dirs.append(os.path.normpath(os.path.join(target_dir, relative_dir)))
+        for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+            src = os.path.join(dirpath, name)
+            dst = os.path.join(target_dir, relative_dir, name)
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), dst)
+                continue
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+    return created_dirs
 
-def load_state():
-    """טוען את מזהה הקומיט האחרון"""
-    try:
-        if not os.path.exists(STATE_FILE) or os.path.getsize(STATE_FILE) == 0:
+def stage_release(ctx, extracted_dir, commit_sha, file_changes, live_release):
+    """בונה גרסה חדשה ב-releases_dir: קישורים קשיחים לגרסה הנוכחית ועליהם רק הקבצים ששונו.
+    מחזיר את רשומת הגרסה (בסטטוס staged)"""
+    name = commit_sha or f"build-{int(time.time())}"
+    if os.path.lexists(os.path.join(ctx.releases_dir, name)):
+        name = f"{name}-{int(time.time())}"
+    release_path = os.path.join(ctx.releases_dir, name)
+    manifest_key = release_manifest_key(ctx, name)
+    store = get_state_store()
+    if live_release:
+        run_file_ops([{'op': 'mkdir', 'path': ctx.releases_dir}])
+        created_dirs = link_tree(live_release['path'], release_path)
+        store.copy_manifest(release_manifest_key(ctx, live_release['name']), manifest_key)
+        run_file_ops([{'op': 'chown', 'path': path} for path in created_dirs])
+    else:
+        run_file_ops([{'op': 'mkdir', 'path': release_path}])
+    release_id = store.add_release(ctx.state_key, name, release_path, commit_sha, 'staged')
+    if file_changes is not None:
+        updated_files = [path for path, status in file_changes.items() if status != 'removed']
+        removed_files = [path for path, status in file_changes.items() if status == 'removed']
+        apply_file_changes(extracted_dir, release_path, updated_files, removed_files)
+        record_manifest(release_path, manifest_key, updated_files, removed_files)
+    else:
+        sync_deploy_path(extracted_dir, release_path, manifest_key)
+    log_message(f"גרסה {name} הוכנה ב-{release_path}")
+    return {'id': release_id, 'name': name, 'path': release_path, 'commit_sha': commit_sha}
+
+def switch_release(ctx, release):
+    """מפנה את נתיב הפריסה לגרסה בהחלפה אטומית של הקישור הסימבולי"""
+    deploy_path = os.path.normpath(ctx.deploy_path)
+    op = {'op': 'symlink_switch', 'path': deploy_path, 'target': release['path']}
+    legacy_name = None
+    if os.path.lexists(deploy_path) and not os.path.islink(deploy_path):
+        # מעבר ראשון למצב גרסאות: התיקייה הקיימת נשמרת כגרסה ולא נמחקת
+        legacy_name = f"legacy-{int(time.time())}"
+        op['legacy'] = os.path.join(ctx.releases_dir, legacy_name)
+    run_file_ops([op])
+    if legacy_name:
+        get_state_store().add_release(ctx.state_key, legacy_name, op['legacy'], None, 'legacy')
+        log_message(f"התיקייה הקיימת {deploy_path} הועברה ל-{op['legacy']}")
+    log_message(f"{deploy_path} מצביע כעת לגרסה {release['name']}")
+
+def release_order(release):
+    """מפתח מיון של גרסאות מהישנה לחדשה; התיקייה שקדמה למצב גרסאות היא הישנה ביותר"""
+    return (release['status'] != 'legacy', release['id'])
+
+def prune_releases(ctx):
+    """משאיר את keep_releases הגרסאות התקינות האחרונות ואת הגרסה הפעילה, ומוחק את השאר"""
+    store = get_state_store()
+    live = get_live_release(ctx)
+    releases = sorted(store.get_releases(ctx.state_key), key=release_order, reverse=True)
+    usable = [release for release in releases if release['status'] in ('success', 'rolled_back', 'legacy')]
+    keep = {release['id'] for release in usable[:ctx.keep_releases]}
+    if live:
+        keep.add(live['id'])
+    for release in releases:
+        if release['id'] in keep:
+            continue
+        run_file_ops([{'op': 'rmtree', 'path': release['path']}])
+        store.delete_manifest(release_manifest_key(ctx, release['name']))
+        store.delete_release(release['id'])
+        log_message(f"גרסה ישנה נמחקה: {release['name']}")
+
+def rollback_release(ctx, name=None):
+    """מחזיר את נתיב הפריסה לגרסה קודמת (או לגרסה בשם name). מחזיר את רשומת הגרסה או None"""
+    with get_deploy_lock(ctx.deploy_path):
+        live = get_live_release(ctx)
+        candidates = [release for release in get_state_store().get_releases(ctx.state_key)
+                      if release['status'] in ('success', 'rolled_back', 'legacy')
+                      and (not live or release['id'] != live['id'])
+                      and os.path.isdir(release['path'])]
+        candidates.sort(key=release_order, reverse=True)
+        if name:
+            candidates = [release for release in candidates if release['name'] == name]
+        elif live:
+            candidates = [release for release in candidates if release_order(release) < release_order(live)]
+        if not candidates:
+            log_message(f"אין גרסה זמינה ל-rollback עבור {ctx.name}")
             return None
-            
-        with open(STATE_FILE, 'r') as f:
-            try:
-                data = json.load(f)
-                return data.get('last_commit')
-            except json.JSONDecodeError:
-                # אם הקובץ קיים אבל לא תקין, נאפס אותו
-                save_state(None)
-                return None
-    except Exception as e:
-        log_message(f"שגיאה בטעינת המצב: {str(e)}")
+        release = candidates[0]
+        started_at = time.time()
+        switch_release(ctx, release)
+        # הקומיט האחרון שנפרס לא משתנה, כדי שהבדיקה התקופתית לא תפרוס שוב את אותו קומיט
+        get_state_store().set_release_status(release['id'], 'rolled_back')
+        # תוצרי setup.sh של הגרסה שהוחזרה לא בהכרח תואמים לטביעת האצבע האחרונה
+        get_state_store().update_state(ctx, last_status='rolled_back', setup_fingerprint=None)
+        record_deploy(ctx, release['commit_sha'], 'rolled_back', f"חזרה לגרסה {release['name']}",
+                      started_at, time.time() - started_at)
+        return release
+
+def get_setup_fingerprint(ctx, deploy_dir):
+    """מחשב טביעת אצבע של קבצי הקלט של setup.sh (setup_inputs ו-setup.sh עצמו), או None אם לא הוגדרו"""
+    if not ctx.setup_inputs:
         return None
+    root = os.path.realpath(deploy_dir)
+    files = {'setup.sh'}
+    for pattern in ctx.setup_inputs:
+        for path in glob.glob(os.path.join(root, pattern), recursive=True):
+            if os.path.isfile(path):
+                files.add(os.path.relpath(path, root))
+    hashes = hash_files(root, sorted(files))
+    digest = hashlib.sha256()
+    for file in sorted(hashes):
+        digest.update(f"{file}\0{hashes[file]}\n".encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
 
-def get_commits_between(base_commit, head_commit):
-    """מחזיר רשימת מזהי קומיטים מהישן לחדש (לא כולל base, כולל head)"""
-    try:
-        commits = []
-        page = 1
+class SetupRun:
+    """הרצה אחת של setup.sh: תהליך בקבוצת תהליכים משלו, פלט שנכתב ללוג שורה אחר שורה
+    ונשמר בזיכרון לצפייה חיה, עם זמן קצוב וביטול"""
+
+    def __init__(self, ctx, deploy_dir, command, env=None):
+        self.ctx = ctx
+        self.deploy_dir = deploy_dir
+        self.command = command
+        self.env = env
+        self.lines = deque(maxlen=SETUP_OUTPUT_LINES)
+        self.state = 'pending'
+        self.returncode = None
+        self.started_at = None
+        self.finished_at = None
+        self.process = None
+        self._cancel = threading.Event()
+        self._reader = None
+
+    def start(self):
+        # cwd וסביבה נקבעים לתהליך הבן בלבד, בלי os.chdir שמשפיע על כל התהליך
+        self.process = subprocess.Popen(self.command,
+                                        cwd=self.deploy_dir,
+                                        env=self.env,
+                                        stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        text=True,
+                                        errors='replace',
+                                        start_new_session=True)
+        self.started_at = time.time()
+        self.state = 'running'
+        # ה-thread שקורא את הפלט רץ בהקשר הלוג של הפריסה (מזהה פריסה ושלב)
+        self._reader = threading.Thread(target=contextvars.copy_context().run, args=(self._read_output,), daemon=True)
+        self._reader.start()
+
+    def _read_output(self):
+        for line in self.process.stdout:
+            line = line.rstrip('\n')
+            self.lines.append(line)
+            log_message(f"setup.sh [{self.ctx.name}]: {line}")
+
+    def wait(self, timeout):
+        """ממתין לסיום התהליך, ועוצר אותו בביטול או בחריגה מהזמן. מחזיר את קוד היציאה"""
+        deadline = self.started_at + timeout
+        kill_attempts = 0
         while True:
-            api_url = f"https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/commits?sha={BRANCH}&since=&per_page=100&page={page}"
-            headers = {'Authorization': f'token {GITHUB_TOKEN}'} if GITHUB_TOKEN else {}
-            response = requests.get(api_url, headers=headers, verify=False)
-            if response.status_code != 200:
-                log_message(f"שגיאה בקבלת רשימת קומיטים: {response.status_code}")
-                return []
-            data = response.json()
-            if not data:
+            try:
+                self.returncode = self.process.wait(timeout=1)
                 break
-            for commit in data:
-                sha = commit['sha']
-                commits.append(sha)
-                if sha == base_commit:
-                    # עצרנו, base_commit נמצא
-                    return list(reversed(commits[:-1]))  # לא כולל base, מהישן לחדש
-            page += 1
-        return list(reversed(commits))
+            except subprocess.TimeoutExpired:
+                if self._cancel.is_set():
+                    self.state = 'cancelled'
+                elif time.time() > deadline:
+                    self.state = 'timeout'
+                else:
+                    continue
+                if kill_attempts >= SETUP_KILL_ATTEMPTS:
+                    # למשל setup.sh שרץ כ-root כשאין הרשאת sudo ל-kill
+                    self.state = 'failed'
+                    log_message(f"לא ניתן לעצור את setup.sh של {self.ctx.name} (PID {self.process.pid}) "
+                                f"אחרי {kill_attempts} ניסיונות; התהליך ממשיך לרוץ ללא מעקב")
+                    break
+                kill_attempts += 1
+                log_message(f"עוצר את setup.sh של {self.ctx.name} ({self.state})")
+                self._kill()
+        self._reader.join(timeout=5)
+        self.finished_at = time.time()
+        if self.state == 'running':
+            self.state = 'success' if self.returncode == 0 else 'failed'
+        return self.returncode
+
+    def _kill(self):
+        """שולח SIGTERM לכל קבוצת התהליכים, ו-SIGKILL אם היא לא הסתיימה בזמן"""
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(self.process.pid, sig)
+            except ProcessLookupError:
+                return
+            except PermissionError:
+                # setup.sh שרץ דרך sudo שייך ל-root
+                return_code, _ = run_command(f"sudo -n kill -{int(sig)} -- -{self.process.pid}")
+                if return_code != 0:
+                    return
+            try:
+                self.process.wait(timeout=SETUP_KILL_GRACE)
+                return
+            except subprocess.TimeoutExpired:
+                continue
+
+    def cancel(self):
+        """מבקש לבטל את ההרצה; מחזיר False אם היא כבר הסתיימה"""
+        if self.state != 'running':
+            return False
+        self._cancel.set()
+        return True
+
+    def snapshot(self, lines=100):
+        """מצב ההרצה לתצוגה ב-API"""
+        end = self.finished_at or time.time()
+        return {
+            'state': self.state,
+            'command': self.command,
+            'cwd': self.deploy_dir,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'elapsed': round(end - self.started_at, 1) if self.started_at else None,
+            'returncode': self.returncode,
+            'output': list(self.lines)[-lines:] if lines else [],
+        }
+
+# ההרצה האחרונה של setup.sh לכל הגדרה (פעילה או שהסתיימה), לצפייה ולביטול דרך ה-API
+_setup_runs = {}
+_setup_runs_lock = threading.Lock()
+
+def get_setup_run(ctx):
+    """מחזיר את ההרצה האחרונה של setup.sh עבור ההגדרה (או None)"""
+    with _setup_runs_lock:
+        return _setup_runs.get(ctx.state_key)
+
+def run_setup(ctx, deploy_dir, commit_sha=None):
+    """מריץ את setup.sh בתיקיית הפריסה ומחזיר האם הצליח"""
+    run_command(f"sudo chmod +x '{deploy_dir}/setup.sh'")
+    if ctx.run_setup_script:
+        command = ['sudo', '-n', f"{deploy_dir}/setup.sh", 'production']
+    else:
+        command = ['./setup.sh']
+    env = dict(os.environ, DEPLOY_PATH=ctx.deploy_path, DEPLOY_DIR=deploy_dir, DEPLOY_COMMIT=commit_sha or '')
+    run = SetupRun(ctx, deploy_dir, command, env)
+    with _setup_runs_lock:
+        _setup_runs[ctx.state_key] = run
+    log_message(f"מריץ את setup.sh (זמן מקסימלי: {int(ctx.setup_timeout)} שניות)")
+    try:
+        run.start()
+        install_result = run.wait(ctx.setup_timeout)
     except Exception as e:
-        log_message(f"שגיאה בקבלת קומיטים בטווח: {str(e)}")
-        return []
+        run.state = 'failed'
+        log_message(f"שגיאה בהרצת setup.sh: {str(e)}")
+        return False
+    if run.state == 'success':
+        log_message(f"setup.sh הסתיים בהצלחה ({run.finished_at - run.started_at:.1f} שניות)")
+        return True
+    if run.state == 'timeout':
+        log_message(f"setup.sh נעצר אחרי {int(ctx.setup_timeout)} שניות")
+    elif run.state == 'cancelled':
+        log_message("setup.sh בוטל")
+    else:
+        log_message(f"שגיאה בהרצת setup.sh. קוד שגיאה: {install_result}")
+    return False
 
-def deploy_latest_version():
-    """מוריד ופורס את הגרסה האחרונה, ומעתיק רק קבצים ששונו בכל הקומיטים מהפעם האחרונה"""
+def _deploy_latest_version(ctx, target_commit=None, base_commit=None, file_changes=None, shared_source=None):
+    current_commit = target_commit
+    start_time = time.time()
     try:
+        set_log_phase('start')
         log_message("מתחיל תהליך התקנה...")
-        current_commit = get_latest_commit()  # שמירת הקומיט הנוכחי
-        last_known_commit = load_state()
-        # שינוי כתובת ה-ZIP להשתמש בענף הנכון
-        zip_url = f"https://github.com/{REPO_OWNER}/{REPO_NAME}/archive/refs/heads/{BRANCH}.zip"
-        headers = {'Authorization': f'token {GITHUB_TOKEN}'} if GITHUB_TOKEN else {}
-        response = requests.get(zip_url, headers=headers, verify=False)
-        if response.status_code == 200:
-            log_message("הורדת הקבצים הצליחה")
-            zip_path = '/tmp/repo.zip'
-            with open(zip_path, 'wb') as f:
-                f.write(response.content)
-            log_message(f"קובץ ZIP נשמר ב-{zip_path}")
-            extracted_dir = f"/tmp/{REPO_NAME}-{BRANCH}"
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                zip_ref.extractall('/tmp')
-            log_message("קבצים חולצו בהצלחה")
-            if UPDATE_ONLY_CHANGED_FILES and last_known_commit:
-                # אם יש שינוי, ניקח את כל הקבצים מכל הקומיטים בטווח; אם אין שינוי, רק את הקומיט האחרון
-                if current_commit != last_known_commit:
-                    commits = get_commits_between(last_known_commit, current_commit)
-                    commits.append(current_commit)
+        last_known_commit = load_state(ctx)
+        release_mode = ctx.deploy_mode == 'release'
+        live_release = None
+        if release_mode:
+            # במצב גרסאות ההפרש מחושב מול הגרסה הפעילה (אחרי rollback היא שונה מהקומיט האחרון שנפרס)
+            live_release = get_live_release(ctx)
+            last_known_commit = live_release['commit_sha'] if live_release else None
+        incremental = ctx.update_only_changed_files and last_known_commit
+        fetch_source = fetch_git_source if ctx.transport == 'git' else fetch_zip_source
+        if shared_source:
+            fetch_source = shared_source.fetch
+        deploy_dir = ctx.deploy_path
+        release = None
+        # תיקיית עבודה ייחודית, כדי שפריסות מקבילות לא ידרסו זו את זו; נמחקת מיד אחרי ההעברה ליעד
+        with Workspace(ctx.repo_name) as workspace:
+            fetched, current_commit, file_changes = fetch_source(
+                ctx, workspace, target_commit, last_known_commit if incremental else None, base_commit, file_changes)
+            if fetched:
+                set_log_phase('place')
+                extracted_dir = workspace.extracted_dir
+                if release_mode:
+                    release = stage_release(ctx, extracted_dir, current_commit, file_changes, live_release)
+                    deploy_dir = release['path']
+                elif file_changes is not None:
+                    updated_files = [path for path, status in file_changes.items() if status != 'removed']
+                    removed_files = [path for path, status in file_changes.items() if status == 'removed']
+                    apply_file_changes(extracted_dir, ctx.deploy_path, updated_files, removed_files)
+                    record_manifest(ctx.deploy_path, ctx.state_key, updated_files, removed_files)
                 else:
-                    commits = [current_commit]
-                changed_files = set()
-                for sha in commits:
-                    for file in get_changed_files(sha):
-                        changed_files.add(file)
-                # העברה למיקום הסופי רק של הקבצים ששונו (הגרסה האחרונה מה-ZIP)
-                for file in changed_files:
-                    src = os.path.join(extracted_dir, file)
-                    dst = os.path.join(DEPLOY_PATH, file)
-                    dst_dir = os.path.dirname(dst)
-                    if not os.path.exists(dst_dir):
-                        os.makedirs(dst_dir, exist_ok=True)
-                    if os.path.exists(src):
-                        run_command(f"sudo -n mv '{src}' '{dst}'")
-            else:
-                run_command(f"sudo -n rm -rf {DEPLOY_PATH}/*")
-                run_command(f"sudo -n mv {extracted_dir}/* {DEPLOY_PATH}/")
-            run_command(f"sudo -n chown -R www-data:www-data {DEPLOY_PATH}")
+                    sync_deploy_path(extracted_dir, ctx.deploy_path, ctx.state_key)
+        if fetched:
+            set_log_phase('setup')
             setup_success = True
-            if os.path.exists(f"{DEPLOY_PATH}/setup.sh"):
-                current_dir = os.getcwd()
-                os.chdir(DEPLOY_PATH)
-                run_command("sudo chmod +x setup.sh")
-                log_message("מריץ את setup.sh")
-                try:
-                    if RUN_SETUP_SCRIPT:
-                        process = os.popen(f"sudo -n {DEPLOY_PATH}/setup.sh production 2>&1")
-                        output = process.read()
-                        install_result = process.close()
-                    else:
-                        install_result = os.system("./setup.sh")
-                        output = "הרצה הושלמה" if install_result == 0 else f"נכשל עם קוד שגיאה: {install_result}"
-                    if install_result == 0:
-                        log_message("setup.sh הסתיים בהצלחה")
-                        log_message(f"פלט:\n{output}")
-                    else:
-                        error_code = install_result >> 8
-                        log_message(f"שגיאה בהרצת setup.sh. קוד שגיאה: {error_code}")
-                        log_message(f"פלט:\n{output}")
-                        setup_success = False
-                except Exception as e:
-                    log_message(f"שגיאה בהרצת setup.sh: {str(e)}")
-                    setup_success = False
-                os.chdir(current_dir)
+            setup_fingerprint = None
+            if os.path.exists(f"{deploy_dir}/setup.sh"):
+                setup_fingerprint = get_setup_fingerprint(ctx, deploy_dir)
+                previous_fingerprint = (get_state_store().get_state(ctx.state_key) or {}).get('setup_fingerprint')
+                if setup_fingerprint and setup_fingerprint == previous_fingerprint:
+                    log_message(f"קבצי הקלט של setup.sh לא השתנו מההרצה המוצלחת האחרונה ({setup_fingerprint[:12]}), מדלג על setup.sh")
+                else:
+                    if setup_fingerprint:
+                        log_message(f"קבצי הקלט של setup.sh השתנו ({(previous_fingerprint or '-')[:12]} -> {setup_fingerprint[:12]})")
+                    setup_success = run_setup(ctx, deploy_dir, current_commit)
             else:
                 log_message("קובץ setup.sh לא נמצא")
-            save_state(current_commit)
-            log_message("התקנה הושלמה" + (" בהצלחה" if setup_success else " עם שגיאות ב-setup.sh"))
+            set_log_phase('finalize')
+            status = 'success' if setup_success else 'setup_failed'
+            if release:
+                # הגרסה מופעלת רק אם setup.sh הצליח; אחרת האתר נשאר על הגרסה הקודמת
+                get_state_store().set_release_status(release['id'], status)
+                if setup_success:
+                    switch_release(ctx, release)
+                else:
+                    log_message(f"הגרסה {release['name']} לא הופעלה בגלל שגיאה ב-setup.sh")
+            duration = time.time() - start_time
+            # טביעת האצבע נשמרת רק אחרי הרצה מוצלחת, כדי שהרצה שנכשלה תנוסה שוב בפריסה הבאה
+            fingerprint_field = {'setup_fingerprint': setup_fingerprint} if setup_success and setup_fingerprint else {}
+            save_state(ctx, current_commit,
+                       last_status=status,
+                       last_deploy=time.time(),
+                       last_deploy_duration=duration,
+                       **fingerprint_field)
+            summary = "התקנה הושלמה" + (" בהצלחה" if setup_success else " עם שגיאות ב-setup.sh")
+            record_deploy(ctx, current_commit, status, summary, start_time, duration)
+            DEPLOY_SECONDS.observe(duration, status=status)
+            log_message(summary)
+            if release:
+                # ניקוי גרסאות ישנות אחרי שמירת המצב: כישלון בניקוי לא הופך פריסה שהופעלה לכושלת
+                try:
+                    prune_releases(ctx)
+                except Exception as e:
+                    log_message(f"אזהרה: מחיקת גרסאות ישנות נכשלה: {str(e)}")
             return True
+        log_message("הורדת הקבצים נכשלה")
+        get_state_store().update_state(ctx, last_status='failed')
+        record_deploy(ctx, current_commit, 'failed', "הורדת הקבצים נכשלה", start_time, time.time() - start_time)
+        DEPLOY_SECONDS.observe(time.time() - start_time, status='failed')
+        return False
     except Exception as e:
         log_message(f"שגיאה בתהליך ההתקנה: {str(e)}")
+        record_deploy(ctx, None, 'failed', f"שגיאה בתהליך ההתקנה: {str(e)}", start_time, time.time() - start_time)
+        DEPLOY_SECONDS.observe(time.time() - start_time, status='failed')
         return False
-    finally:
-        if os.path.exists(zip_path):
-            os.remove(zip_path)
-        if os.path.exists(extracted_dir):
-            run_command(f"sudo -n rm -rf {extracted_dir}")
 
 def load_config(config_file):
-    """טוען הגדרות מקובץ"""
-    global REPO_OWNER, REPO_NAME, DEPLOY_PATH, GITHUB_TOKEN, UPDATE_ONLY_CHANGED_FILES, BRANCH, RUN_SETUP_SCRIPT
+    """טוען הגדרות מקובץ ומחזיר DeployContext (או None בכישלון)"""
     try:
         with open(config_file, 'r') as f:
             config = json.load(f)
-            REPO_OWNER = config['repo_owner']
-            REPO_NAME = config['repo_name']
-            DEPLOY_PATH = config['deploy_path']
-            GITHUB_TOKEN = config.get('github_token', '')
-            UPDATE_ONLY_CHANGED_FILES = config.get('update_only_changed_files', False)
-            BRANCH = config.get('branch', 'main')  # קריאת הענף מההגדרות
-            RUN_SETUP_SCRIPT = config.get('run_setup_script', False)  # קריאת הגדרת הרצת setup.sh
-            return True
+        return DeployContext(config, config_file)
     except Exception as e:
         log_message(f"שגיאה בטעינת הגדרות מ-{config_file}: {str(e)}")
-        return False
+        return None
 
 def run_single_check(config_file=None):
-    """פונקציה שמבצעת בדיקה אחת ומסתיימת"""
+    """פונקציה שמבצעת בדיקה אחת ומסתיימת; ללא קובץ הגדרות נבדקים כל הקבצים ב-processed"""
+    if not config_file:
+        return check_processed_configs()
+    ctx = load_config(config_file)
+    if not ctx:
+        return False
+    return run_check(ctx)
+
+def run_check(ctx):
+    """בודק ופורס את הגרסה האחרונה עבור הקשר פריסה נתון"""
     try:
-        if config_file and not load_config(config_file):
-            return False
-        
-        if not REPO_OWNER or not REPO_NAME:
-            log_message("חסרות הגדרות בסיסיות (REPO_OWNER, REPO_NAME)")
+        if not ctx.repo_owner or not ctx.repo_name:
+            log_message("חסרות הגדרות בסיסיות (repo_owner, repo_name)")
             return False
 
-        current_commit = get_latest_commit()
+        current_commit = get_latest_commit(ctx)
         if not current_commit:
             log_message("לא הצלחתי לקבל את הקומיט האחרון")
             return False
-        
-        last_known_commit = load_state()
-        log_message(f"קומיט נוכחי: {current_commit}, קומיט אחרון ידוע: {last_known_commit}")
+        log_message(f"קומיט נוכחי: {current_commit}")
 
-        if UPDATE_ONLY_CHANGED_FILES:
-            # תמיד נבצע פריסה של הקבצים ששונו בקומיט האחרון (או בטווח)
-            deploy_latest_version()
-            # נשמור את הקומיט רק אם יש שינוי
-            if current_commit != last_known_commit:
-                save_state(current_commit)
-            return True
-        else:
-            # תמיד פריסה מלאה
-            deploy_latest_version()
-            if current_commit != last_known_commit:
-                save_state(current_commit)
-            return True
-        return False
+        # במצב update_only_changed_files נפרסים הקבצים ששונו בקומיט האחרון (או בטווח),
+        # אחרת מתבצעת פריסה מלאה; הקומיט נשמר במצב רק כשהפריסה מצליחה.
+        # הקומיט מועבר לפריסה, כדי שראש הענף לא ייבדק פעם שנייה
+        return deploy_latest_version(ctx, current_commit)
     except Exception as e:
         log_message(f"שגיאה: {str(e)}")
         return False
@@ -421,7 +2781,7 @@ def check_permissions():
                 return False
         
         # בדיקת הרשאות לקבצים
-        for file_path in [LOG_FILE, STATE_FILE]:
+        for file_path in [LOG_FILE, STATE_DB]:
             dir_path = os.path.dirname(file_path)
             if not os.access(dir_path, os.W_OK):
                 log_message(f"אין הרשאות כתיבה לתיקייה: {dir_path}")
@@ -448,7 +2808,9 @@ def validate_config(config):
         'branch': 'main',
         'setup_script': 'setup.sh',
         'setup_args': 'production',
-        'run_setup_script': False  # הוספת שדה חדש עם ערך ברירת מחדל False
+        'run_setup_script': False,  # הוספת שדה חדש עם ערך ברירת מחדל False
+        'transport': DEFAULT_TRANSPORT,
+        'deploy_mode': 'inplace'
     }
     
     # בדיקת שדות חובה
@@ -467,6 +2829,32 @@ def validate_config(config):
     
     return True
 
+def parse_legacy_time(value):
+    """ממיר זמן בפורמט שנשמר בעבר בקובץ ההגדרות ל-timestamp (או None)"""
+    try:
+        return time.mktime(time.strptime(value or '', '%Y-%m-%d %H:%M:%S'))
+    except (TypeError, ValueError):
+        return None
+
+def import_legacy_history(ctx, config):
+    """מעביר היסטוריה ושדות מצב ישנים מקובץ ההגדרות למאגר, ומסיר אותם מההגדרות.
+    הייבוא מתבצע פעם אחת - רק כשאין עדיין מצב להגדרה במאגר - כך שהקומיט האחרון שנפרס לפני השדרוג
+    נשמר, והבדיקה הראשונה אחרי השדרוג לא מבצעת פריסה מלאה ולא מריצה שוב את setup.sh"""
+    if not any(config.get(field) for field in LEGACY_STATUS_FIELDS):
+        return
+    store = get_state_store()
+    if store.get_state(ctx.state_key) is None:
+        for entry in config.get('history') or []:
+            record_deploy(ctx, entry.get('commit'), entry.get('status'), entry.get('log'),
+                          parse_legacy_time(entry.get('update_time')))
+        if config.get('last_commit'):
+            store.update_state(ctx, last_commit=config['last_commit'],
+                               last_status=config.get('status') or 'success',
+                               last_deploy=parse_legacy_time(config.get('last_update')))
+            log_message(f"יובא הקומיט האחרון של {ctx.name} מקובץ ההגדרות: {config['last_commit']}")
+    for field in LEGACY_STATUS_FIELDS:
+        config.pop(field, None)
+
 def process_config_file(config_file_path):
     """מעבד קובץ הגדרות ומבצע התקנה"""
     try:
@@ -489,30 +2877,17 @@ def process_config_file(config_file_path):
         
         try:
             # ביצוע ההתקנה
-            success = run_single_check(config_file_path)
-            current_commit = get_latest_commit()
-            
-            # הוספת מידע על ההתקנה
-            update_info = {
-                'last_commit': current_commit,
-                'last_update': time.strftime('%Y-%m-%d %H:%M:%S'),
-                'status': 'success',
-                'update_log': "אין צורך בעדכון - הגרסה העדכנית כבר מותקנת"
-            }
+            ctx = DeployContext(config, config_file_path)
+            import_legacy_history(ctx, config)
+            success = run_check(ctx)
             
-            if success and current_commit != load_state():
-                update_info['update_log'] = "התקנה הושלמה בהצלחה"
-            elif not success:
-                update_info['status'] = 'failed'
-                update_info['update_log'] = "התקנה נכשלה"
-            
-            # עדכון הקונפיג עם המידע החדש
-            config.update(update_info)
-            
-            # כתיבת התוכן לקובץ החדש אם ההתקנה הצליחה
+            # קובץ ההגדרות נשמר כפי שהוא; סטטוס והיסטוריה נשמרים במאגר המצב
             if success:
-                with open(processed_file, 'w', encoding='utf-8') as f:
+                # כתיבה לקובץ זמני והחלפה, כך שמאגר ההגדרות לא יקרא קובץ כתוב למחצה
+                tmp_file = f"{processed_file}.tmp"
+                with open(tmp_file, 'w', encoding='utf-8') as f:
                     json.dump(config, f, indent=4, ensure_ascii=False)
+                os.replace(tmp_file, processed_file)
                 log_message(f"קובץ {config_file_path} הועבר בהצלחה ל-processed")
             else:
                 log_message(f"התקנה נכשלה עבור {config_file_path}")
@@ -544,26 +2919,29 @@ def process_config_file(config_file_path):
                 pass
         return False
 
-def check_processed_configs():
-    """בדיקת עדכונים לקבצי הגדרות מעובדים"""
+def check_processed_configs(force=False):
+    """בדיקת עדכונים לקבצי הגדרות מעובדים - נבדקים במקביל המאגרים שהגיע זמנם לפי התזמון (force - כולם)"""
     try:
         # בדיקה אם יש תהליך התקנה פעיל
         if os.name == 'nt':  # Windows
             try:
                 import psutil
                 for proc in psutil.process_iter(['pid', 'name']):
+                    if proc.info['pid'] == os.getpid():
+                        continue
                     if 'setup.sh' in proc.info['name'] or 'app.py' in proc.info['name']:
                         log_message(f"יש תהליך התקנה פעיל (PID: {proc.info['pid']})")
-                        return
+                        return False
             except ImportError:
                 log_message("psutil לא מותקן, לא ניתן לבדוק תהליכים פעילים")
-                return
+                return False
         else:  # Linux/Unix
             try:
                 output = subprocess.check_output(['pgrep', '-f', 'setup.sh|app.py']).decode()
-                if output.strip():
+                other_pids = [pid for pid in output.split() if pid != str(os.getpid())]
+                if other_pids:
                     log_message("זוהה תהליך התקנה פעיל, דילוג על בדיקת עדכונים")
-                    return
+                    return False
             except subprocess.CalledProcessError:
                 pass  # אין תהליך התקנה פעיל
         
@@ -571,67 +2949,231 @@ def check_processed_configs():
         
         if not os.path.exists(CONFIG_PROCESSED_DIR):
             log_message("תיקיית processed לא קיימת") 
-            return
-            
-        files = [f for f in os.listdir(CONFIG_PROCESSED_DIR) if f.endswith('.json')]
-        if not files:
-            log_message("אין קבצי הגדרות בתיקיית processed")
-            return
+            return False
             
-        log_message(f"נמצאו {len(files)} קבצי הגדרות לבדיקה")
-        
-        for file in files:
-            try:
-                config_path = os.path.join(CONFIG_PROCESSED_DIR, file)
-                log_message(f"בודק עדכונים עבור {file}...")
-                
-                with open(config_path, 'r') as f:
-                    config = json.load(f)
-                    
-                # טעינת הגדרות גלובליות
-                global REPO_OWNER, REPO_NAME, DEPLOY_PATH, GITHUB_TOKEN, RUN_SETUP_SCRIPT
-                REPO_OWNER = config['repo_owner']
-                REPO_NAME = config['repo_name']
-                DEPLOY_PATH = config['deploy_path']
-                GITHUB_TOKEN = config.get('github_token', '')
-                RUN_SETUP_SCRIPT = config.get('run_setup_script', False)
-                
-                # בדיקת עדכונים
-                current_commit = get_latest_commit()
-                last_known_commit = load_state()  # קריאת הקומיט האחרון מקובץ המצב
-                
-                log_message(f"קומיט נוכחי: {current_commit}, קומיט אחרון ידוע: {last_known_commit}")
-                
-                if not current_commit:
-                    log_message(f"לא הצלחתי לקבל את הקומיט האחרון עבור {file}")
-                    continue
-                    
-                if current_commit != last_known_commit:
-                    log_message(f"נמצא עדכון חדש עבור {file}")
-                    if deploy_latest_version():
-                        # עדכון הקומיט האחרון בשני המקומות
-                        save_state(current_commit)  # שמירה בקובץ המצב הגלובלי
-                        
-                        # עדכון בקובץ ההגדרות
-                        config['last_commit'] = current_commit
-                        config['last_update'] = time.strftime('%Y-%m-%d %H:%M:%S')
-                        config['status'] = 'success'
-                        config['update_log'] = "התקנה הושלמה בהצלחה"
-                        
-                        # שמירת הקובץ המעודכן
-                        with open(config_path, 'w', encoding='utf-8') as f:
-                            json.dump(config, f, indent=4, ensure_ascii=False)
-                            
-                        log_message(f"עודכן קובץ {file} וקובץ המצב הגלובלי")
-                else:
-                    log_message(f"אין עדכונים חדשים עבור {file}")
-                    
-            except Exception as e:
-                log_message(f"שגיאה בבדיקת {file}: {str(e)}")
-                continue
+        return poll_due_configs(force)
                 
     except Exception as e:
         log_message(f"שגיאה בבדיקת עדכונים אוטומטית: {str(e)}")
+        return False
+
+def poll_due_configs(force=False, wait=True):
+    """בודק את קבוצות ההגדרות שהגיע זמן הבדיקה שלהן, בגבולות מכסת ה-API. מחזיר False אם בדיקה נכשלה.
+    wait=False (המתזמן בשירות) - פריסות נכנסות לתור בלי המתנה לסיומן, כדי שפריסה ארוכה לא תעכב בדיקות"""
+    # רשימת ההגדרות מהמאגר בזיכרון, מסונכרנת עם התיקייה פעם אחת לכל הסריקה
+    # (כשה-Observer פעיל, בלי קריאה מהדיסק)
+    registry = get_config_registry()
+    registry.refresh()
+    files = registry.names(refresh=False)
+    if not files:
+        log_message("אין קבצי הגדרות בתיקיית processed")
+        return True
+
+    # הגדרות של אותו מאגר, ענף וטוקן נבדקות יחד: קריאת API אחת והורדה אחת לכל הקבוצה
+    results = {file: False for file in files if registry.get(file, refresh=False) is None}
+    if results:
+        log_message(f"קבצי הגדרות לא תקינים: {', '.join(sorted(results))}")
+    groups = group_contexts([registry.get(file, refresh=False) for file in files if file not in results])
+    due, deferred = get_poll_scheduler().select(groups, force=force)
+    if not due:
+        return not results
+    log_message(f"נבדקים {len(due)} מתוך {len(groups)} מאגרים"
+                + (f", {deferred} נדחו בגלל מכסת ה-API" if deferred else ""))
+
+    # כל קבוצה נבדקת ב-thread משלה; פריסות לאותו נתיב מסונכרנות ב-deploy_latest_version
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=min(POLL_MAX_WORKERS, len(due))) as executor:
+        futures = [executor.submit(check_config_group, [ctx.name for ctx in contexts], wait) for contexts in due]
+        for future in as_completed(futures):
+            results.update(future.result())
+
+    failed = [file for file, ok in results.items() if not ok]
+    POLL_SWEEP_SECONDS.observe(time.time() - start_time)
+    log_message(f"הבדיקה התקופתית הסתיימה תוך {time.time() - start_time:.1f} שניות"
+                + (f", נכשלו: {', '.join(sorted(failed))}" if failed else ""))
+    return not failed
+
+def schedule_key(ctx):
+    """מפתח התזמון: מאגר וענף (תדירות הקומיטים לא תלויה בטוקן או בנתיב הפריסה)"""
+    return f"{ctx.repo_owner.lower()}/{ctx.repo_name.lower()}/{ctx.branch}"
+
+class PollScheduler:
+    """תזמון הבדיקות התקופתיות: מרווח נפרד לכל מאגר וענף, מותאם לתדירות הקומיטים ונשמר ב-state.db.
+    בשירות רץ thread שבודק כל POLL_TICK שניות רק את המאגרים שהגיע זמנם, כך שהבדיקות מתפזרות לאורך הזמן"""
+
+    def __init__(self):
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def select(self, groups, now=None, force=False):
+        """מחזיר (קבוצות לבדיקה, מספר הקבוצות שנדחו בגלל המכסה). קבוצות שלא נבדקו מעולם - מיד.
+        לכל טוקן נבדקות רק קבוצות בגבולות המכסה שמעל הרזרבה לפריסות, מהמאוחרת ביותר"""
+        now = now or time.time()
+        store = get_state_store()
+        due = []
+        for contexts in groups:
+            schedule = store.get_schedule(schedule_key(contexts[0]))
+            next_check = schedule['next_check'] if schedule and schedule['next_check'] else 0
+            if force or next_check <= now:
+                due.append((next_check, contexts))
+        due.sort(key=lambda item: item[0])
+        allowances = {}
+        selected = []
+        deferred = 0
+        for _, contexts in due:
+            ctx = contexts[0]
+            if ctx.transport != 'git':  # ls-remote לא נספר במכסת ה-API
+                key = token_id(ctx.github_token)
+                if key not in allowances:
+                    allowances[key] = get_rate_budget().poll_allowance(ctx.github_token, now)
+                if allowances[key] is not None:
+                    if allowances[key] <= 0:
+                        # הבדיקה נדחית עד איפוס המכסה, כדי שלא תיבחר ותידחה שוב בכל POLL_TICK
+                        reset = get_rate_budget().reset_time(ctx.github_token)
+                        store.set_schedule(schedule_key(ctx), next_check=max(reset or 0, now + POLL_MIN_INTERVAL))
+                        deferred += 1
+                        continue
+                    allowances[key] -= 1
+            selected.append(contexts)
+        if deferred:
+            POLLS_DEFERRED.inc(deferred)
+        return selected, deferred
+
+    def record(self, ctx, head_commit, now=None):
+        """מעדכן את התזמון אחרי בדיקה: קומיט חדש מקצר את המרווח לפי הזמן הממוצע בין קומיטים,
+        בדיקה בלי שינוי מאריכה אותו; head_commit=None (כשל) - ניסיון חוזר אחרי המרווח הקצר או איפוס המכסה"""
+        now = now or time.time()
+        key = schedule_key(ctx)
+        with self._lock:
+            store = get_state_store()
+            schedule = store.get_schedule(key) or {}
+            interval = schedule.get('interval') or AUTO_CHECK_INTERVAL
+            if head_commit is None:
+                retry_at = now + POLL_MIN_INTERVAL
+                reset = get_rate_budget().reset_time(ctx.github_token)
+                if ctx.transport != 'git' and get_rate_budget().poll_allowance(ctx.github_token, now) == 0 and reset:
+                    retry_at = max(retry_at, reset)
+                store.set_schedule(key, next_check=retry_at, last_check=now)
+                return
+            fields = {'last_check': now, 'last_head': head_commit}
+            previous_head = schedule.get('last_head')
+            if previous_head and previous_head != head_commit:
+                avg_gap = schedule.get('avg_change_gap')
+                if schedule.get('last_change'):
+                    gap = now - schedule['last_change']
+                    avg_gap = gap if not avg_gap else (avg_gap + gap) / 2
+                    fields['avg_change_gap'] = avg_gap
+                fields['last_change'] = now
+                interval = avg_gap * POLL_CHANGE_FACTOR if avg_gap else interval / 2
+            elif previous_head:
+                interval = interval * POLL_BACKOFF
+            interval = min(POLL_MAX_INTERVAL, max(POLL_MIN_INTERVAL, interval))
+            if schedule:
+                delay = interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+            else:
+                delay = interval * random.uniform(0.5, 1.5)  # פיזור ראשוני, כדי שמאגרים חדשים לא ייבדקו תמיד יחד
+            fields.update(interval=interval, next_check=now + delay)
+            store.set_schedule(key, **fields)
+
+    def snapshot(self, groups=None):
+        """מחזיר את תזמון המאגרים (למסך /schedule), כולל ההגדרות של כל מאגר"""
+        now = time.time()
+        members = {}
+        for contexts in groups or []:
+            members.setdefault(schedule_key(contexts[0]), []).extend(ctx.name for ctx in contexts)
+        schedules = {row['repo_key']: row for row in get_state_store().get_all_schedules()}
+        result = []
+        for key in sorted(set(schedules) | set(members), key=lambda k: (schedules.get(k) or {}).get('next_check') or 0):
+            row = dict(schedules.get(key) or {'repo_key': key})
+            row['configs'] = sorted(members.get(key, []))
+            row['due_in'] = max(0, int(row['next_check'] - now)) if row.get('next_check') else 0
+            result.append(row)
+        return result
+
+    def start(self):
+        """מפעיל את ה-thread של הבדיקות התקופתיות (פעם אחת לכל תהליך)"""
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='poll-scheduler', daemon=True)
+            self._thread.start()
+        log_message(f"מתזמן הבדיקות פועל (כל {POLL_TICK} שניות)")
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(POLL_TICK):
+            try:
+                poll_due_configs(wait=False)
+            except Exception as e:
+                log_message(f"שגיאה במתזמן הבדיקות: {str(e)}")
+
+_poll_scheduler = None
+_poll_scheduler_lock = threading.Lock()
+
+def get_poll_scheduler():
+    """מחזיר את מתזמן הבדיקות המשותף (נוצר בשימוש הראשון)"""
+    global _poll_scheduler
+    with _poll_scheduler_lock:
+        if _poll_scheduler is None:
+            _poll_scheduler = PollScheduler()
+        return _poll_scheduler
+
+def check_config_group(files, wait=True):
+    """בודק קבוצת קבצי הגדרות של אותו מאגר, ענף וטוקן בקריאה אחת, ופורס את אלה שלא בקומיט האחרון.
+    מחזיר מילון {שם קובץ: הצלחה}"""
+    with log_context(config=','.join(files), phase='check'):
+        return _check_config_group(files, wait)
+
+def _check_config_group(files, wait=True):
+    results = {file: False for file in files}
+    try:
+        log_message(f"בודק עדכונים עבור {', '.join(files)}...")
+        registry = get_config_registry()
+        contexts = []
+        for file in files:
+            # poll_due_configs כבר סינכרן את המאגר בתחילת הסריקה
+            ctx = registry.get(file, refresh=False)
+            if ctx:
+                contexts.append(ctx)
+            else:
+                log_message(f"קובץ ההגדרות {file} לא נמצא או לא תקין")
+        if not contexts:
+            return results
+
+        # בדיקת עדכונים - קריאה אחת לכל הקבוצה
+        current_commit = get_latest_commit(contexts[0])
+        get_poll_scheduler().record(contexts[0], current_commit)
+        if not current_commit:
+            log_message(f"לא הצלחתי לקבל את הקומיט האחרון עבור {', '.join(files)}")
+            return results
+
+        outdated = []
+        for ctx in contexts:
+            last_known_commit = load_state(ctx)  # קריאת הקומיט האחרון של ההגדרה ממאגר המצב
+            get_state_store().update_state(ctx, last_check=time.time())
+            log_message(f"{ctx.name}: קומיט נוכחי: {current_commit}, קומיט אחרון ידוע: {last_known_commit}")
+            if current_commit != last_known_commit:
+                outdated.append(ctx)
+            else:
+                results[ctx.name] = True
+
+        if outdated:
+            log_message(f"נמצא עדכון חדש עבור {', '.join(ctx.name for ctx in outdated)}")
+            # הפריסה עוברת בתור, כך שהיא מתאחדת עם בקשות מ-Webhook או מ-/deploy לאותן הגדרות
+            future = deploy_queue.enqueue_group(outdated, current_commit, source='poll')
+            ok = future.result() if wait else True  # בלי המתנה התוצאה נרשמת בתור ובהיסטוריית הפריסות
+            results.update({ctx.name: ok for ctx in outdated})
+        else:
+            log_message(f"אין עדכונים חדשים עבור {', '.join(files)}")
+        return results
+
+    except Exception as e:
+        log_message(f"שגיאה בבדיקת {', '.join(files)}: {str(e)}")
+        return results
 
 def acquire_lock():
     """מנסה לקבל נעילה על הסקריפט"""
@@ -694,6 +3236,7 @@ def acquire_lock():
                 fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
             except IOError:
                 f.close()
+                log_message("תהליך אחר (השירות או הרצת --single) מחזיק בנעילה, יציאה")
                 return None
 
         # כתיבת מידע לקובץ הנעילה
@@ -723,6 +3266,7 @@ def release_lock(lock_fd):
                 except:
                     pass
             else:  # Linux/Unix
+                import fcntl
                 fcntl.flock(lock_fd.fileno(), fcntl.LOCK_UN)
                 lock_fd.close()
                 try:
@@ -736,10 +3280,11 @@ def validate_directories():
     """בדיקת תקינות התיקיות"""
     try:
         # וידוא שהתיקיות קיימות
-        for dir_path in [BASE_DIR, CONFIG_WATCH_DIR, CONFIG_PROCESSED_DIR, os.path.dirname(LOG_FILE), os.path.dirname(STATE_FILE)]:
+        for dir_path in [BASE_DIR, CONFIG_WATCH_DIR, CONFIG_PROCESSED_DIR, os.path.dirname(LOG_FILE), os.path.dirname(STATE_DB)]:
             if not os.path.exists(dir_path):
                 os.makedirs(dir_path)
                 log_message(f"נוצרה תיקייה: {dir_path}")
+        cleanup_stale_workspaces()
         
         # בדיקת תכולת pending
         pending_files = [f for f in os.listdir(CONFIG_WATCH_DIR) if f.endswith('.json')]
@@ -747,45 +3292,156 @@ def validate_directories():
             log_message(f"נמצאו {len(pending_files)} קבצים בתיקיית pending")
             for file in pending_files:
                 log_message(f"מעבד קובץ שנשאר: {file}")
-                process_config_file(os.path.join(CONFIG_WATCH_DIR, file))
+                deploy_queue.enqueue_config_file(os.path.join(CONFIG_WATCH_DIR, file))
         
         return True
     except Exception as e:
         log_message(f"שגיאה בבדיקת תיקיות: {str(e)}")
         return False
 
-def get_changed_files(commit_sha):
-    """מקבל רשימת קבצים ששונו בקומיט מסוים"""
+class FileChanges(dict):
+    """מילון {נתיב: סטטוס} של קבצים ששונו, עם מזהי ה-blob שה-API החזיר לכל קובץ (blobs: נתיב -> sha),
+    כך שמטמון ה-blobs לא צריך את עץ הקבצים המלא בפריסה חלקית"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.blobs = {}
+
+def merge_file_changes(changes, files):
+    """ממזג רשימת קבצים מה-API למילון {נתיב: סטטוס}; שינוי שם נרשם כמחיקת השם הישן"""
+    blobs = getattr(changes, 'blobs', None)
+    for file in files:
+        file_path = file.get('filename')
+        if not file_path:
+            continue
+        status = file.get('status', 'modified')
+        previous_path = file.get('previous_filename')
+        if status == 'renamed' and previous_path:
+            changes[previous_path] = 'removed'
+        changes[file_path] = status
+        if blobs is not None:
+            if status != 'removed' and file.get('sha'):
+                blobs[file_path] = file['sha']
+            else:
+                blobs.pop(file_path, None)
+    return changes
+
+def get_range_file_changes(ctx, base_commit, head_commit):
+    """מחזיר את הקבצים ששונו בין שני קומיטים בבקשת compare אחת, או None אם ה-API לא יכול לענות"""
     try:
-        # קבלת מידע על הקומיט
-        api_url = f"https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/commits/{commit_sha}"
-        headers = {'Authorization': f'token {GITHUB_TOKEN}'} if GITHUB_TOKEN else {}
-        
-        response = requests.get(api_url, headers=headers, verify=False)
+        # per_page=1 מצמצם את רשימת הקומיטים בתשובה; רשימת הקבצים מוחזרת במלואה בעמוד הראשון
+        api_url = f"{GITHUB_API_URL}/repos/{ctx.repo_owner}/{ctx.repo_name}/compare/{base_commit}...{head_commit}?per_page=1"
+        response = github_get(api_url, ctx.github_token)
         if response.status_code != 200:
-            log_message(f"שגיאה בקבלת מידע על קומיט: {response.status_code}")
-            return []
-            
-        commit_data = response.json()
-        changed_files = []
-        
-        # איסוף רשימת הקבצים ששונו
-        for file in commit_data.get('files', []):
-            file_path = file.get('filename')
-            if file_path:
-                # יצירת תיקיות נדרשות
-                dir_path = os.path.dirname(os.path.join(DEPLOY_PATH, file_path))
-                if not os.path.exists(dir_path):
-                    os.makedirs(dir_path, exist_ok=True)
-                changed_files.append(file_path)
-        
-        log_message(f"נמצאו {len(changed_files)} קבצים ששונו בקומיט {commit_sha}")
-        return changed_files
-        
+            log_message(f"שגיאה בהשוואת קומיטים: {response.status_code}")
+            return None
+
+        compare_data = response.json()
+        status = compare_data.get('status')
+        if status not in ('ahead', 'identical'):
+            # היסטוריה ששוכתבה (force push) - ההשוואה מול נקודת הפיצול לא משקפת את המצב המותקן
+            log_message(f"השוואת הקומיטים החזירה סטטוס {status}")
+            return None
+
+        files = compare_data.get('files', [])
+        if len(files) >= COMPARE_FILES_LIMIT:
+            log_message(f"ההשוואה כוללת {len(files)} קבצים או יותר ועלולה להיות קטועה")
+            return None
+
+        changes = merge_file_changes(FileChanges(), files)
+        log_message(f"נמצאו {len(changes)} קבצים ששונו בין {base_commit} ל-{head_commit}")
+        return changes
+
+    except Exception as e:
+        log_message(f"שגיאה בהשוואת קומיטים: {str(e)}")
+        return None
+
+def get_changes_between(ctx, base_commit, head_commit):
+    """מחזיר מילון {נתיב: סטטוס} של כל השינויים בטווח, או None כשצריך פריסה מלאה
+    (היסטוריה ששוכתבה, השוואה קטועה או שגיאה) - בלי מעבר קומיט-קומיט שעלול לעבור על כל הענף"""
+    changes = get_range_file_changes(ctx, base_commit, head_commit)
+    if changes is None:
+        log_message("לא ניתן לחשב את השינויים בטווח, מבצע פריסה מלאה")
+    return changes
+
+def get_commit_file_changes(ctx, commit_sha):
+    """מקבל את רשימת הקבצים (כולל סטטוס) ששונו בקומיט מסוים, עם דפדוף כשהרשימה ארוכה"""
+    try:
+        api_url = f"{GITHUB_API_URL}/repos/{ctx.repo_owner}/{ctx.repo_name}/commits/{commit_sha}"
+
+        files = []
+        while api_url:
+            response = github_get(api_url, ctx.github_token)
+            if response.status_code != 200:
+                log_message(f"שגיאה בקבלת מידע על קומיט: {response.status_code}")
+                return []
+            files.extend(response.json().get('files', []))
+            # GitHub מחלק קומיטים גדולים לעמודים של קבצים
+            api_url = response.links.get('next', {}).get('url')
+
+        log_message(f"נמצאו {len(files)} קבצים ששונו בקומיט {commit_sha}")
+        return files
+
     except Exception as e:
         log_message(f"שגיאה בקבלת רשימת קבצים ששונו: {str(e)}")
         return []
 
+def verify_webhook_signature(body, signature, secret):
+    """מאמת חתימת HMAC-SHA256 של Webhook מ-GitHub (כותרת X-Hub-Signature-256)"""
+    if not secret or not signature or not signature.startswith('sha256='):
+        return False
+    expected = 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+def find_configs(repo_owner, repo_name, branch=None):
+    """מחזיר את הקשרי הפריסה ב-processed שמתאימים למאגר (ולענף, אם צוין)"""
+    return get_config_registry().find(repo_owner, repo_name, branch)
+
+def group_key(ctx):
+    """מפתח הקבוצה של הגדרה: הגדרות עם אותו מפתח חולקות בדיקה והורדה"""
+    return (ctx.repo_owner.lower(), ctx.repo_name.lower(), ctx.branch, ctx.transport, ctx.repo_url or '', token_id(ctx.github_token))
+
+def group_contexts(contexts):
+    """מקבץ הקשרי פריסה לפי group_key, בסדר ההופעה"""
+    groups = OrderedDict()
+    for ctx in contexts:
+        groups.setdefault(group_key(ctx), []).append(ctx)
+    return list(groups.values())
+
+def get_push_file_changes(payload):
+    """בונה מילון {נתיב: סטטוס} מרשימות הקבצים של הקומיטים באירוע push"""
+    changes = {}
+    for commit in payload.get('commits') or []:
+        for path in commit.get('removed') or []:
+            changes[path] = 'removed'
+        for path in commit.get('added') or []:
+            changes[path] = 'added'
+        for path in commit.get('modified') or []:
+            changes[path] = 'modified'
+    return changes
+
+def handle_push_event(payload):
+    """ממפה אירוע push להגדרות ב-processed ומכניס פריסות לתור; מחזיר את שמות ההגדרות"""
+    ref = payload.get('ref', '')
+    if not ref.startswith('refs/heads/') or payload.get('deleted'):
+        return []
+    repository = payload.get('repository') or {}
+    owner = repository.get('owner') or {}
+    repo_owner = owner.get('login') or owner.get('name') or ''
+    branch = ref[len('refs/heads/'):]
+    after = payload.get('after')
+    # ב-push רגיל רשימות הקבצים מהאירוע מספיקות; אחרי force push מחשבים את השינויים מחדש
+    file_changes = None if payload.get('forced') else get_push_file_changes(payload)
+    queued = []
+    for contexts in group_contexts(find_configs(repo_owner, repository.get('name', ''), branch)):
+        if after:
+            get_poll_scheduler().record(contexts[0], after)  # Push הוא גם קומיט שנצפה לצורך התזמון
+        names = [ctx.name for ctx in contexts]
+        log_message(f"Webhook: פריסה של {after} עבור {', '.join(names)}")
+        deploy_queue.enqueue_group(contexts, after, payload.get('before'), file_changes, source='webhook')
+        queued.extend(names)
+    return queued
+
 def main():
     # בדיקת תקינות התיקיות לפני כל פעולה
     if not validate_directories():
@@ -803,15 +3459,19 @@ def main():
             return False
 
         if len(sys.argv) > 1 and sys.argv[1] == "--single":
-            return run_single_check()
+            # אפשר להעביר קובץ הגדרות ספציפי; אחרת נבדקים המאגרים שהגיע זמנם (--all - כולם)
+            if len(sys.argv) > 2 and sys.argv[2] == '--all':
+                result = check_processed_configs(force=True)
+            else:
+                result = run_single_check(sys.argv[2] if len(sys.argv) > 2 else None)
+            deploy_queue.wait_idle()  # סיום קבצים שנשארו ב-pending לפני יציאה
+            return result
         
         log_message("התחלת מעקב אחר שינויים...")
         
-        # הגדרת מאזין לתיקיית pending
-        event_handler = ConfigFileHandler()
-        observer = Observer()
-        observer.schedule(event_handler, CONFIG_WATCH_DIR, recursive=False)
-        observer.start()
+        # הגדרת מאזין לתיקיות pending ו-processed, ובדיקות תקופתיות לפי התזמון
+        observer = start_observer()
+        get_poll_scheduler().start()
 
         try:
             while True:
@@ -822,6 +3482,19 @@ def main():
     finally:
         release_lock(lock_fd)
 
+def start_observer():
+    """מפעיל Observer על pending (עיבוד קבצים חדשים) ועל processed (עדכון מאגר ההגדרות)"""
+    from watchdog.observers import Observer
+    observer = Observer()
+    observer.schedule(ConfigFileHandler(), CONFIG_WATCH_DIR, recursive=False)
+    observer.schedule(ProcessedConfigHandler(), CONFIG_PROCESSED_DIR, recursive=False)
+    observer.start()
+    # הטעינה המלאה מתבצעת אחרי שה-Observer פועל, כדי לא לפספס שינויים שקרו בינתיים
+    get_config_registry().watch()
+    return observer
+
+_service_lock_fd = None
+
 def start_watcher():
     """מפעיל את ה-Watcher בתהליך נפרד"""
     try:
@@ -829,32 +3502,31 @@ def start_watcher():
             log_message("שגיאה: לא ניתן לוודא תקינות תיקיות")
             return False
 
+        global _service_lock_fd
         lock_fd = acquire_lock()
         if not lock_fd:
             return False
+        # הנעילה נשמרת לכל חיי השירות, כך ש---single מ-cron לא ירוץ במקביל למתזמן
+        _service_lock_fd = lock_fd
 
         if not check_permissions():
             log_message("שגיאה: לא ניתן להגדיר הרשאות נדרשות")
             return False
 
         log_message("התחלת מעקב אחר שינויים...")
-        event_handler = ConfigFileHandler()
-        observer = Observer()
-        observer.schedule(event_handler, CONFIG_WATCH_DIR, recursive=False)
-        observer.start()
+        observer = start_observer()
+        get_poll_scheduler().start()
         return observer
     except Exception as e:
         log_message(f"שגיאה בהפעלת Watcher: {str(e)}")
         return None
 
-# הפעלת Watcher כשמריצים עם Gunicorn
-if FLASK_AVAILABLE:
-    observer = start_watcher()
-
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--single':
+        LOG_FILE = SINGLE_LOG_FILE
     current_user = getpass.getuser()
     log_message(f"הסקריפט רץ תחת המשתמש: {current_user}")
     if FLASK_AVAILABLE and len(sys.argv) > 1 and sys.argv[1] == '--api':
-        app.run(host='0.0.0.0', port=5000)
+        create_app().run(host='0.0.0.0', port=5000)
     else:
         sys.exit(0 if main() else 1)
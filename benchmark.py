@@ -0,0 +1,707 @@
+#!/usr/bin/python3
+"""מדידת ביצועים של תהליך הפריסה מול שרת GitHub מקומי מדומה, בלי גישה ל-GitHub האמיתי.
+
+השרת מגיש מאגרים סינתטיים (מספר קבצים, גודל, עומק היסטוריה וקבצים לכל קומיט ניתנים להגדרה),
+עם השהיה ומגבלת קצב מוזרקות. כל תרחיש רץ בתהליך נפרד, כך שזיכרון השיא נמדד לכל תרחיש בנפרד.
+
+שימוש:
+    python3 benchmark.py [--files 500] [--file-size 4096] [--depth 20] [--files-per-commit 5]
+                         [--configs 20] [--repos 0] [--incremental-commits 5] [--concurrency 4]
+                         [--transport zip|git] [--latency-ms 20] [--rate-limit 5000]
+                         [--output results.json] [--baseline old.json]
+
+תרחישים: cold_full (פריסה מלאה ראשונה), incremental (פריסה אחרי N קומיטים),
+noop_sweep (בדיקה תקופתית של M הגדרות בלי שינויים), concurrent_deploy (קריאות /deploy מקבילות).
+
+עם --transport git כל מאגר סינתטי נכתב גם למאגר bare מקומי (file://), ונספרות פקודות ה-git
+שפונות למאגר המרוחק (ls-remote, fetch) במקום בקשות ה-API.
+"""
+import os
+import io
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import zipfile
+import argparse
+import tempfile
+import platform
+import threading
+import subprocess
+import http.server
+import urllib.request
+from collections import Counter, OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+SCENARIOS = ('cold_full', 'incremental', 'noop_sweep', 'concurrent_deploy')
+REPO_OWNER = 'bench'
+
+
+def blob_sha(data):
+    """מזהה ה-blob של git עבור תוכן נתון"""
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+
+class SyntheticRepo:
+    """מאגר סינתטי בזיכרון: רשימת קומיטים על ענף אחד, כל קומיט עם תמונת מצב מלאה של הקבצים"""
+
+    def __init__(self, name, files, file_size, depth, files_per_commit, seed, branch='main'):
+        self.name = name
+        self.branch = branch
+        self.file_size = file_size
+        self.files_per_commit = files_per_commit
+        self.seed = seed
+        self.blobs = {}
+        self.commits = []  # רשימת (sha, תמונת מצב נתיב -> blob, שינויים נתיב -> סטטוס)
+        self.index = {}
+        self.git_dir = None  # מאגר bare מקומי עבור transport=git
+        self.git_exported = 0
+        self._lock = threading.Lock()
+        rng = self._rng(0)
+        snapshot = {}
+        for i in range(files):
+            snapshot[f"dir{i % 20}/sub{i % 7}/file{i}.txt"] = self._add_blob(rng)
+        self._add_commit(snapshot, {path: 'added' for path in snapshot})
+        self.advance(depth - 1)
+        self.initial_depth = len(self.commits)
+
+    def _rng(self, number):
+        return random.Random(f"{self.seed}:{self.name}:{number}")
+
+    def _add_blob(self, rng):
+        data = rng.randbytes(self.file_size)
+        sha = blob_sha(data)
+        self.blobs[sha] = data
+        return sha
+
+    def _add_commit(self, snapshot, changes):
+        parent = self.commits[-1][0] if self.commits else ''
+        sha = hashlib.sha1(f"{parent}:{len(self.commits)}:{self.seed}:{self.name}".encode()).hexdigest()
+        self.index[sha] = len(self.commits)
+        self.commits.append((sha, snapshot, changes))
+
+    def advance(self, count):
+        """מוסיף קומיטים לענף: בעיקר שינוי קבצים קיימים, ומדי פעם הוספה או מחיקה"""
+        with self._lock:
+            for _ in range(count):
+                rng = self._rng(len(self.commits))
+                snapshot = dict(self.commits[-1][1])
+                changes = {}
+                for path in rng.sample(sorted(snapshot), min(self.files_per_commit, len(snapshot))):
+                    snapshot[path] = self._add_blob(rng)
+                    changes[path] = 'modified'
+                roll = rng.random()
+                if roll < 0.1:
+                    path = f"added/c{len(self.commits)}.txt"
+                    snapshot[path] = self._add_blob(rng)
+                    changes[path] = 'added'
+                elif roll < 0.2 and len(snapshot) > 1:
+                    path = rng.choice(sorted(set(snapshot) - set(changes)))
+                    del snapshot[path]
+                    changes[path] = 'removed'
+                self._add_commit(snapshot, changes)
+            if self.git_dir:
+                self._export_git()
+
+    def init_git(self, path):
+        """יוצר מאגר bare עם כל הקומיטים הקיימים. מחזיר את כתובת ה-file:// שלו"""
+        subprocess.run(['git', 'init', '--bare', '--quiet', path], check=True)
+        with self._lock:
+            self.git_dir = path
+            self._export_git()
+            self.git_initial_head = self._git(['rev-parse', f"refs/heads/{self.branch}"]).strip()
+        return f"file://{path}"
+
+    def _git(self, args, **kwargs):
+        return subprocess.run(['git', '--git-dir', self.git_dir] + args, check=True,
+                              stdout=subprocess.PIPE, **kwargs).stdout.decode()
+
+    def _export_git(self):
+        """כותב למאגר ה-bare את הקומיטים שעוד לא נכתבו, ב-git fast-import"""
+        stream = io.BytesIO()
+        for number in range(self.git_exported, len(self.commits)):
+            _, snapshot, changes = self.commits[number]
+            message = f"commit {number}".encode()
+            # זמן קבוע לכל קומיט, כך שאחרי reset נוצרים מחדש אותם מזהים
+            stream.write(f"commit refs/heads/{self.branch}\n"
+                         f"committer Bench <bench@example.com> {1700000000 + number} +0000\n"
+                         f"data {len(message)}\n".encode() + message + b"\n")
+            if number and number == self.git_exported:
+                stream.write(f"from refs/heads/{self.branch}^0\n".encode())
+            for path, status in sorted(changes.items()):
+                if status == 'removed':
+                    stream.write(f"D {path}\n".encode())
+                else:
+                    data = self.blobs[snapshot[path]]
+                    stream.write(f"M 100644 inline {path}\ndata {len(data)}\n".encode() + data + b"\n")
+            stream.write(b"\n")
+        if stream.tell():
+            self._git(['fast-import', '--quiet'], input=stream.getvalue())
+        self.git_exported = len(self.commits)
+
+    def reset(self):
+        """מחזיר את הענף למצב ההתחלתי (הקומיטים נוצרים מחדש באופן זהה)"""
+        with self._lock:
+            for sha, _, _ in self.commits[self.initial_depth:]:
+                del self.index[sha]
+            del self.commits[self.initial_depth:]
+            if self.git_dir:
+                self._git(['update-ref', f"refs/heads/{self.branch}", self.git_initial_head])
+                self.git_exported = len(self.commits)
+
+    @property
+    def head(self):
+        return self.commits[-1][0]
+
+    def resolve(self, ref):
+        """מחזיר את אינדקס הקומיט של ענף או מזהה, או None"""
+        if ref == self.branch or ref == f"refs/heads/{self.branch}":
+            return len(self.commits) - 1
+        return self.index.get(ref)
+
+    def diff(self, base, head):
+        old, new = self.commits[base][1], self.commits[head][1]
+        files = []
+        for path in sorted(set(old) | set(new)):
+            if path not in new:
+                files.append({'filename': path, 'status': 'removed'})
+            elif path not in old:
+                files.append({'filename': path, 'status': 'added', 'sha': new[path]})
+            elif old[path] != new[path]:
+                files.append({'filename': path, 'status': 'modified', 'sha': new[path]})
+        return files
+
+    def archive(self, number, ref):
+        """ארכיון ZIP של קומיט, במבנה של GitHub (תיקיית שורש אחת)"""
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+            for path, sha in sorted(self.commits[number][1].items()):
+                zf.writestr(f"{self.name}-{ref}/{path}", self.blobs[sha])
+        return buffer.getvalue()
+
+
+class QuietHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # חיבורים פתוחים (keep-alive) נסגרים בכוח כשתהליך התרחיש מסתיים
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeGitHub:
+    """שרת HTTP מקומי שמחקה את ה-endpoints של GitHub ש-app.py משתמש בהם, וסופר בקשות ובתים"""
+
+    def __init__(self, repos, latency=0.0, rate_limit=0):
+        self.repos = {repo.name: repo for repo in repos}
+        self.latency = latency
+        self.rate_limit = rate_limit  # מספר בקשות API לכל טוקן בשעה; 0 = ללא הגבלה
+        self.archives = OrderedDict()
+        self._lock = threading.Lock()
+        self.reset_stats()
+        self.reset_rate_limits()
+        handler = type('Handler', (FakeGitHubHandler,), {'server_state': self})
+        self.httpd = QuietHTTPServer(('127.0.0.1', 0), handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls = Counter()
+            self.stats = Counter()
+
+    def reset_rate_limits(self):
+        with self._lock:
+            self.used = Counter()
+            self.window_reset = int(time.time()) + 3600
+
+    def snapshot(self):
+        with self._lock:
+            return {'calls': dict(self.calls), **dict(self.stats)}
+
+    def count(self, endpoint, status, size, token, api):
+        with self._lock:
+            self.calls[endpoint] += 1
+            self.stats['requests'] += 1
+            self.stats['bytes_sent'] += size
+            if status == 304:
+                self.stats['not_modified'] += 1
+            if endpoint == 'rate_limited':
+                self.stats['rate_limited'] += 1
+            # כמו ב-GitHub: תשובות 304 והורדות ארכיון לא נספרות במכסת ה-API
+            if api and status != 304:
+                self.stats['api_requests'] += 1
+
+    def take_rate_limit(self, token):
+        """מחזיר (מותר, נותר)"""
+        with self._lock:
+            if not self.rate_limit:
+                return True, None
+            if self.used[token] >= self.rate_limit:
+                return False, 0
+            self.used[token] += 1
+            return True, self.rate_limit - self.used[token]
+
+    def refund_rate_limit(self, token):
+        with self._lock:
+            if self.rate_limit and self.used[token]:
+                self.used[token] -= 1
+
+    def archive(self, repo, number, ref):
+        key = (repo.name, repo.commits[number][0])
+        with self._lock:
+            data = self.archives.get(key)
+            if data is not None:
+                self.archives.move_to_end(key)
+                return data
+        data = repo.archive(number, ref)
+        with self._lock:
+            self.archives[key] = data
+            while len(self.archives) > 8:
+                self.archives.popitem(last=False)
+        return data
+
+
+class FakeGitHubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, endpoint, status, body=b'', content_type='application/json', headers=None, api=False):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        self.server_state.count(endpoint, status, len(body), self.token, api)
+
+    def do_POST(self):
+        # endpoints לשליטה מהתהליך של התרחיש
+        state = self.server_state
+        length = int(self.headers.get('Content-Length') or 0)
+        data = json.loads(self.rfile.read(length) or b'{}')
+        path = urlparse(self.path).path
+        if path == '/_bench/advance':
+            state.repos[data['repo']].advance(int(data['commits']))
+        elif path == '/_bench/reset-stats':
+            # המדידה (כולל חלון מגבלת הקצב) מתחילה אחרי שלב ההכנה של התרחיש
+            state.reset_stats()
+            state.reset_rate_limits()
+        else:
+            self.send_error(404)
+            return
+        body = b'{}'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        state = self.server_state
+        self.token = (self.headers.get('Authorization') or '').replace('token ', '') or 'anonymous'
+        if state.latency:
+            time.sleep(state.latency)
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        match = re.match(r'^/repos/([^/]+)/([^/]+)/(.+)$', parsed.path)
+        if match:
+            repo = state.repos.get(match.group(2))
+            if repo is None:
+                return self.reply('not_found', 404, {'message': 'Not Found'})
+            allowed, remaining = state.take_rate_limit(self.token)
+            headers = {}
+            if state.rate_limit:
+                headers = {'X-RateLimit-Limit': str(state.rate_limit),
+                           'X-RateLimit-Remaining': str(remaining),
+                           'X-RateLimit-Reset': str(state.window_reset)}
+            if not allowed:
+                return self.reply('rate_limited', 403, {'message': 'API rate limit exceeded'}, headers=headers)
+            return self.api(repo, match.group(3), query, headers)
+        match = re.match(r'^/([^/]+)/([^/]+)/archive/(.+)\.zip$', parsed.path)
+        if match:
+            repo = state.repos.get(match.group(2))
+            number = repo.resolve(match.group(3)) if repo else None
+            if number is None:
+                return self.reply('not_found', 404, b'Not Found', 'text/plain')
+            ref = match.group(3).replace('refs/heads/', '')
+            return self.reply('archive', 200, state.archive(repo, number, ref), 'application/zip')
+        self.reply('not_found', 404, b'Not Found', 'text/plain')
+
+    def api(self, repo, rest, query, headers):
+        state = self.server_state
+        match = re.match(r'^commits/([^/]+)$', rest)
+        if match:
+            number = repo.resolve(match.group(1))
+            if number is None:
+                return self.reply('commit', 422, {'message': 'No commit found'}, headers=headers, api=True)
+            sha = repo.commits[number][0]
+            etag = f'"{sha}"'
+            headers = {**headers, 'ETag': etag}
+            if self.headers.get('If-None-Match') == etag:
+                state.refund_rate_limit(self.token)
+                return self.reply('commit_head', 304, headers=headers, api=True)
+            if 'sha' in (self.headers.get('Accept') or ''):
+                return self.reply('commit_head', 200, sha.encode(), 'text/plain', headers, api=True)
+            snapshot = repo.commits[number][1]
+            files = [{'filename': path, 'status': status, **({'sha': snapshot[path]} if path in snapshot else {})}
+                     for path, status in sorted(repo.commits[number][2].items())]
+            return self.reply('commit', 200, {'sha': sha, 'files': files}, headers=headers, api=True)
+        if rest == 'commits':
+            number = repo.resolve(query.get('sha', [repo.branch])[0])
+            per_page = int(query.get('per_page', ['30'])[0])
+            page = int(query.get('page', ['1'])[0])
+            end = number + 1 - (page - 1) * per_page
+            shas = [repo.commits[i][0] for i in range(end - 1, max(end - per_page, 0) - 1, -1)] if end > 0 else []
+            return self.reply('commits_list', 200, [{'sha': sha} for sha in shas], headers=headers, api=True)
+        match = re.match(r'^compare/([0-9a-f]+)\.\.\.([^/]+)$', rest)
+        if match:
+            base, head = repo.resolve(match.group(1)), repo.resolve(match.group(2))
+            if base is None or head is None:
+                return self.reply('compare', 404, {'message': 'Not Found'}, headers=headers, api=True)
+            status = 'identical' if base == head else 'ahead' if base < head else 'behind'
+            return self.reply('compare', 200, {'status': status, 'files': repo.diff(base, head)}, headers=headers, api=True)
+        match = re.match(r'^git/trees/([^/]+)$', rest)
+        if match:
+            number = repo.resolve(match.group(1))
+            if number is None:
+                return self.reply('tree', 404, {'message': 'Not Found'}, headers=headers, api=True)
+            tree = [{'path': path, 'mode': '100644', 'type': 'blob', 'sha': sha, 'size': len(repo.blobs[sha])}
+                    for path, sha in sorted(repo.commits[number][1].items())]
+            return self.reply('tree', 200, {'sha': repo.commits[number][0], 'tree': tree, 'truncated': False},
+                              headers=headers, api=True)
+        match = re.match(r'^git/blobs/([0-9a-f]+)$', rest)
+        if match and match.group(1) in repo.blobs:
+            return self.reply('blob', 200, repo.blobs[match.group(1)], 'application/octet-stream', headers, api=True)
+        self.reply('not_found', 404, {'message': 'Not Found'}, headers=headers, api=True)
+
+
+GIT_REMOTE_COMMANDS = ('ls-remote', 'fetch', 'clone')
+git_calls = Counter()
+
+
+def count_git_calls(app):
+    """עוטף את run_git של app.py וסופר פקודות git לפי סוג (transport=git לא עובר בשרת המדומה)"""
+    run_git = app.run_git
+
+    def counting_run_git(ctx, args, **kwargs):
+        rest = list(args)
+        while rest and rest[0] == '-C':
+            rest = rest[2:]
+        git_calls[rest[0] if rest else ''] += 1
+        return run_git(ctx, args, **kwargs)
+
+    app.run_git = counting_run_git
+
+
+def reset_stats(server):
+    """מאפס את המדידה בשרת ואת מוני ה-git, אחרי שלב ההכנה של התרחיש"""
+    post(f"{server}/_bench/reset-stats", {})
+    git_calls.clear()
+
+
+def post(url, data):
+    request = urllib.request.Request(url, data=json.dumps(data).encode(), method='POST',
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        response.read()
+
+
+def configure_app(spec):
+    """מייבא את app.py ומפנה את כל הנתיבים והכתובות לתיקיית העבודה ולשרת המדומה"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    start = time.perf_counter()
+    import app
+    spec['import_time'] = round(time.perf_counter() - start, 4)
+    import grp
+    import pwd
+    workdir = spec['workdir']
+    paths = {
+        'BASE_DIR': workdir,
+        'CONFIG_WATCH_DIR': os.path.join(workdir, 'pending'),
+        'CONFIG_PROCESSED_DIR': os.path.join(workdir, 'processed'),
+        'LOG_FILE': os.path.join(workdir, 'log.log'),
+        'STATE_DB': os.path.join(workdir, 'state.db'),
+        'MIRRORS_DIR': os.path.join(workdir, 'mirrors'),
+        'BLOB_CACHE_DIR': os.path.join(workdir, 'blobs'),
+        'WORKSPACE_ROOT': os.path.join(workdir, 'workspaces'),
+    }
+    for name, value in paths.items():
+        setattr(app, name, value)
+    for name in ('CONFIG_WATCH_DIR', 'CONFIG_PROCESSED_DIR', 'WORKSPACE_ROOT'):
+        os.makedirs(paths[name], exist_ok=True)
+    app.GITHUB_API_URL = spec['server']
+    app.GITHUB_URL = spec['server']
+    app.BLOB_CACHE_ENABLED = spec['blob_cache']
+    # הבעלות נשארת של המשתמש הנוכחי, כך שאין צורך ב-sudo
+    app.DEPLOY_OWNER = f"{pwd.getpwuid(os.getuid()).pw_name}:{grp.getgrgid(os.getgid()).gr_name}"
+    if spec['transport'] == 'git':
+        count_git_calls(app)
+    return app
+
+
+def write_configs(app, spec, count):
+    """יוצר count קבצי הגדרות ב-processed, עם נתיב פריסה נפרד לכל אחד. מחזיר את שמות הקבצים.
+    ההגדרות מתחלקות בין המאגרים לפי הסדר; הגדרות שחולקות מאגר מתקבצות לבדיקה ולהורדה אחת"""
+    names = []
+    for i in range(count):
+        name = f"bench{i}.json"
+        repo_name = spec['repos'][i % len(spec['repos'])]
+        config = {
+            'repo_owner': REPO_OWNER,
+            'repo_name': repo_name,
+            'branch': 'main',
+            'deploy_path': os.path.join(spec['workdir'], 'sites', f"site{i}"),
+            'update_only_changed_files': True,
+            'transport': spec['transport'],
+        }
+        if spec['repo_urls']:
+            config['repo_url'] = spec['repo_urls'][repo_name]
+        if spec['tokens']:
+            config['github_token'] = f"bench-token-{i % spec['tokens']}"
+        with open(os.path.join(app.CONFIG_PROCESSED_DIR, name), 'w') as f:
+            json.dump(config, f)
+        names.append(name)
+    return names
+
+
+def deploy_all(app, names):
+    contexts = [app.load_config(os.path.join(app.CONFIG_PROCESSED_DIR, name)) for name in names]
+    return all(app.deploy_latest_version(ctx) for ctx in contexts)
+
+
+def run_scenario(spec):
+    """מריץ תרחיש אחד (בתהליך הבן) ומחזיר את התוצאה שנמדדה בצד הלקוח"""
+    app = configure_app(spec)
+    scenario = spec['scenario']
+    server = spec['server']
+    result = {'deploys': 0, 'import_time': spec['import_time']}
+
+    if scenario == 'cold_full':
+        names = write_configs(app, spec, 1)
+        reset_stats(server)
+        start = time.perf_counter()
+        success = deploy_all(app, names)
+        result['deploys'] = 1
+        result['configs'] = len(names)
+    elif scenario == 'incremental':
+        names = write_configs(app, spec, 1)
+        deploy_all(app, names)
+        post(f"{server}/_bench/advance", {'repo': spec['repos'][0], 'commits': spec['incremental_commits']})
+        reset_stats(server)
+        start = time.perf_counter()
+        success = deploy_all(app, names)
+        result['deploys'] = 1
+        result['configs'] = len(names)
+    elif scenario == 'noop_sweep':
+        names = write_configs(app, spec, spec['configs'])
+        deploy_all(app, names)
+        reset_stats(server)
+        start = time.perf_counter()
+        success = app.check_processed_configs()
+        result['configs'] = len(names)
+    elif scenario == 'concurrent_deploy':
+        if not getattr(app, 'FLASK_AVAILABLE', False):
+            return {'skipped': 'Flask is not installed'}
+        names = write_configs(app, spec, spec['concurrency'])
+        client = app.create_app(watch=False).test_client()
+        statuses = []
+        reset_stats(server)
+        start = time.perf_counter()
+
+        def call(name):
+            statuses.append(client.get(f"/deploy/{name}").status_code)
+
+        threads = [threading.Thread(target=call, args=(name,)) for name in names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # כמו ה-Watcher: כל קובץ שהועבר ל-pending נכנס לתור הפריסות
+        futures = [app.deploy_queue.enqueue_config_file(os.path.join(app.CONFIG_WATCH_DIR, name))
+                   for name in names]
+        success = all(status == 200 for status in statuses) and all(future.result() for future in futures)
+        result['deploys'] = len(names)
+        result['configs'] = len(names)
+    else:
+        raise ValueError(f"תרחיש לא מוכר: {scenario}")
+
+    result['wall_time'] = round(time.perf_counter() - start, 4)
+    result['success'] = bool(success)
+    if spec['transport'] == 'git':
+        result['git_calls'] = dict(git_calls)
+        result['git_requests'] = sum(git_calls[command] for command in GIT_REMOTE_COMMANDS)
+    return result
+
+
+def peak_rss_kb():
+    import resource
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+def child_main(spec_json):
+    spec = json.loads(spec_json)
+    try:
+        result = run_scenario(spec)
+    except Exception as e:
+        result = {'success': False, 'error': f"{type(e).__name__}: {e}"}
+    result['peak_rss_kb'] = peak_rss_kb()
+    with open(spec['result_file'], 'w') as f:
+        json.dump(result, f)
+    # יציאה מיידית, בלי להמתין ל-threads של הפריסות והלוג
+    os._exit(0)
+
+
+def run_child(spec, verbose):
+    """מריץ תרחיש בתהליך נפרד ומחזיר את התוצאה שלו"""
+    log_path = os.path.join(spec['workdir'], 'output.log')
+    with open(log_path, 'w') as output:
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', json.dumps(spec)],
+                                 stdout=None if verbose else output, stderr=subprocess.STDOUT if not verbose else None)
+    try:
+        with open(spec['result_file']) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'success': False, 'error': f"התהליך הסתיים בקוד {process.returncode}, ראה {log_path}"}
+
+
+def compare_with_baseline(results, baseline_path):
+    """מדפיס את ההפרש בזמן ובמספר הבקשות מול קובץ תוצאות קודם"""
+    with open(baseline_path) as f:
+        baseline = {item['scenario']: item for item in json.load(f).get('scenarios', [])}
+    print(f"\nהשוואה מול {baseline_path}:")
+    for item in results['scenarios']:
+        old = baseline.get(item['scenario'])
+        if not old or 'wall_time' not in old or 'wall_time' not in item:
+            continue
+        ratio = item['wall_time'] / old['wall_time'] if old['wall_time'] else float('inf')
+        print(f"  {item['scenario']:<18} זמן {old['wall_time']:.3f} -> {item['wall_time']:.3f} ({ratio:.2f}x), "
+              f"בקשות {old.get('requests', 0)} -> {item.get('requests', 0)} "
+              f"({old.get('requests_per_config', '-')} -> {item.get('requests_per_config', '-')} להגדרה), "
+              f"בתים {old.get('bytes_sent', 0)} -> {item.get('bytes_sent', 0)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='מדידת ביצועים של הפריסה מול שרת GitHub מדומה')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"רשימה מופרדת בפסיקים מתוך: {', '.join(SCENARIOS)}")
+    parser.add_argument('--files', type=int, default=500, help='מספר הקבצים במאגר')
+    parser.add_argument('--file-size', type=int, default=4096, help='גודל כל קובץ (בתים)')
+    parser.add_argument('--depth', type=int, default=20, help='מספר הקומיטים בהיסטוריה ההתחלתית')
+    parser.add_argument('--files-per-commit', type=int, default=5, help='מספר הקבצים שמשתנים בכל קומיט')
+    parser.add_argument('--repos', type=int, default=0,
+                        help='מספר המאגרים (ההגדרות מתחלקות ביניהם; 0 = מאגר נפרד לכל הגדרה)')
+    parser.add_argument('--configs', type=int, default=20, help='מספר ההגדרות בתרחיש noop_sweep')
+    parser.add_argument('--incremental-commits', type=int, default=5, help='מספר הקומיטים החדשים בתרחיש incremental')
+    parser.add_argument('--concurrency', type=int, default=4, help='מספר קריאות /deploy מקבילות')
+    parser.add_argument('--tokens', type=int, default=0, help='מספר הטוקנים השונים בהגדרות (0 = ללא טוקן)')
+    parser.add_argument('--transport', default='zip', choices=('zip', 'git'),
+                        help='שיטת ההורדה: zip (ארכיון ו-API מהשרת המדומה) או git (מאגר bare מקומי)')
+    parser.add_argument('--no-blob-cache', action='store_true', help='ביטול מטמון ה-blobs')
+    parser.add_argument('--latency-ms', type=float, default=0, help='השהיה לכל בקשה (מילישניות)')
+    parser.add_argument('--rate-limit', type=int, default=0, help='מכסת בקשות API לכל טוקן (0 = ללא הגבלה)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='benchmark-results.json', help='קובץ JSON לשמירת התוצאות')
+    parser.add_argument('--baseline', help='קובץ תוצאות קודם להשוואה')
+    parser.add_argument('--keep', action='store_true', help='לא למחוק את תיקיות העבודה')
+    parser.add_argument('--verbose', action='store_true', help='הצגת הלוג של app.py')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child_main(args.child)
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"תרחישים לא מוכרים: {', '.join(sorted(unknown))}")
+
+    repo_count = args.repos or max(args.configs, args.concurrency, 1)
+    print(f"יוצר {repo_count} מאגרים סינתטיים ({args.files} קבצים, {args.depth} קומיטים)...")
+    repos = [SyntheticRepo(f"repo{i}", args.files, args.file_size, args.depth, args.files_per_commit, args.seed)
+             for i in range(repo_count)]
+    git_root = None
+    repo_urls = {}
+    if args.transport == 'git':
+        git_root = tempfile.mkdtemp(prefix='cornget-bench-git-')
+        repo_urls = {repo.name: repo.init_git(os.path.join(git_root, f"{repo.name}.git")) for repo in repos}
+    server = FakeGitHub(repos, args.latency_ms / 1000, args.rate_limit).start()
+    params = {name: value for name, value in vars(args).items()
+              if name not in ('child', 'output', 'baseline', 'keep', 'verbose', 'scenarios')}
+    results = {
+        'params': params,
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'scenarios': [],
+    }
+    try:
+        for scenario in scenarios:
+            for repo in repos:
+                repo.reset()
+            server.reset_rate_limits()
+            workdir = tempfile.mkdtemp(prefix=f"cornget-bench-{scenario}-")
+            spec = {
+                'scenario': scenario,
+                'server': server.url,
+                'workdir': workdir,
+                'result_file': os.path.join(workdir, 'result.json'),
+                'repos': [repo.name for repo in repos],
+                'configs': args.configs,
+                'incremental_commits': args.incremental_commits,
+                'concurrency': args.concurrency,
+                'tokens': args.tokens,
+                'transport': args.transport,
+                'repo_urls': repo_urls,
+                'blob_cache': not args.no_blob_cache,
+            }
+            print(f"מריץ {scenario}...")
+            result = run_child(spec, args.verbose)
+            item = {'scenario': scenario, **result, **server.snapshot()}
+            item['requests'] = item.get('requests', 0) + item.get('git_requests', 0)
+            if item.get('configs'):
+                item['requests_per_config'] = round(item['requests'] / item['configs'], 2)
+            results['scenarios'].append(item)
+            if 'error' in item:
+                print(f"  שגיאה: {item['error']}")
+            elif 'skipped' in item:
+                print(f"  דולג: {item['skipped']}")
+            else:
+                print(f"  {'הצליח' if item['success'] else 'נכשל'}: {item['wall_time']:.3f} שניות, "
+                      f"{item.get('requests', 0)} בקשות ({item.get('requests_per_config', 0)} להגדרה, "
+                      f"{item.get('api_requests', 0)} API, {item.get('git_requests', 0)} git, "
+                      f"{item.get('not_modified', 0)} 304, {item.get('rate_limited', 0)} חסומות), {item.get('bytes_sent', 0)} בתים, "
+                      f"זיכרון שיא {item['peak_rss_kb']} KB")
+            if args.keep:
+                print(f"  תיקיית העבודה: {workdir}")
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        server.stop()
+        if git_root:
+            shutil.rmtree(git_root, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"התוצאות נשמרו ב-{args.output}")
+    if args.baseline:
+        compare_with_baseline(results, args.baseline)
+    return all(item.get('success') or 'skipped' in item for item in results['scenarios'])
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
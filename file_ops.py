@@ -0,0 +1,369 @@
+#!/usr/bin/python3
+"""ביצוע רשימת פעולות קבצים (העברה, מחיקה, שינוי בעלות) בתהליך אחד.
+
+app.py מריץ את הפעולות ישירות; פעולות שנכשלו בגלל הרשאות נשלחות יחד,
+בהרצה אחת דרך sudo, לעותק של הסקריפט שמותקן בתיקייה של root בלבד:
+    sudo -n python3 /usr/local/lib/cornget/file_ops.py < ops.json
+
+פורמט הקלט: {"owner": "www-data:www-data", "ops": [{"op": "move", "src": ..., "dst": ...}, ...]}
+פעולות: move (src, dst), remove (path, prune_root), rmtree (path), chown (path), mkdir (path),
+symlink_switch (path, target, legacy) - החלפה אטומית של קישור סימבולי; תיקייה קיימת בנתיב מועברת ל-legacy
+
+בהרצה דרך sudo כל פעולה נבדקת מול מדיניות ב-POLICY_FILE (קובץ של root): יעדים רק בתוך deploy_roots,
+מקורות העברה רק בתיקיות עבודה בתוך workspace_roots, בלי '..' ובלי קישורים סימבוליים בתיקיות האב,
+ושינוי בעלות רק ל-owner שבמדיניות. כל פעולה נבדקת מיד לפני ביצועה, והיא מתבצעת יחסית לתיקיית האב
+שנפתחה רכיב אחר רכיב בלי לעקוב אחרי קישורים סימבוליים (parent_dir), ולא לפי הנתיב שנבדק.
+"""
+import os
+import sys
+import json
+import stat
+import errno
+import shutil
+import contextlib
+import tempfile
+
+try:
+    import grp
+    import pwd
+except ImportError:  # Windows - אין שינוי בעלות
+    grp = pwd = None
+
+POLICY_FILE = '/etc/cornget/file_ops.json'
+DEFAULT_POLICY = {
+    'deploy_roots': ['/var/www/html'],  # תיקיות שבתוכן מותר לכתוב, למחוק ולשנות בעלות
+    'exclude_roots': ['/var/www/html/CornGetFromGit'],  # תיקיות אסורות בתוך deploy_roots
+    'workspace_roots': [tempfile.gettempdir()],  # תיקיות שמהן מותר להעביר קבצים (WORKSPACE_ROOT ב-app.py)
+    'owner': 'www-data:www-data',  # הבעלים היחיד שמותר להעביר אליו קבצים
+}
+WORKSPACE_PREFIX = 'cornget-'  # כמו WORKSPACE_PREFIX ב-app.py
+
+
+def resolve_owner(owner):
+    """ממיר 'user:group' ל-(uid, gid); None אם המשתמש או הקבוצה לא קיימים"""
+    if not owner or pwd is None:
+        return None
+    user, _, group = owner.partition(':')
+    try:
+        uid = pwd.getpwnam(user).pw_uid
+        gid = grp.getgrnam(group).gr_gid if group else pwd.getpwnam(user).pw_gid
+    except KeyError:
+        return None
+    return uid, gid
+
+
+DIR_FD_SUPPORTED = os.open in os.supports_dir_fd and hasattr(os, 'O_NOFOLLOW')
+OPEN_DIR_FLAGS = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) | getattr(os, 'O_NOFOLLOW', 0)
+
+
+@contextlib.contextmanager
+def parent_dir(path, create=False):
+    """פותח את תיקיית האב של נתיב מוחלט רכיב אחר רכיב מהשורש, בלי לעקוב אחרי קישורים סימבוליים,
+    ומחזיר (dir_fd, שם הרכיב האחרון, תיקיות שנוצרו). הפעולה עצמה מתבצעת יחסית ל-dir_fd, כך שהחלפת
+    תיקיית אב בקישור סימבולי אחרי הבדיקה לא מפנה אותה למקום אחר. create=True יוצר תיקיות אב חסרות.
+    במערכת בלי dir_fd (Windows) מוחזר הנתיב המלא ו-dir_fd=None"""
+    path = os.path.normpath(path)
+    if not DIR_FD_SUPPORTED:
+        created = make_parents(path) if create else []
+        yield None, path, created
+        return
+    parts = [part for part in path.split(os.sep) if part]
+    if not parts:
+        raise ValueError(f"נתיב לא חוקי: {path!r}")
+    created = []
+    current = os.sep
+    fd = os.open(os.sep, OPEN_DIR_FLAGS)
+    try:
+        for part in parts[:-1]:
+            current = os.path.join(current, part)
+            if create:
+                try:
+                    os.mkdir(part, dir_fd=fd)
+                    created.append(current)
+                except FileExistsError:
+                    pass
+            try:
+                next_fd = os.open(part, OPEN_DIR_FLAGS, dir_fd=fd)
+            except OSError as e:
+                if e.errno in (errno.ENOTDIR, errno.ELOOP) and os.path.islink(current):
+                    raise ValueError(f"קישור סימבולי בנתיב: {path}") from e
+                raise
+            os.close(fd)
+            fd = next_fd
+        yield fd, parts[-1], created
+    finally:
+        os.close(fd)
+
+
+def make_parents(path):
+    """יוצר את תיקיות האב של הנתיב ומחזיר את התיקיות שנוצרו (כשאין תמיכה ב-dir_fd)"""
+    created = []
+    parent = os.path.dirname(path)
+    while parent and not os.path.isdir(parent):
+        created.append(parent)
+        parent = os.path.dirname(parent)
+    for directory in reversed(created):
+        try:
+            os.mkdir(directory)
+        except FileExistsError:
+            pass
+    return created
+
+
+def lstat_at(dir_fd, name):
+    """lstat יחסי לתיקייה; None אם הקובץ לא קיים"""
+    try:
+        return os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+    except FileNotFoundError:
+        return None
+
+
+def remove_tree(dir_fd, name):
+    """מוחק תיקייה יחסית לתיקיית האב (rmtree עם dir_fd נתמך מ-Python 3.11)"""
+    if dir_fd is not None and sys.version_info >= (3, 11):
+        shutil.rmtree(name, dir_fd=dir_fd)
+    elif dir_fd is None:
+        shutil.rmtree(name)
+    else:
+        shutil.rmtree(os.path.join(f"/proc/self/fd/{dir_fd}", name))
+
+
+def copy_file_at(src_fd, src_name, dst_fd, dst_name):
+    """מעתיק קובץ או קישור סימבולי (עם ההרשאות וזמני השינוי) בין שתי תיקיות שנפתחו"""
+    st = os.stat(src_name, dir_fd=src_fd, follow_symlinks=False)
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(src_name, dir_fd=src_fd), dst_name, dir_fd=dst_fd)
+        return
+    nofollow = getattr(os, 'O_NOFOLLOW', 0)
+    with open(os.open(src_name, os.O_RDONLY | nofollow, dir_fd=src_fd), 'rb') as src, \
+            open(os.open(dst_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL | nofollow,
+                         stat.S_IMODE(st.st_mode), dir_fd=dst_fd), 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+        dst.flush()
+        # שינוי לפי ה-fd הפתוח ולא לפי שם, שאפשר להחליף בקישור סימבולי
+        if hasattr(os, 'fchmod'):
+            os.fchmod(dst.fileno(), stat.S_IMODE(st.st_mode))
+        if os.utime in os.supports_fd:
+            os.utime(dst.fileno(), ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def place_file(src_fd, src_name, dst_fd, dst_name):
+    """מעביר קובץ ליעד בהחלפה אטומית; בין מערכות קבצים שונות - העתקה לקובץ זמני ליד היעד ואז החלפה"""
+    try:
+        os.replace(src_name, dst_name, src_dir_fd=src_fd, dst_dir_fd=dst_fd)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    tmp_name = f".{os.path.basename(dst_name)}.{os.getpid()}.tmp"
+    if dst_fd is None:
+        tmp_name = os.path.join(os.path.dirname(dst_name), tmp_name)
+    try:
+        copy_file_at(src_fd, src_name, dst_fd, tmp_name)
+        os.replace(tmp_name, dst_name, src_dir_fd=dst_fd, dst_dir_fd=dst_fd)
+    finally:
+        if lstat_at(dst_fd, tmp_name):
+            os.unlink(tmp_name, dir_fd=dst_fd)
+    os.unlink(src_name, dir_fd=src_fd)
+
+
+def prune_empty_dirs(path, root):
+    """מוחק תיקיות שהתרוקנו מעל הנתיב, עד תיקיית השורש (לא כולל)"""
+    parent = os.path.dirname(path)
+    while root and parent.startswith(root.rstrip(os.sep) + os.sep):
+        try:
+            with parent_dir(parent) as (fd, name, _):
+                os.rmdir(name, dir_fd=fd)
+        except (OSError, ValueError):
+            break
+        parent = os.path.dirname(parent)
+
+
+def apply_op(op, owner):
+    """מבצע פעולה אחת ומחזיר רשימת נתיבים שצריך לשנות את הבעלות עליהם"""
+    kind = op['op']
+    if kind == 'move':
+        with parent_dir(op['src']) as (src_fd, src_name, _), \
+                parent_dir(op['dst'], create=True) as (dst_fd, dst_name, created):
+            st = lstat_at(dst_fd, dst_name)
+            if st and stat.S_ISDIR(st.st_mode):
+                remove_tree(dst_fd, dst_name)  # קובץ שמחליף תיקייה באותו שם
+            place_file(src_fd, src_name, dst_fd, dst_name)
+        return created + [op['dst']] if owner else []
+    if kind == 'remove':
+        with parent_dir(op['path']) as (fd, name, _):
+            if lstat_at(fd, name):
+                os.unlink(name, dir_fd=fd)
+        # מחיקת תיקיות שהתרוקנו, עד תיקיית השורש שהועברה
+        prune_empty_dirs(os.path.normpath(op['path']), op.get('prune_root'))
+        return []
+    if kind == 'rmtree':
+        with parent_dir(op['path']) as (fd, name, _):
+            st = lstat_at(fd, name)
+            if st and stat.S_ISDIR(st.st_mode):
+                remove_tree(fd, name)
+            elif st:
+                os.unlink(name, dir_fd=fd)
+        return []
+    if kind == 'chown':
+        return [op['path']] if owner else []
+    if kind == 'mkdir':
+        with parent_dir(op['path'], create=True) as (fd, name, created):
+            try:
+                os.mkdir(name, dir_fd=fd)
+                created.append(os.path.normpath(op['path']))
+            except FileExistsError:
+                pass
+        return created if owner else []
+    if kind == 'symlink_switch':
+        created = []
+        with parent_dir(op['path']) as (fd, name, _):
+            st = lstat_at(fd, name)
+            if op.get('legacy') and st and stat.S_ISDIR(st.st_mode):
+                # מעבר ראשון למצב גרסאות: התיקייה הקיימת נשמרת ולא נמחקת
+                with parent_dir(op['legacy'], create=True) as (legacy_fd, legacy_name, created):
+                    os.rename(name, legacy_name, src_dir_fd=fd, dst_dir_fd=legacy_fd)
+            tmp_name = f"{name}.tmp-{os.getpid()}-{os.urandom(4).hex()}"
+            os.symlink(op['target'], tmp_name, dir_fd=fd)
+            try:
+                os.replace(tmp_name, name, src_dir_fd=fd, dst_dir_fd=fd)
+            except OSError:
+                os.unlink(tmp_name, dir_fd=fd)
+                raise
+        return created + [op['path']] if owner else []
+    raise ValueError(f"פעולה לא מוכרת: {kind}")
+
+
+def chown_path(path, owner, uid=None):
+    """משנה בעלות רק אם היא שונה מהנדרש, בלי לעקוב אחרי קישורים סימבוליים. הבדיקה והשינוי נעשים
+    על אותו קובץ פתוח (fstat/fchown); כש-uid ניתן (sudo), קובץ עם כמה קישורים קשיחים חייב להיות שלו"""
+    with parent_dir(path) as (fd, name, _):
+        try:
+            file_fd = os.open(name, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK | os.O_NOCTTY, dir_fd=fd)
+        except OSError as e:
+            if e.errno != errno.ELOOP:
+                raise
+            # קישור סימבולי - שינוי הבעלות על הקישור עצמו
+            st = os.stat(name, dir_fd=fd, follow_symlinks=False)
+            if (st.st_uid, st.st_gid) != owner:
+                os.chown(name, *owner, dir_fd=fd, follow_symlinks=False)
+            return
+        try:
+            st = os.fstat(file_fd)
+            if uid is not None and not stat.S_ISDIR(st.st_mode) and st.st_nlink > 1 and st.st_uid != uid:
+                raise ValueError(f"הקובץ {path} אינו של המשתמש המריץ")
+            if (st.st_uid, st.st_gid) != owner:
+                os.fchown(file_fd, *owner)
+        finally:
+            os.close(file_fd)
+
+
+def run_ops(ops, owner=None, check=None, uid=None):
+    """מבצע את הפעולות לפי הסדר. מחזיר (מספר הפעולות שהצליחו, רשימת (פעולה, שגיאה) שנכשלו).
+    check (בהרצה דרך sudo) בודק כל פעולה מול המדיניות מיד לפני ביצועה.
+    שינוי הבעלות מתבצע בסוף, רק על הקבצים והתיקיות שנכתבו"""
+    done = 0
+    failed = []
+    to_chown = []
+    for op in ops:
+        try:
+            if check:
+                check(op)
+            to_chown.extend(apply_op(op, owner))
+            done += 1
+        except (OSError, ValueError, KeyError) as e:
+            failed.append((op, e))
+    for path in dict.fromkeys(to_chown):
+        try:
+            chown_path(path, owner, uid)
+        except (OSError, ValueError) as e:
+            failed.append(({'op': 'chown', 'path': path}, e))
+    return done, failed
+
+
+def load_policy(path=POLICY_FILE):
+    """טוען את המדיניות; קובץ שאינו של root או שאחרים יכולים לכתוב אליו נדחה"""
+    policy = dict(DEFAULT_POLICY)
+    if os.path.exists(path):
+        st = os.stat(path)
+        if st.st_uid != 0 or st.st_mode & 0o022:
+            raise PermissionError(f"{path} חייב להיות של root ולא ניתן לכתיבה לאחרים")
+        with open(path) as f:
+            policy.update(json.load(f))
+    for key in ('deploy_roots', 'exclude_roots', 'workspace_roots'):
+        policy[key] = [os.path.realpath(root) for root in policy[key]]
+    return policy
+
+
+def is_within(path, root):
+    return path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+def check_path(path, roots, exclude=()):
+    """מוודא שהנתיב מוחלט, בלי '..', בלי קישורים סימבוליים בתיקיות האב, ובתוך אחת מתיקיות השורש.
+    הרכיב האחרון יכול להיות קישור סימבולי - הפעולות עליו (החלפה, מחיקה, lchown) לא עוקבות אחריו"""
+    if not isinstance(path, str) or not os.path.isabs(path) or '..' in path.split(os.sep):
+        raise ValueError(f"נתיב לא חוקי: {path!r}")
+    path = os.path.normpath(path)
+    parent = os.path.dirname(path)
+    if os.path.realpath(parent) != parent:
+        raise ValueError(f"קישור סימבולי בנתיב: {path}")
+    if not any(is_within(path, root) for root in roots) or any(path == root or is_within(path, root) for root in exclude):
+        raise ValueError(f"נתיב מחוץ לתיקיות המותרות: {path}")
+    return path
+
+
+def check_owned(path, uid):
+    """מקור העברה או קובץ עם כמה קישורים קשיחים חייבים להיות של המשתמש שהריץ את sudo,
+    כדי שלא ניתן יהיה להעביר או לשנות בעלות של קובץ מערכת דרך קישור קשיח"""
+    st = os.lstat(path)
+    if st.st_uid != uid:
+        raise ValueError(f"הקובץ {path} אינו של המשתמש המריץ")
+
+
+def validate_op(op, policy, uid):
+    """בודק פעולה אחת מול המדיניות; זורק ValueError אם היא אסורה"""
+    deploy = (policy['deploy_roots'], policy['exclude_roots'])
+    kind = op.get('op')
+    if kind == 'move':
+        src = check_path(op.get('src'), policy['workspace_roots'])
+        root = next(root for root in policy['workspace_roots'] if is_within(src, root))
+        if not os.path.relpath(src, root).startswith(WORKSPACE_PREFIX):
+            raise ValueError(f"המקור {src} אינו בתיקיית עבודה")
+        if not os.path.islink(src):
+            check_owned(src, uid)
+        check_path(op.get('dst'), *deploy)
+    elif kind == 'remove':
+        check_path(op.get('path'), *deploy)
+        if op.get('prune_root'):
+            check_path(op['prune_root'], *deploy)
+    elif kind == 'mkdir':
+        check_path(op.get('path'), *deploy)
+    elif kind == 'symlink_switch':
+        check_path(op.get('path'), *deploy)
+        check_path(op.get('target'), *deploy)
+        if op.get('legacy'):
+            check_path(op['legacy'], *deploy)
+    elif kind in ('rmtree', 'chown'):
+        # קובץ עם כמה קישורים קשיחים נבדק ב-chown_path, על הקובץ הפתוח
+        check_path(op.get('path'), *deploy)
+    else:
+        raise ValueError(f"פעולה לא מוכרת: {kind}")
+
+
+def main():
+    request = json.load(sys.stdin)
+    policy = load_policy()
+    if request.get('owner') and request['owner'] != policy['owner']:
+        json.dump({'done': 0, 'errors': [{'op': None, 'error': f"בעלים לא מורשה: {request['owner']}"}]}, sys.stdout)
+        return False
+    owner = resolve_owner(request.get('owner'))
+    uid = int(os.environ.get('SUDO_UID', os.getuid()))
+    # כל פעולה נבדקת מיד לפני ביצועה, ולא כולן מראש, כדי שפעולה קודמת לא תשנה נתיב שכבר נבדק
+    done, failed = run_ops(request['ops'], owner, check=lambda op: validate_op(op, policy, uid), uid=uid)
+    json.dump({'done': done, 'errors': [{'op': op, 'error': str(error)} for op, error in failed]}, sys.stdout)
+    return not failed
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
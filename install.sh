@@ -1,29 +1,54 @@
 #!/bin/bash
 
 # יצירת תיקיות
-sudo mkdir -p /var/www/html/CornGetFromGit/{pending,processed}
+sudo mkdir -p /var/www/html/CornGetFromGit/{pending,processed,locks}
 
 # הגדרת הרשאות לתיקיות
 sudo chown -R www-data:www-data /var/www/html/CornGetFromGit
 sudo chmod -R 775 /var/www/html/CornGetFromGit
+# קבצים חדשים (למשל state.db-wal ו-state.db-shm שהשירות יוצר כ-root) יורשים את הקבוצה www-data
+sudo chmod g+s /var/www/html/CornGetFromGit
 
 # יצירת קבצי מערכת
 #sudo touch /var/www/html/CornGetFromGit/update_process.log
-sudo touch /var/www/html/CornGetFromGit/last_commit.json
+sudo touch /var/www/html/CornGetFromGit/state.db /var/www/html/CornGetFromGit/state.db-wal /var/www/html/CornGetFromGit/state.db-shm
 sudo touch /var/www/html/CornGetFromGit/check_updates.lock
 
 # הגדרת הרשאות לקבצים
 #sudo chown www-data:www-data /var/www/html/CornGetFromGit/update_process.log
-sudo chown www-data:www-data /var/www/html/CornGetFromGit/last_commit.json
+sudo chown www-data:www-data /var/www/html/CornGetFromGit/state.db /var/www/html/CornGetFromGit/state.db-wal /var/www/html/CornGetFromGit/state.db-shm
 sudo chown www-data:www-data /var/www/html/CornGetFromGit/check_updates.lock
 sudo chmod 664 /var/www/html/CornGetFromGit/update_process.log
-sudo chmod 664 /var/www/html/CornGetFromGit/last_commit.json
+sudo chmod 664 /var/www/html/CornGetFromGit/state.db /var/www/html/CornGetFromGit/state.db-wal /var/www/html/CornGetFromGit/state.db-shm
 sudo chmod 664 /var/www/html/CornGetFromGit/check_updates.lock
 
 # העתקת והגדרת הרשאות לסקריפט הראשי
 sudo cp app.py /var/www/html/CornGetFromGit/
 sudo chown www-data:www-data /var/www/html/CornGetFromGit/app.py
 sudo chmod 755 /var/www/html/CornGetFromGit/app.py
+sudo cp file_ops.py /var/www/html/CornGetFromGit/
+sudo chown www-data:www-data /var/www/html/CornGetFromGit/file_ops.py
+
+# העותק שרץ דרך sudo מותקן בתיקייה ש-www-data לא יכול לכתוב אליה
+sudo install -d -o root -g root -m 755 /usr/local/lib/cornget
+sudo install -o root -g root -m 755 file_ops.py /usr/local/lib/cornget/file_ops.py
+
+# מדיניות ה-helper: איפה מותר לכתוב, ממה מותר להעביר ולאיזה בעלים
+sudo install -d -o root -g root -m 755 /etc/cornget
+if [ ! -f /etc/cornget/file_ops.json ]; then
+    sudo tee /etc/cornget/file_ops.json > /dev/null <<'POLICY'
+{
+    "deploy_roots": ["/var/www/html"],
+    "exclude_roots": ["/var/www/html/CornGetFromGit"],
+    "workspace_roots": ["/tmp"],
+    "owner": "www-data:www-data"
+}
+POLICY
+fi
+sudo chown root:root /etc/cornget/file_ops.json
+sudo chmod 644 /etc/cornget/file_ops.json
+sudo cp metrics.py /var/www/html/CornGetFromGit/
+sudo chown www-data:www-data /var/www/html/CornGetFromGit/metrics.py
 
 # העתקת והגדרת שירות המערכת
 sudo cp update_checker.service /etc/systemd/system/
@@ -38,6 +63,8 @@ sudo systemctl start update_checker
 echo "www-data ALL=(ALL) NOPASSWD: /bin/chown -R www-data\:www-data /var/www/html/CornGetFromGit/*" | sudo tee -a /etc/sudoers.d/www-data-updates
 echo "www-data ALL=(ALL) NOPASSWD: /bin/chmod -R 775 /var/www/html/CornGetFromGit/*" | sudo tee -a /etc/sudoers.d/www-data-updates
 echo "www-data ALL=(ALL) NOPASSWD: /bin/rm -rf /var/www/html/CornGetFromGit/*" | sudo tee -a /etc/sudoers.d/www-data-updates
+# המפרש והנתיב חייבים להתאים ל-FILE_OPS_PYTHON ול-FILE_OPS_HELPER ב-app.py
+echo "www-data ALL=(ALL) NOPASSWD: /usr/bin/python3 /usr/local/lib/cornget/file_ops.py" | sudo tee -a /etc/sudoers.d/www-data-updates
 sudo chmod 0440 /etc/sudoers.d/www-data-updates
 
 echo "ההתקנה הושלמה בהצלחה" 
@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+"""שולח אירוע Webhook מוקלט (קובץ JSON) ל-endpoint של /webhook, חתום כמו ש-GitHub חותם.
+
+שימוש:
+    python3 webhook_replay.py payload.json --secret SECRET [--url http://localhost:5000/webhook] [--event push]
+"""
+import sys
+import hmac
+import json
+import hashlib
+import argparse
+import urllib.request
+import urllib.error
+
+
+def sign(body, secret):
+    """מחשב את ערך הכותרת X-Hub-Signature-256 עבור גוף הבקשה"""
+    return 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def send(url, body, secret, event):
+    """שולח את גוף האירוע ומחזיר (קוד סטטוס, תשובה)"""
+    request = urllib.request.Request(url, data=body, method='POST', headers={
+        'Content-Type': 'application/json',
+        'X-GitHub-Event': event,
+        'X-Hub-Signature-256': sign(body, secret),
+    })
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='שליחת אירוע Webhook מוקלט ל-/webhook')
+    parser.add_argument('payload', help='קובץ JSON של האירוע (כפי שנשלח מ-GitHub)')
+    parser.add_argument('--secret', required=True, help='הסוד שהוגדר ב-GITHUB_WEBHOOK_SECRET או ב-webhook_secret')
+    parser.add_argument('--url', default='http://localhost:5000/webhook')
+    parser.add_argument('--event', default='push', help='ערך הכותרת X-GitHub-Event')
+    args = parser.parse_args()
+
+    with open(args.payload, 'rb') as f:
+        body = f.read()
+    json.loads(body)  # וידוא שהקובץ תקין לפני השליחה
+
+    status, text = send(args.url, body, args.secret, args.event)
+    print(f"{status} {text}")
+    return 200 <= status < 300
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)